@@ -38,7 +38,7 @@
 #% gisprompt: old,file,input
 #% label: Path to ASCII file containing authentication parameters
 #% description: "-" to pass the parameters interactively
-#% required: yes
+#% required: no
 #% guisection: Define
 #%end
 #%option
@@ -46,7 +46,22 @@
 #% type: string
 #% key_desc: name
 #% description: Name or IP of server to be connected
-#% required: yes
+#% required: no
+#%end
+#%option
+#% key: backend
+#% type: string
+#% label: Backend executing the jobs
+#% description: qsub submits the jobs to the cluster server, local runs them in temporary mapsets of the current location
+#% options: qsub,local
+#% answer: qsub
+#%end
+#%option
+#% key: nprocs
+#% type: integer
+#% description: Number of jobs run at once by the local backend
+#% required: no
+#% answer: 1
 #%end
 #%option
 #% key: grass_script
@@ -110,13 +125,18 @@
 # import library
 import os
 import sys
+import errno
+import json
+import shutil
+import socket
+import subprocess
 import tarfile
 import ast
 import tempfile
 import getpass
 import itertools
-import collections
 import stat
+from concurrent.futures import ThreadPoolExecutor
 from types import *
 import grass.script as grass
 
@@ -146,7 +166,7 @@ def transposed(lists):
     """Function to transpose list of variables"""
     if not lists:
         return []
-    return map(lambda *row: list(row), *lists)
+    return list(map(lambda *row: list(row), *lists))
 
 
 def _iteration(lis):
@@ -161,7 +181,7 @@ def _iteration(lis):
 def _flatten(lis):
     """Used after iteration to create a good list"""
     for el in lis:
-        if isinstance(el, collections.Iterable) and not isinstance(el, basestring):
+        if isinstance(el, (list, tuple)):
             for sub in _flatten(el):
                 # return but keep the state of the function
                 yield sub
@@ -215,7 +235,7 @@ def copyMaps(conn, infiles, typ, home):
 def variablesCheck(listValue):
     """Function to check if all variables as the same length and
     return the values in a useful list"""
-    if isinstance(listValue[0], ListType):
+    if isinstance(listValue[0], list):
         oldlen = len(listValue[0])
     else:
         grass.fatal(_("Values must be a Python list"))
@@ -279,6 +299,238 @@ def reconnect(conn, pid, path, vari, home):
     return
 
 
+def jobValues():
+    """Return names of variables and list of their values for each job"""
+    if options["variables"] == "":
+        return [], [[]]
+    vari = ast.literal_eval(options["variables"])
+    keys = list(vari.keys())
+    values = list(vari.values())
+    if flags["c"]:
+        values = variablesCheckCicle(values)
+    else:
+        values = variablesCheck(values)
+    return keys, values
+
+
+def writeGisrc(path, vari, mapset):
+    """Write GISRC file for the mapset of the current location"""
+    fd, gisrc = tempfile.mkstemp(prefix="rc.", dir=path)
+    with os.fdopen(fd, "w") as f:
+        f.write("GISDBASE: %s\n" % vari["GISDBASE"])
+        f.write("LOCATION_NAME: %s\n" % vari["LOCATION_NAME"])
+        f.write("MAPSET: %s\n" % mapset)
+        f.write("GUI: text\n")
+    return gisrc
+
+
+def processAlive(pid):
+    """Check if process of this host is running"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def claimJob(mapset, pid):
+    """Claim the mapset of the job for this process. Mapset of unfinished
+    job is claimed again if the job failed or its process of this host is
+    not running"""
+    claim = os.path.join(mapset, ".gcloud_claim")
+    try:
+        os.mkdir(mapset)
+    except OSError:
+        if os.path.exists(os.path.join(mapset, pid)):
+            return False
+        try:
+            with open(claim) as f:
+                host, owner = f.read().split()
+        # claim of failed job is removed
+        except IOError:
+            host = None
+        except ValueError:
+            return False
+        if host:
+            if host != socket.gethostname() or processAlive(int(owner)):
+                return False
+            grass.try_remove(claim)
+    try:
+        fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write("%s %d" % (socket.gethostname(), os.getpid()))
+    return True
+
+
+def runJob(job, pid, values, mapset, vari, path):
+    """Run the GRASS script with the values of variables in the mapset
+    of the job, inputs maps are linked by search path of the mapset.
+    The job is skipped if another process claimed it"""
+    if not claimJob(mapset, pid):
+        return False
+    name = os.path.basename(mapset)
+    location = os.path.dirname(mapset)
+    shutil.copy(
+        os.path.join(location, "PERMANENT", "DEFAULT_WIND"),
+        os.path.join(mapset, "WIND"),
+    )
+    with open(os.path.join(mapset, "SEARCH_PATH"), "w") as f:
+        f.write("\n".join([name] + job["mapsets"]) + "\n")
+    gisrc = writeGisrc(path, vari, name)
+    env = os.environ.copy()
+    for var in ("GRASS_REGION", "WIND_OVERRIDE"):
+        env.pop(var, None)
+    env["GISRC"] = gisrc
+    env["MYPID"] = pid
+    for key, value in zip(job["keys"], values):
+        env[str(key)] = str(value)
+    logfile = os.path.join(path, "%s.log" % name)
+    try:
+        grass.run_command("db.connect", flags="c", quiet=True, env=env)
+        with open(logfile, "w") as log:
+            ret = subprocess.call(
+                ["sh", job["script"]],
+                env=env,
+                cwd=path,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+    finally:
+        grass.try_remove(gisrc)
+    if ret != 0:
+        grass.warning(_("Job <%s> failed, see %s") % (name, logfile))
+        # job can be run again by reconnecting
+        grass.try_remove(os.path.join(mapset, ".gcloud_claim"))
+        return False
+    # leave breadcrumb of finished job as the qsub script does
+    open(os.path.join(mapset, pid), "w").close()
+    return True
+
+
+def collectJobs(job, pid, mapsets, vari, path):
+    """Copy maps of the mapsets of the jobs to the target mapset, only one
+    process collects the maps"""
+    location = os.path.join(vari["GISDBASE"], vari["LOCATION_NAME"])
+    collected = os.path.join(location, "gcloud%s.collected" % pid)
+    try:
+        os.mkdir(collected)
+    except OSError:
+        grass.message(
+            _("Job %s terminated, the results are in mapset <%s>")
+            % (pid, job["target"])
+        )
+        return
+    grass.message(_("Job %s terminated, now coping the result data..." % pid))
+    gisrc = writeGisrc(path, vari, job["target"])
+    env = os.environ.copy()
+    env["GISRC"] = gisrc
+    try:
+        for mapset in mapsets:
+            name = os.path.basename(mapset)
+            for typ in ("raster", "raster_3d", "vector"):
+                maps = grass.read_command("g.list", type=typ, mapset=name, env=env)
+                for m in maps.split():
+                    grass.run_command(
+                        "g.copy",
+                        overwrite=True,
+                        quiet=True,
+                        env=env,
+                        **{typ: "%s@%s,%s" % (m, name, m)}
+                    )
+    except Exception:
+        # the maps are collected again by reconnecting
+        os.rmdir(collected)
+        raise
+    finally:
+        grass.try_remove(gisrc)
+    if not flags["k"]:
+        # the job file first, so the job can not be reconnected anymore
+        grass.try_remove(os.path.join(location, "gcloud%s.json" % pid))
+        for mapset in mapsets:
+            shutil.rmtree(mapset)
+        grass.try_remove(job["script"])
+        os.rmdir(collected)
+    grass.message(_("The results are in mapset <%s>") % job["target"])
+
+
+def localBackend(vari, path):
+    """Run the jobs in temporary mapsets of the current location by a pool
+    of nprocs processes. Other machines sharing GISDBASE can run the jobs
+    too by reconnecting to the job"""
+    location = os.path.join(vari["GISDBASE"], vari["LOCATION_NAME"])
+    if options["reconnect"]:
+        pid = options["reconnect"]
+        jobfile = os.path.join(location, "gcloud%s.json" % pid)
+        if not os.path.exists(jobfile):
+            grass.fatal(
+                _(
+                    "Job %s not found in location <%s>, it is already collected or not launched"
+                )
+                % (pid, location)
+            )
+        with open(jobfile) as f:
+            job = json.load(f)
+    else:
+        if not options["grass_script"]:
+            grass.fatal(_("You have to set %s option") % "grass_script")
+        if not os.path.exists(options["grass_script"]):
+            grass.fatal(_("File %s does not exists" % options["grass_script"]))
+        # the pid of process to have unique value
+        pid = os.path.split(tempfile.mkstemp()[1])[-1]
+        # input maps are not copied, their mapsets are added to search path
+        mapsets = [vari["MAPSET"]]
+        for typ, ele in (("raster", "cell"), ("vector", "vector")):
+            if options[typ] == "":
+                continue
+            for i in options[typ].split(","):
+                gfile = grass.find_file(name=i, element=ele)
+                if not gfile["name"]:
+                    grass.fatal(_("%s map <%s> not found") % (typ, i))
+                mapsets.append(gfile["mapset"])
+        mapsets.append("PERMANENT")
+        keys, values = jobValues()
+        # script is copied to the location, visible for all machines
+        script = os.path.join(location, "gcloud%s.sh" % pid)
+        shutil.copy(options["grass_script"], script)
+        job = {
+            "script": script,
+            "keys": keys,
+            "values": values,
+            "mapsets": sorted(set(mapsets), key=mapsets.index),
+            "target": vari["MAPSET"],
+        }
+        with open(os.path.join(location, "gcloud%s.json" % pid), "w") as f:
+            json.dump(job, f)
+        grass.message(_("Launching %i jobs..." % len(values)))
+
+    mapsets = [
+        os.path.join(location, "gcloud%s_%d" % (pid, i))
+        for i in range(len(job["values"]))
+    ]
+    if not os.path.exists(os.path.join(location, "gcloud%s.collected" % pid)):
+        # every job is claimed by the process running it, so other machines
+        # reconnecting to the job run the jobs not yet claimed
+        with ThreadPoolExecutor(int(options["nprocs"])) as pool:
+            jobs = [
+                pool.submit(runJob, job, pid, values, mapset, vari, path)
+                for values, mapset in zip(job["values"], mapsets)
+            ]
+            # raise errors of the jobs
+            for j in jobs:
+                j.result()
+        finished = [m for m in mapsets if os.path.exists(os.path.join(m, pid))]
+        if len(finished) < len(mapsets):
+            grass.message(
+                _("Job %s not yet completed, %d of %d jobs finished...")
+                % (pid, len(finished), len(mapsets))
+            )
+            grass.message(_("   g.cloud backend=local reconnect=%s" % pid))
+            return
+    collectJobs(job, pid, mapsets, vari, path)
+
+
 # main function
 def main():
     # set the home path
@@ -289,7 +541,7 @@ def main():
         grass.fatal(_("$GISBASE not defined"))
         return 0
     # check ssh
-    if not grass.find_program("ssh", "-V"):
+    if options["backend"] == "qsub" and not grass.find_program("ssh", "-V"):
         grass.fatal(_("%s required. Please install '%s' first.") % ("ssh", "ssh"))
         return 0
     # parse the grassdata, location e mapset
@@ -308,6 +560,14 @@ def main():
     path = os.path.join(home, session_path, "g.cloud")
     if not os.path.exists(path):
         os.makedirs(path)
+    if options["backend"] == "local":
+        if int(options["nprocs"]) < 1:
+            grass.fatal(_("Option %s must be greater than 0") % "nprocs")
+        localBackend(variables, path)
+        return
+    for opt in ("config", "server"):
+        if not options[opt]:
+            grass.fatal(_("You have to set %s option") % opt)
     # set username, password and folder if settings are inserted by stdin
     if options["config"] == "-":
         user = raw_input(_("Insert username: "))
@@ -426,13 +686,7 @@ def main():
         qsubid = os.path.join(serverFolder, "tmpqsub")
         grass.debug("The pid of job is %s" % (str(pid)), debug=2)
         if options["variables"] != "":
-            vari = ast.literal_eval(options["variables"])
-            values = vari.values()
-            keys = vari.keys()
-            if flags["c"]:
-                values = variablesCheckCicle(values)
-            else:
-                values = variablesCheck(values)
+            keys, values = jobValues()
             njobs = 0
             for val in range(len(values)):
                 launchstr = (
@@ -34,6 +34,10 @@
 #% key: t
 #% description: Does not consider the topology for vector
 #%end
+#%flag
+#% key: m
+#% description: Reuse digests stored in manifest of mapset for unchanged files
+#%end
 #%option
 #% key: ainput
 #% type: string
@@ -54,31 +58,130 @@
 #% options: raster,vector
 #% answer: raster
 #%end
+#%option
+#% key: hash
+#% type: string
+#% description: Hash function used to compare the files
+#% options: md5,blake2b
+#% answer: md5
+#%end
+#%option
+#% key: nprocs
+#% type: integer
+#% description: Number of files hashed in parallel
+#% required: no
+#% answer: 1
+#%end
 
 import os
 import sys
+import json
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import grass.script as grass
 
+# size of blocks in which the files are read
+CHUNK_SIZE = 1024 * 1024
+# file of mapset with digests of its files
+MANIFEST = ".g.compare.md5.json"
+
 
-def md5(fileName, excludeLine="", includeLine=""):
-    """Compute md5 hash of the specified file"""
-    m = hashlib.md5()
+def md5(fileName, excludeLine="", includeLine="", hashname="md5"):
+    """Compute hash of the specified file, the file is read in chunks"""
+    m = hashlib.new(hashname)
     try:
         fd = open(fileName, "rb")
     except IOError:
         print("Unable to open the file in read mode")
         return
-    content = fd.readlines()
-    fd.close()
-    for eachLine in content:
-        if excludeLine and eachLine.startswith(excludeLine):
-            continue
-        m.update(eachLine)
+    with fd:
+        if excludeLine:
+            excludeLine = excludeLine.encode("utf-8")
+            for eachLine in fd:
+                if eachLine.startswith(excludeLine):
+                    continue
+                m.update(eachLine)
+        else:
+            for chunk in iter(lambda: fd.read(CHUNK_SIZE), b""):
+                m.update(chunk)
     m.update(includeLine.encode("utf-8"))
     return m.hexdigest()
 
 
+class Manifest(object):
+    """Digests of files of a mapset stored with size and modification
+    time of the files, so only changed files are hashed again"""
+
+    def __init__(self, mapset):
+        self.mapset = mapset
+        self.path = os.path.join(mapset, MANIFEST)
+        self.changed = False
+        try:
+            with open(self.path) as fd:
+                self.digests = json.load(fd)
+        except (IOError, ValueError):
+            self.digests = {}
+
+    def _key(self, fileName, hashname):
+        stat = os.stat(fileName)
+        name = os.path.relpath(fileName, self.mapset)
+        return name, [stat.st_size, stat.st_mtime_ns, hashname]
+
+    def get(self, fileName, hashname):
+        """Return stored digest of the file or None if the file changed"""
+        name, key = self._key(fileName, hashname)
+        entry = self.digests.get(name)
+        if entry and entry[:3] == key:
+            return entry[3]
+
+    def set(self, fileName, hashname, digest):
+        """Store digest of the file"""
+        name, key = self._key(fileName, hashname)
+        self.digests[name] = key + [digest]
+        self.changed = True
+
+    def save(self):
+        """Write the manifest if changed, mapset can be read only"""
+        if not self.changed:
+            return
+        tmp = self.path + ".%d" % os.getpid()
+        try:
+            with open(tmp, "w") as fd:
+                json.dump(self.digests, fd)
+            os.replace(tmp, self.path)
+        except (IOError, OSError):
+            grass.verbose(_("Unable to write manifest of mapset %s") % self.mapset)
+            grass.try_remove(tmp)
+
+
+def hashfiles(files, hashname, nprocs, manifests=None):
+    """Hash the files by nprocs threads, digests of unchanged files are
+    taken from the manifests
+
+    :param files: list of files
+    :param manifests: dictionary of files and Manifest of their mapset
+
+    :return: dictionary of files and their digests
+    """
+    digests = {}
+    manifests = manifests or {}
+    for fileName in files:
+        manifest = manifests.get(fileName)
+        if manifest:
+            digest = manifest.get(fileName, hashname)
+            if digest:
+                digests[fileName] = digest
+    tohash = [f for f in files if f not in digests]
+    with ThreadPoolExecutor(nprocs) as pool:
+        for fileName, digest in zip(
+            tohash, pool.map(lambda f: md5(f, hashname=hashname), tohash)
+        ):
+            digests[fileName] = digest
+            if fileName in manifests:
+                manifests[fileName].set(fileName, hashname, digest)
+    return digests
+
+
 def checkfile(name, formatt, shell):
     """Check if the input file exists"""
     if formatt == "raster":
@@ -97,8 +200,9 @@ def checkfile(name, formatt, shell):
         return inp
 
 
-def checkmd5(a, b, shell):
-    """Check if md5 is the same for both files"""
+def checkmd5(a, b, shell, digests=None):
+    """Check if md5 is the same for both files, digests of the files can
+    be computed in advance by hashfiles()"""
     # check if the files exist and if the user have permission to read them
     if os.path.exists(a) and os.path.exists(b):
         if not os.access(a, os.R_OK):
@@ -114,8 +218,15 @@ def checkmd5(a, b, shell):
             else:
                 grass.fatal(_("You have no permission to read %s file" % b))
         # calculate the md5
-        amd5 = md5(a)
-        bmd5 = md5(b)
+        if digests is None:
+            amd5 = md5(a)
+            bmd5 = md5(b)
+        # files of different size can not be the same
+        elif os.path.getsize(a) != os.path.getsize(b):
+            return 0
+        else:
+            amd5 = digests[a]
+            bmd5 = digests[b]
         # check if md5 is the same
         if amd5 == bmd5:
             return 1
@@ -136,6 +247,8 @@ def main():
     if not gisbase:
         grass.fatal(_("$GISBASE not defined"))
         return 0
+    if int(options["nprocs"]) < 1:
+        grass.fatal(_("Option %s must be greater than 0") % "nprocs")
     # check if shell script output is required
     if flags["g"]:
         shell = True
@@ -165,8 +278,8 @@ def main():
     bloc = os.path.join(
         variables["GISDBASE"], variables["LOCATION_NAME"], binp["mapset"]
     )
-    # variable for color table
-    md5color = 1
+    # pairs of files to compare
+    pairs = []
     # start analysis for raster
     if typ == "raster":
         # for each folder
@@ -181,32 +294,47 @@ def main():
                 # if the files are the same check md5sum for each file
                 if adirlist == bdirlist:
                     for i in adirlist:
-                        apath = os.path.join(apath, i)
-                        bpath = os.path.join(bpath, i)
-                        if not checkmd5(apath, bpath, shell):
-                            grass.message(err)
-                            return
+                        pairs.append((os.path.join(apath, i), os.path.join(bpath, i)))
                 # if the files are different return false
                 else:
                     grass.message(err)
                     return
             # check md5sum for each file
             else:
-                if not checkmd5(apath, bpath, shell):
-                    grass.message(err)
-                    return
-        grass.message(good)
-        return
+                pairs.append((apath, bpath))
     # start analysis for vector
     elif typ == "vector":
         for fold in vector_folder:
             apath = os.path.join(aloc, "vector", ainp["name"], fold)
             bpath = os.path.join(bloc, "vector", binp["name"], fold)
-            if not checkmd5(apath, bpath, shell):
-                grass.message(err)
-                return
-        grass.message(good)
-        return
+            pairs.append((apath, bpath))
+
+    # hash files which exist in both maps and have the same size
+    files = []
+    for apath, bpath in pairs:
+        if (
+            os.access(apath, os.R_OK)
+            and os.access(bpath, os.R_OK)
+            and os.path.getsize(apath) == os.path.getsize(bpath)
+        ):
+            files.extend((apath, bpath))
+    manifests = {}
+    if flags["m"]:
+        amanifest = Manifest(aloc)
+        bmanifest = Manifest(bloc) if bloc != aloc else amanifest
+        for apath, bpath in pairs:
+            manifests[apath] = amanifest
+            manifests[bpath] = bmanifest
+    digests = hashfiles(files, options["hash"], int(options["nprocs"]), manifests)
+    for manifest in set(manifests.values()):
+        manifest.save()
+
+    for apath, bpath in pairs:
+        if not checkmd5(apath, bpath, shell, digests):
+            grass.message(err)
+            return
+    grass.message(good)
+    return
 
 
 if __name__ == "__main__":
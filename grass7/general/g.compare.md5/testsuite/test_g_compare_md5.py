@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import importlib.util
+
+from grass.gunittest.case import TestCase
+from grass.gunittest.main import test
+
+# the module name contains a dot, load it from its file
+spec = importlib.util.spec_from_file_location(
+    "compare_md5",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "g.compare.md5.py"),
+)
+compare_md5 = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(compare_md5)
+
+
+class TestManifest(TestCase):
+    """Digests of unchanged files are taken from the manifest"""
+
+    def setUp(self):
+        self.mapset = tempfile.mkdtemp()
+        self.files = []
+        for name, content in (("a", b"first file"), ("b", b"second file")):
+            path = os.path.join(self.mapset, name)
+            with open(path, "wb") as fd:
+                fd.write(content)
+            self.files.append(path)
+        self.hashed = []
+        md5 = compare_md5.md5
+
+        def counting_md5(fileName, *args, **kwargs):
+            self.hashed.append(fileName)
+            return md5(fileName, *args, **kwargs)
+
+        compare_md5.md5 = counting_md5
+        self.addCleanup(setattr, compare_md5, "md5", md5)
+
+    def tearDown(self):
+        shutil.rmtree(self.mapset)
+
+    def hashfiles(self):
+        manifest = compare_md5.Manifest(self.mapset)
+        manifests = dict((path, manifest) for path in self.files)
+        digests = compare_md5.hashfiles(self.files, "md5", 2, manifests)
+        manifest.save()
+        return digests
+
+    def test_reuse_digests(self):
+        """Second run hashes only the changed file"""
+        first = self.hashfiles()
+        self.assertEqual(sorted(self.hashed), sorted(self.files))
+        self.assertTrue(os.path.exists(os.path.join(self.mapset, compare_md5.MANIFEST)))
+
+        del self.hashed[:]
+        second = self.hashfiles()
+        self.assertEqual(self.hashed, [])
+        self.assertEqual(second, first)
+
+        with open(self.files[1], "wb") as fd:
+            fd.write(b"changed file")
+        third = self.hashfiles()
+        self.assertEqual(self.hashed, [self.files[1]])
+        self.assertEqual(third[self.files[0]], first[self.files[0]])
+        self.assertNotEqual(third[self.files[1]], first[self.files[1]])
+
+
+if __name__ == "__main__":
+    test()
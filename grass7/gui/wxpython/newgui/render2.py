@@ -25,15 +25,23 @@ This program is free software under the GNU General Public License
 """
 
 import os
+import re
 import sys
 import glob
 import math
 import copy
 import tempfile
 import types
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import wx
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from grass.script import core as grass
 
 from core import utils
@@ -43,6 +51,10 @@ from core.debug import Debug
 from core.settings import UserSettings
 
 USE_GPNMCOMP = True
+# number of layers rendered at once
+RENDER_THREADS = 4
+# number of rendered map layer images kept by render cache
+RENDER_CACHE_SIZE = 32
 
 
 class Layer(object):
@@ -124,9 +136,11 @@ class Layer(object):
             % (self.name, self.GetCmd(string=True)),
         )
 
-    def Render(self):
+    def Render(self, env=None):
         """!Render layer to image
 
+        @param env environment of render command, os.environ if None
+
         @return rendered image filename
         @return None on error or if cmdfile is defined
         """
@@ -148,23 +162,25 @@ class Layer(object):
                 % {"type": self.type, "name": self.name}
             )
 
+        # own copy of environment, layers can be rendered concurrently
+        if env is None:
+            env = os.environ
+        env = env.copy()
         if self.mapfile:
-            os.environ["GRASS_RENDER_FILE"] = self.mapfile
+            env["GRASS_RENDER_FILE"] = self.mapfile
 
         # execute command
         try:
             if self.type == "command":
                 read = False
                 for c in self.cmd:
-                    ret, msg = self._runCommand(c)
+                    ret, msg = self._runCommand(c, env)
                     if ret != 0:
                         break
                     if not read:
-                        os.environ["GRASS_RENDER_FILE_READ"] = "TRUE"
-
-                os.environ["GRASS_RENDER_FILE_READ"] = "FALSE"
+                        env["GRASS_RENDER_FILE_READ"] = "TRUE"
             else:
-                ret, msg = self._runCommand(self.cmd)
+                ret, msg = self._runCommand(self.cmd, env)
             if ret != 0:
                 sys.stderr.write(_("Command '%s' failed\n") % self.GetCmd(string=True))
                 if msg:
@@ -179,22 +195,20 @@ class Layer(object):
                 grass.try_remove(f)
                 f = None
 
-        # stop monitor
-        if self.mapfile and "GRASS_RENDER_FILE" in os.environ:
-            del os.environ["GRASS_RENDER_FILE"]
-
         self.forceRender = False
 
         return self.mapfile
 
-    def _runCommand(self, cmd):
+    def _runCommand(self, cmd, env=None):
         """!Run command to render data"""
         if self.type == "wms":
             ret = 0
             msg = ""
             self.renderMgr.Render(cmd)
         else:
-            ret, msg = RunCommand(cmd[0], getErrorMsg=True, quiet=True, **cmd[1])
+            ret, msg = RunCommand(
+                cmd[0], getErrorMsg=True, quiet=True, env=env, **cmd[1]
+            )
 
         return ret, msg
 
@@ -414,6 +428,12 @@ class Map(object):
         # setting some initial env. variables
         self._initGisEnv()  # g.gisenv
         self.GetWindow()
+        self.gisenv = self.env
+
+        # rendered images of map layers (least recently used are dropped)
+        self.renderCache = OrderedDict()
+        # images of map layers of last rendering
+        self.images = list()
 
         # receiver of events
         self.receiver = None
@@ -911,6 +931,9 @@ class Map(object):
     def _renderLayers(self, force=False, overlaysOnly=False):
         """!Render all map layers into files
 
+        Layers are rendered concurrently. Map layers found in render
+        cache are not rendered again.
+
         @param force True to force rendering
         @param overlaysOnly True to render only overlays
 
@@ -919,46 +942,154 @@ class Map(object):
         maps = list()
         masks = list()
         opacities = list()
+        self.images = list()
         # render map layers
         if overlaysOnly:
             layers = self.overlays
         else:
             layers = self.layers + self.overlays
+        layers = [layer for layer in layers if layer and layer.active]
+
+        keys = dict()
+        render = list()
+        for layer in layers:
+            keys[layer] = self._getCacheKey(layer)
+            if keys[layer] in self.renderCache:
+                continue
+            if force or layer.forceRender:
+                render.append(layer)
+
+        # wms layers are downloaded by their render manager
+        rendered = dict()
+        for layer in render:
+            if layer.type == "wms":
+                rendered[layer] = layer.Render()
+        render = [layer for layer in render if layer.type != "wms"]
+        if render:
+            env = os.environ.copy()
+            pool = ThreadPool(min(RENDER_THREADS, len(render)))
+            try:
+                mapfiles = pool.map(lambda layer: layer.Render(env), render)
+            finally:
+                pool.close()
+                pool.join()
+            rendered.update(zip(render, mapfiles))
 
         self.downloading = False
         if self.receiver:
             event = wxUpdateProgressBar(layer=None, map=self)
             self.receiver.GetEventHandler().ProcessEvent(event)
         for layer in layers:
-            # skip non-active map layers
-            if not layer or not layer.active:
+            if layer in rendered and not rendered[layer]:
                 continue
 
-            # render
-            if force or layer.forceRender:
-                if not layer.Render():
-                    continue
-
             if layer.IsDownloading():
                 self.downloading = True
             if self.receiver:
                 event = wxUpdateProgressBar(layer=layer, map=self)
                 self.receiver.GetEventHandler().ProcessEvent(event)
 
+            key = keys[layer]
+            if key in self.renderCache:
+                image = self.renderCache.pop(key)
+                self.renderCache[key] = image
             # skip map layers when rendering fails
-            if not os.path.exists(layer.mapfile):
+            elif not os.path.exists(layer.mapfile):
                 continue
+            elif np is not None and layer.type != "overlay":
+                image = self._readLayerImage(layer)
+                if key and layer in rendered:
+                    self.renderCache[key] = image
+                    while len(self.renderCache) > RENDER_CACHE_SIZE:
+                        self.renderCache.popitem(last=False)
 
             # add image to compositing list
             if layer.type != "overlay":
                 maps.append(layer.mapfile)
                 masks.append(layer.maskfile)
                 opacities.append(str(layer.opacity))
+                if np is not None:
+                    self.images.append(image)
 
             Debug.msg(3, "Map.Render() type=%s, layer=%s " % (layer.type, layer.name))
 
         return maps, masks, opacities
 
+    def _getCacheKey(self, layer):
+        """!Get key of map layer image in render cache
+
+        The key consists of command, region, size of the map display
+        and modification time of the map of the layer.
+
+        @return key or None if layer is not cached
+        """
+        if np is None or layer.type not in ("raster", "vector"):
+            return None
+        name = layer.GetName(fullyQualified=False)
+        if not name["mapset"]:
+            return None
+
+        location = os.path.join(self.gisenv["GISDBASE"], self.gisenv["LOCATION_NAME"])
+        if layer.type == "raster":
+            files = [
+                os.path.join(location, name["mapset"], element, name["name"])
+                for element in ("cell", "cellhd", "colr", "cats")
+            ]
+            files.append(
+                os.path.join(
+                    location,
+                    self.gisenv["MAPSET"],
+                    "colr2",
+                    name["mapset"],
+                    name["name"],
+                )
+            )
+        else:
+            files = glob.glob(
+                os.path.join(location, name["mapset"], "vector", name["name"], "*")
+            )
+        mtime = max([os.path.getmtime(f) for f in files if os.path.exists(f)] or [None])
+
+        return (
+            layer.GetCmd(string=True),
+            os.getenv("GRASS_REGION"),
+            self.width,
+            self.height,
+            mtime,
+        )
+
+    def _readLayerImage(self, layer):
+        """!Read rendered image of map layer
+
+        @return tuple of color (rows, cols, 3) and alpha (rows, cols, 1) arrays
+        """
+        rgb = _readPnm(layer.mapfile)
+        if layer.maskfile and os.path.exists(layer.maskfile):
+            alpha = _readPnm(layer.maskfile)
+        else:
+            alpha = np.empty(rgb.shape[:2] + (1,), dtype=np.uint8)
+            alpha.fill(255)
+
+        return rgb, alpha
+
+    def _composite(self, opacities, bgcolor):
+        """!Composite images of map layers into self.mapfile by alpha
+        blending as g.pnmcomp does
+
+        @param opacities list of layer opacities
+        @param bgcolor background color (r, g, b)
+        """
+        out = np.empty((self.height, self.width, 3))
+        out[...] = bgcolor
+        for (rgb, alpha), opacity in zip(self.images, opacities):
+            if rgb.shape[:2] != out.shape[:2]:
+                continue
+            out += (rgb - out) * (alpha * (float(opacity) / 255))
+
+        with open(self.mapfile, "wb") as f:
+            f.write(("P6\n%d %d\n255\n" % (self.width, self.height)).encode())
+            f.write(np.around(out).astype(np.uint8).tobytes())
+
     def GetMapsMasksAndOpacities(self, force, windres):
         """!
         Used by Render function.
@@ -1015,7 +1146,12 @@ class Map(object):
             map(str, UserSettings.Get(group="display", key="bgcolor", subkey="color"))
         )
 
-        if maps:
+        if maps and np is not None:
+            self._composite(
+                opacities,
+                UserSettings.Get(group="display", key="bgcolor", subkey="color")[:3],
+            )
+        elif maps:
             ret, msg = RunCommand(
                 "g.pnmcomp",
                 getErrorMsg=True,
@@ -1432,6 +1568,7 @@ class Map(object):
         """
         self._clean(self.layers)
         self._clean(self.overlays)
+        self.renderCache.clear()
 
     def ReverseListOfLayers(self):
         """!Reverse list of layers"""
@@ -1461,3 +1598,21 @@ class Map(object):
         """!Abort all layers threads e. g. donwloading data"""
         for l in self.layers + self.overlays:
             l.AbortThread()
+
+
+def _readPnm(filename):
+    """!Read binary PPM or PGM image
+
+    @return array (rows, cols, channels)
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    header = re.match(br"P([56])\s+(\d+)\s+(\d+)\s+255\s", data)
+    if not header:
+        raise GException(_("Unable to read image <%s>") % filename)
+    channels = 3 if header.group(1) == b"6" else 1
+    cols, rows = int(header.group(2)), int(header.group(3))
+
+    return np.frombuffer(data, dtype=np.uint8, offset=header.end()).reshape(
+        rows, cols, channels
+    )
@@ -23,6 +23,10 @@
 #%  key: e
 #%  description: External georeferencing in the images folder (when using images_directory)
 #%end
+#%flag
+#%  key: t
+#%  description: Detect in overlapping tiles read directly from the raster maps (when using band1)
+#%end
 #%option
 #% key: band1
 #% type: string
@@ -71,6 +75,39 @@
 #% answer: area
 #% required: no
 #%end
+#%option
+#% key: tile_size
+#% type: integer
+#% label: Size of tiles in cells (when using -t flag)
+#% answer: 768
+#% required: no
+#% guisection: Tiling
+#%end
+#%option
+#% key: overlap
+#% type: integer
+#% label: Overlap of neighbouring tiles in cells (when using -t flag)
+#% description: Should be larger than the detected features
+#% answer: 128
+#% required: no
+#% guisection: Tiling
+#%end
+#%option
+#% key: batch_size
+#% type: integer
+#% label: Number of tiles detected in one forward pass (when using -t flag)
+#% answer: 1
+#% required: no
+#% guisection: Tiling
+#%end
+#%option
+#% key: nprocs
+#% type: integer
+#% label: Number of worker processes running the detection (when using -t flag)
+#% answer: 1
+#% required: no
+#% guisection: Tiling
+#%end
 #%rules
 #% requires_all: images_directory, images_format
 #% requires_all: band1, band2, band3
@@ -88,12 +125,21 @@ import numpy as np
 import grass.script as gscript
 from grass.script.utils import get_lib_path
 import grass.script.array as garray
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
 
 path = get_lib_path(modname="maskrcnn", libname="model")
 if path is None:
     gscript.fatal("Not able to find the maskrcnn library directory.")
 sys.path.append(path)
 
+# null value for CELL maps
+CNULL = -2147483648
+
+# model used for the tiled detection, loaded once per worker process
+tiledModel = None
+
 
 def main(options, flags):
 
@@ -103,9 +149,6 @@ def main(options, flags):
     except ImportError as e:
         gscript.fatal(_("Module requires GDAL python bindings: {}").format(e))
 
-    import model as modellib
-    from config import ModelConfig
-
     try:
         imagesDir = options["images_directory"]
         modelPath = options["model"]
@@ -126,6 +169,11 @@ def main(options, flags):
         else:
             extension = ""
 
+        tileSize = int(options["tile_size"])
+        overlap = int(options["overlap"])
+        batchSize = int(options["batch_size"])
+        nprocs = int(options["nprocs"])
+
         # a directory where masks and georeferencing will be saved in case of
         # external images
         masksDir = gscript.core.tempfile().rsplit(os.sep, 1)[0]
@@ -150,6 +198,11 @@ def main(options, flags):
         else:
             extension = ""
 
+        tileSize = int(options[b"tile_size"].decode("utf-8"))
+        overlap = int(options[b"overlap"].decode("utf-8"))
+        batchSize = int(options[b"batch_size"].decode("utf-8"))
+        nprocs = int(options[b"nprocs"].decode("utf-8"))
+
         newFlags = dict()
         for flag, value in flags.items():
             newFlags.update({flag.decode("utf-8"): value})
@@ -169,20 +222,37 @@ def main(options, flags):
     if len(set(classes)) != len(classes):
         gscript.fatal("Two or more classes have the same name.")
 
+    if flags["t"] and not 0 <= overlap < tileSize:
+        gscript.fatal("Overlap must be smaller than the size of tiles.")
+
     # used colour corresponds to class_id
     classesColours = range(len(classes) + 1)
 
-    # Create model object in inference mode.
-    config = ModelConfig(numClasses=len(classes) + 1)
-    model = modellib.MaskRCNN(mode="inference", model_dir=modelPath, config=config)
-
-    model.load_weights(modelPath, by_name=True)
+    # Create model object in inference mode (only when needed, the tiled
+    # detection loads its own models)
+    model = None
 
     masks = list()
     detectedClasses = list()
 
+    if len(band1) > 0 and flags["t"]:
+        gscript.message("Detecting features in tiles of raster maps...")
+        detect_tiled(
+            list(zip(band1, band2, band3)),
+            modelPath,
+            len(classes) + 1,
+            tileSize,
+            overlap,
+            batchSize,
+            nprocs,
+            outputType,
+            masks,
+            detectedClasses,
+        )
+
     # TODO: Use the whole list instead of iteration
-    if len(band1) > 0:
+    elif len(band1) > 0:
+        model = load_model(modelPath, len(classes) + 1)
         gscript.message("Detecting features in raster maps...")
         # using maps imported in GRASS
         mapsCount = len(band1)
@@ -222,6 +292,8 @@ def main(options, flags):
                 )
 
     if imagesDir:
+        if model is None:
+            model = load_model(modelPath, len(classes) + 1)
         gscript.message("Detecting features in images from the directory...")
         for imageFile in [
             file
@@ -299,6 +371,251 @@ def main(options, flags):
     gscript.run_command("g.remove", "f", name=masksString, type="raster", quiet=True)
 
 
+def load_model(modelPath, numClasses, batchSize=1):
+    """
+    Create a Mask R-CNN model in inference mode and load its weights.
+
+    :param modelPath: path to the .h5 file containing the model
+    :param numClasses: number of classes including the background
+    :param batchSize: number of images detected in one forward pass
+    """
+    import model as modellib
+    from config import ModelConfig
+
+    config = ModelConfig(numClasses=numClasses, imagesPerGPU=batchSize)
+    model = modellib.MaskRCNN(mode="inference", model_dir=modelPath, config=config)
+    model.load_weights(modelPath, by_name=True)
+
+    return model
+
+
+def init_tiled_model(modelPath, numClasses, batchSize):
+    """
+    Load the model used by detect_band() in the current process.
+    """
+    global tiledModel
+    tiledModel = load_model(modelPath, numClasses, batchSize)
+
+
+def tile_starts(size, tileSize, overlap):
+    """
+    Return first cells of overlapping tiles covering the given size.
+
+    :param size: number of rows or columns to cover
+    :param tileSize: size of tiles in cells
+    :param overlap: overlap of neighbouring tiles in cells
+    """
+    return list(range(0, max(size - overlap, 1), tileSize - overlap))
+
+
+def tile_core(start, starts, size, tileSize, overlap):
+    """
+    Return the part of a tile owning the detections, the cores of all tiles
+    cover the region without overlapping.
+
+    :param start: first cell of the tile
+    :param starts: first cells of all the tiles
+    :param size: number of rows or columns of the region
+    """
+    half = overlap // 2
+    first = start + half if start > 0 else 0
+    last = start + tileSize - overlap + half if start != starts[-1] else size
+
+    return first, last
+
+
+def read_tile_rows(maps, start, end):
+    """
+    Read rows of three raster maps directly into a model-ready array.
+
+    :param maps: names of the raster maps used as the three bands
+    :param start: first row to read
+    :param end: row following the last one to read
+
+    :return: [rows, cols, 3] array, null cells set to 0
+    """
+    region = Region()
+    bands = np.zeros((end - start, region.cols, 3), dtype=np.float32)
+    for b, mapName in enumerate(maps):
+        with RasterRow(mapName) as raster:
+            for i, row in enumerate(range(start, end)):
+                bands[i, :, b] = raster[row]
+            if raster.mtype == "CELL":
+                bands[:, :, b][bands[:, :, b] == CNULL] = 0
+    np.nan_to_num(bands, copy=False)
+
+    return bands
+
+
+def detect_band(args):
+    """
+    Detect features in a band of tiles sharing the same rows.
+
+    Tiles are padded to tileSize and detected in batches. Only instances
+    with the centre of their bounding box in the core of a tile are kept,
+    so that features crossing tile seams are taken from one tile only.
+
+    :return: first row of the band, [rows, cols] array of class IDs of the
+        kept instances (0 elsewhere) and the set of detected class IDs
+    """
+    maps, rowStart, rowCore, tileSize, overlap, which, verbosity = args
+
+    region = Region()
+    region.from_rast(maps[0])
+    region.set_raster_region()
+    rowEnd = min(rowStart + tileSize, region.rows)
+    bands = read_tile_rows(maps, rowStart, rowEnd)
+    labels = np.zeros(bands.shape[:2], dtype=np.uint8)
+    detected = set()
+
+    colStarts = tile_starts(region.cols, tileSize, overlap)
+    batchSize = tiledModel.config.BATCH_SIZE
+    for b in range(0, len(colStarts), batchSize):
+        batchStarts = colStarts[b : b + batchSize]
+        tiles = list()
+        for colStart in batchStarts:
+            tile = np.zeros((tileSize, tileSize, 3), dtype=np.float32)
+            part = bands[:, colStart : colStart + tileSize]
+            tile[: part.shape[0], : part.shape[1]] = part
+            tiles.append(tile)
+        # all images of a batch must be given to the model
+        tiles.extend([tiles[-1]] * (batchSize - len(tiles)))
+
+        results = tiledModel.detect(tiles, verbosity=verbosity)
+
+        for colStart, r in zip(batchStarts, results):
+            colCore = tile_core(colStart, colStarts, region.cols, tileSize, overlap)
+            height = rowEnd - rowStart
+            width = min(tileSize, region.cols - colStart)
+            for i, classId in enumerate(r["class_ids"]):
+                if not np.any(r["rois"][i]):
+                    # Skip this instance. Has no bbox.
+                    continue
+                y1, x1, y2, x2 = r["rois"][i]
+                row = int((y1 + y2) / 2)
+                col = int((x1 + x2) / 2)
+                if not (
+                    rowCore[0] <= rowStart + row < rowCore[1]
+                    and colCore[0] <= colStart + col < colCore[1]
+                ):
+                    continue
+                detected.add(int(classId))
+                if which == "area":
+                    mask = r["masks"][:height, :width, i].astype(bool)
+                    labels[:, colStart : colStart + width][mask] = classId
+                else:
+                    labels[row, colStart + col] = classId
+
+    return rowStart, labels, detected
+
+
+def detect_tiled(
+    mapsList,
+    modelPath,
+    numClasses,
+    tileSize,
+    overlap,
+    batchSize,
+    nprocs,
+    which,
+    mList,
+    cList,
+):
+    """
+    Detect features in overlapping tiles of raster maps and write the
+    detected classes into one raster map per set of bands.
+
+    Bands of tiles are detected by worker processes (each one loading the
+    model once) and merged into the output map row by row as soon as no
+    other tile can cover the rows.
+
+    :param mapsList: list of (band1, band2, band3) raster map names
+    :param modelPath: path to the .h5 file containing the model
+    :param numClasses: number of classes including the background
+    :param which: either 'area' or 'point', a representation of detections
+    :param mList: list of names of created rasters
+    :param cList: list of classes with at least one instance
+    """
+    if nprocs > 1:
+        from multiprocessing import Pool
+
+        pool = Pool(
+            nprocs,
+            initializer=init_tiled_model,
+            initargs=(modelPath, numClasses, batchSize),
+        )
+        mapper = pool.imap
+    else:
+        init_tiled_model(modelPath, numClasses, batchSize)
+        pool = None
+        mapper = map
+
+    try:
+        for i, maps in enumerate(mapsList):
+            gscript.percent(i + 1, len(mapsList), 1)
+            maskName = "{}_{}".format(maps[0].split(".")[0], i)
+            region = Region()
+            region.from_rast(maps[0])
+            region.set_raster_region()
+
+            rowStarts = tile_starts(region.rows, tileSize, overlap)
+            jobs = [
+                (
+                    maps,
+                    rowStart,
+                    tile_core(rowStart, rowStarts, region.rows, tileSize, overlap),
+                    tileSize,
+                    overlap,
+                    which,
+                    gscript.verbosity(),
+                )
+                for rowStart in rowStarts
+            ]
+
+            # rows detected but not yet written, starting at row written
+            pending = np.zeros((0, region.cols), dtype=np.uint8)
+            written = 0
+            detected = set()
+            with RasterRow(
+                maskName, mode="w", mtype="CELL", overwrite=gscript.overwrite()
+            ) as out:
+                newRow = Buffer((region.cols,), mtype="CELL")
+                for k, (rowStart, labels, classIds) in enumerate(
+                    mapper(detect_band, jobs)
+                ):
+                    detected.update(classIds)
+                    end = rowStart + labels.shape[0]
+                    if end - written > pending.shape[0]:
+                        pending = np.vstack(
+                            (
+                                pending,
+                                np.zeros(
+                                    (end - written - pending.shape[0], region.cols),
+                                    dtype=np.uint8,
+                                ),
+                            )
+                        )
+                    target = pending[rowStart - written : end - written]
+                    np.copyto(target, labels, where=labels > 0)
+
+                    # rows before the next band of tiles are final
+                    final = rowStarts[k + 1] if k + 1 < len(rowStarts) else end
+                    for row in pending[: final - written]:
+                        newRow[:] = row
+                        out.put_row(newRow)
+                    pending = pending[final - written :]
+                    written = final
+
+            mList.append(maskName)
+            for classId in sorted(detected):
+                if classId not in cList:
+                    cList.append(classId)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
 def external_georeferencing(imagesDir, classes, masksDir, mList, cList, extension):
     """
     Find the external georeferencing and copy it to the directory with
@@ -51,12 +51,159 @@
 #% required: no
 #% answer: 255
 #%end
+#%option
+#% key: nprocs
+#% type: integer
+#% description: Number of images processed in parallel (in-memory mode only)
+#% required: no
+#% answer: 1
+#%end
+#%flag
+#% key: m
+#% description: Compute histograms and matching in memory instead of a SQLite database
+#%end
 
 
 import sys
 import os
 import sqlite3
+from multiprocessing import Pool
+
+import numpy as np
+
 import grass.script as grass
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
+CNULL = -2147483648  # null value for CELL maps
+BLOCK_ROWS = 256  # number of rows read at once
+
+
+def set_raster_region(image):
+    """Set the region of the current process to the given raster"""
+    region = Region()
+    region.from_rast(image)
+    region.set_raster_region()
+    return region
+
+
+def grey_values(rows, mtype):
+    """Return the grey values of a block of rows and the mask of valid cells
+
+    Floating point maps are rounded to integers as r.stats -i does.
+    """
+    block = np.asarray(rows)
+    if mtype == "CELL":
+        return block, block != CNULL
+    valid = ~np.isnan(block)
+    return np.rint(np.where(valid, block, 0)).astype(np.int64), valid
+
+
+def image_histogram(args):
+    """Compute the histogram of an image streaming over blocks of rows
+
+    Values outside of the range from 0 to max_value are ignored.
+    """
+    image, max_value = args
+    region = set_raster_region(image)
+    histogram = np.zeros(max_value, dtype=np.int64)
+    with RasterRow(image) as rast:
+        for start in range(0, region.rows, BLOCK_ROWS):
+            rows = [rast[r] for r in range(start, min(start + BLOCK_ROWS, region.rows))]
+            values, valid = grey_values(rows, rast.mtype)
+            values = values[valid & (values >= 0) & (values < max_value)]
+            histogram += np.bincount(values, minlength=max_value)
+    return histogram
+
+
+def matching_tables(histograms):
+    """Build the lookup tables matching each histogram to the average one
+
+    The cumulative distribution functions are computed as in the database
+    mode: the CDF of each image is rounded to six decimal places and each
+    grey value gets the value of the average histogram with the closest
+    CDF, the lowest one in case of ties.
+    """
+    histograms = np.asarray(histograms)
+    n_images = histograms.shape[0]
+    average = (histograms.sum(axis=0) / n_images).astype(np.int64)
+    pixel_tot = average.sum()
+    average_cumul = np.cumsum(average)
+    # only grey values with non zero cumulative histogram are candidates
+    candidates = np.flatnonzero(average_cumul)
+    if not len(candidates) or not pixel_tot:
+        return [np.zeros(histograms.shape[1], dtype=np.int64)] * n_images
+    average_cdf = average_cumul[candidates] / float(pixel_tot)
+
+    tables = []
+    for histogram in histograms:
+        cumul = np.cumsum(histogram)
+        if cumul[-1]:
+            cdf = np.round(cumul / float(cumul[-1]), 6)
+        else:
+            cdf = np.zeros(len(cumul))
+        upper = np.clip(np.searchsorted(average_cdf, cdf), 0, len(average_cdf) - 1)
+        lower = np.clip(upper - 1, 0, len(average_cdf) - 1)
+        closest = np.where(
+            np.abs(cdf - average_cdf[lower]) <= np.abs(cdf - average_cdf[upper]),
+            average_cdf[lower],
+            average_cdf[upper],
+        )
+        # first grey value with the closest CDF
+        tables.append(candidates[np.searchsorted(average_cdf, closest)])
+    return tables
+
+
+def apply_table(args):
+    """Write the matched image applying the lookup table in one pass"""
+    image, output, table, overwrite = args
+    region = set_raster_region(image)
+    max_value = len(table)
+    with RasterRow(image) as rast, RasterRow(
+        output, mode="w", mtype="CELL", overwrite=overwrite
+    ) as out:
+        newrow = Buffer((region.cols,), mtype="CELL")
+        for row in rast:
+            values, valid = grey_values(row, rast.mtype)
+            valid &= (values >= 0) & (values < max_value)
+            newrow[:] = CNULL
+            newrow[valid] = table[values[valid]]
+            out.put_row(newrow)
+    return output
+
+
+def match_in_memory(images, suffix, max_value, nprocs):
+    """Histogram matching without the SQLite database
+
+    Return the names of the output maps.
+    """
+    pool = Pool(nprocs) if nprocs > 1 else None
+    mapper = pool.map if pool else map
+    try:
+        grass.message(_("Calculating Cumulative Distribution Functions ..."))
+        histograms = list(mapper(image_histogram, [(i, max_value) for i in images]))
+        tables = matching_tables(histograms)
+
+        grass.message(_("Reclassifying bands based on average histogram..."))
+        jobs = []
+        for i, table in zip(images, tables):
+            outname = "%s.%s" % (i.split("@")[0], suffix)
+            result = grass.core.find_file(outname, element="cell")
+            if result["fullname"] and not grass.overwrite():
+                grass.warning(
+                    _("Raster map %s already exists and will not be overwritten" % i)
+                )
+                continue
+            jobs.append((i, outname, table, grass.overwrite()))
+        output_names = list(mapper(apply_table, jobs))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    for outname in output_names:
+        grass.raster_history(outname)
+    return output_names
 
 
 def main():
@@ -76,6 +223,18 @@ def main():
     table_ave = "t%s_average" % suffix
     # increment of one the maximum value for a correct use of range function
     max_value = int(options["max"]) + 1
+
+    if flags["m"]:
+        output_names = match_in_memory(
+            images, suffix, max_value, int(options["nprocs"])
+        )
+        if mosaic:
+            grass.message(_("Processing mosaic <%s>..." % mosaic))
+            grass.use_temp_region()
+            grass.run_command("g.region", raster=all_images)
+            grass.run_command("r.patch", input=output_names, output=mosaic)
+        return 0
+
     # if the db path is the default one
     if dbopt.find("$GISDBASE/$LOCATION_NAME/$MAPSET") == 0:
         dbopt_split = dbopt.split("/")[-1]
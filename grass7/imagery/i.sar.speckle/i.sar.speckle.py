@@ -19,6 +19,15 @@
 # Lee, J. S. (1986). Speckle suppression and analysis for synthetic aperture
 # radar images. Optical engineering, 25(5), 255636.
 #
+# Lopes, A., Touzi, R., & Nezry, E. (1990). Adaptive speckle filters and
+# scene heterogeneity. IEEE Transactions on Geoscience and Remote Sensing,
+# 28(6), 992-1000.
+#
+# Frost, V. S., Stiles, J. A., Shanmugan, K. S., & Holtzman, J. C. (1982).
+# A model for radar images and its application to adaptive digital
+# filtering of multiplicative noise. IEEE Transactions on Pattern Analysis
+# and Machine Intelligence, (2), 157-166.
+#
 #############################################################################
 
 #%Module
@@ -42,7 +51,7 @@
 #%option
 #% key: method
 #% description: Method for speckle removal
-#% options: lee
+#% options: lee,enhanced_lee,frost
 #% answer: lee
 #% required: yes
 #%end
@@ -53,53 +62,210 @@
 #% answer: 11
 #% required: yes
 #%end
+#%option
+#% key: looks
+#% type: double
+#% description: Equivalent number of looks (enhanced_lee method)
+#% answer: 1
+#% required: no
+#%end
+#%option
+#% key: damping
+#% type: double
+#% description: Damping factor (enhanced_lee and frost methods)
+#% answer: 1
+#% required: no
+#%end
+#%option
+#% key: nprocs
+#% type: integer
+#% description: Number of processes to run in parallel
+#% answer: 1
+#% required: no
+#%end
+
 
+from multiprocessing import Pool
+
+import numpy as np
 
-import os
 import grass.script as grass
+from grass.pygrass.gis.region import Region
 from grass.pygrass.modules.shortcuts import general as g
-from grass.pygrass.modules.shortcuts import raster as r
-
-
-def lee_filter(img, size, img_out):
-
-    pid = str(os.getpid())
-    img_mean = "tmp%s_img_mean" % pid
-    img_sqr = "tmp%s_img_sqr" % pid
-    img_sqr_mean = "tmp%s_img_sqr_mean" % pid
-    img_variance = "tmp%s_img_variance" % pid
-    img_weights = "tmp%s_img_weights" % pid
-
-    # Local mean
-    r.neighbors(input=img, size=size, method="average", output=img_mean)
-    # Local square mean
-    r.mapcalc("%s = %s^2" % (img_sqr, img))
-    r.neighbors(input=img_sqr, size=size, method="average", output=img_sqr_mean)
-    # Local variance
-    r.mapcalc("%s = %s - (%s^2)" % (img_variance, img_sqr_mean, img_mean))
-    # Overall variance
-    return_univar = grass.read_command("r.univar", map=img, flags="ge")
-    univar_stats = grass.parse_key_val(return_univar)
-    overall_variance = univar_stats["variance"]
-    # Weights
-    r.mapcalc(
-        "%s = %s / (%s + %s)"
-        % (img_weights, img_variance, img_variance, overall_variance)
-    )
-    # Output
-    r.mapcalc(
-        "%s = %s + %s * (%s - %s)" % (img_out, img_mean, img_weights, img, img_mean)
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
+CNULL = -2147483648  # null value for CELL maps
+BLOCK_ROWS = 256  # number of output rows computed per tile
+
+
+def read_rows(img, start, end):
+    """Read rows from start to end (excluded) as a float array, NaN for nulls"""
+    with RasterRow(img) as rast:
+        rows = np.array([rast[row] for row in range(start, end)], dtype=np.float64)
+        if rast.mtype == "CELL":
+            rows[rows == CNULL] = np.nan
+    return rows
+
+
+def tile_statistics(args):
+    """Return number of cells, mean and sum of squared deviations of a tile"""
+    img, start, end = args
+    values = read_rows(img, start, end)
+    values = values[~np.isnan(values)]
+    if not values.size:
+        return 0, 0.0, 0.0
+    mean = values.mean()
+    return values.size, mean, ((values - mean) ** 2).sum()
+
+
+def overall_variance(img, tiles, mapper):
+    """Compute the variance of the image in a streaming pre-pass
+
+    The statistics of the tiles are combined with the pairwise formula of
+    Chan et al., the result equals the population variance of r.univar.
+    """
+    count, mean, m2 = 0, 0.0, 0.0
+    for n, tile_mean, tile_m2 in mapper(
+        tile_statistics, [(img, start, end) for start, end in tiles]
+    ):
+        if not n:
+            continue
+        total = count + n
+        delta = tile_mean - mean
+        mean += delta * n / total
+        m2 += tile_m2 + delta**2 * count * n / total
+        count = total
+    if not count:
+        grass.fatal(_("Input image <%s> contains only null cells") % img)
+    return m2 / count
+
+
+def window_sums(values, size):
+    """Sum values over size x size moving windows using a summed-area table
+
+    Cells outside of the array are treated as zero.
+    """
+    half = size // 2
+    padded = np.pad(values, ((half + 1, half), (half + 1, half)))
+    sat = padded.cumsum(axis=0).cumsum(axis=1)
+    return (
+        sat[size:, size:]
+        - sat[:-size, size:]
+        - sat[size:, :-size]
+        + sat[:-size, :-size]
     )
 
-    # Cleanup
-    grass.message(_("Cleaning up intermediate files..."))
-    try:
-        grass.run_command(
-            "g.remove", flags="f", quiet=False, type="raster", pattern="tmp*"
-        )
-    except:
-        """ """
 
+def local_statistics(values, size):
+    """Compute local mean and variance ignoring null cells as r.neighbors does"""
+    valid = ~np.isnan(values)
+    data = np.where(valid, values, 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        count = window_sums(valid.astype(np.float64), size)
+        mean = window_sums(data, size) / count
+        sqr_mean = window_sums(data**2, size) / count
+    return mean, np.maximum(sqr_mean - mean**2, 0)
+
+
+def lee(values, size, variance, looks, damping):
+    """Lee filter (Lee 1986) using the overall image variance as noise"""
+    mean, local_var = local_statistics(values, size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weights = local_var / (local_var + variance)
+    return mean + weights * (values - mean)
+
+
+def enhanced_lee(values, size, variance, looks, damping):
+    """Enhanced Lee filter (Lopes et al. 1990)"""
+    mean, local_var = local_statistics(values, size)
+    cu = 1.0 / np.sqrt(looks)
+    cmax = np.sqrt(1 + 2.0 / looks)
+    with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+        ci = np.sqrt(local_var) / mean
+        weights = np.exp(-damping * (ci - cu) / (cmax - ci))
+        filtered = mean * weights + values * (1 - weights)
+    filtered = np.where(ci <= cu, mean, filtered)
+    filtered = np.where(ci >= cmax, values, filtered)
+    # homogeneous areas with zero mean have no defined coefficient of variation
+    return np.where(np.isnan(ci), mean, filtered)
+
+
+def frost(values, size, variance, looks, damping):
+    """Frost filter (Frost et al. 1982) with exponentially damped weights"""
+    mean, local_var = local_statistics(values, size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        factor = damping * local_var / mean**2
+    half = size // 2
+    padded = np.pad(values, half, constant_values=np.nan)
+    rows, cols = values.shape
+    weighted = np.zeros(values.shape)
+    weights = np.zeros(values.shape)
+    for drow in range(-half, half + 1):
+        for dcol in range(-half, half + 1):
+            shifted = padded[
+                half + drow : half + drow + rows, half + dcol : half + dcol + cols
+            ]
+            valid = ~np.isnan(shifted)
+            with np.errstate(invalid="ignore", over="ignore"):
+                weight = np.exp(-factor * np.hypot(drow, dcol))
+            weight = np.where(valid, weight, 0)
+            weighted += weight * np.where(valid, shifted, 0)
+            weights += weight
+    with np.errstate(invalid="ignore", divide="ignore"):
+        filtered = weighted / weights
+    # homogeneous areas with zero mean have no defined coefficient of variation
+    return np.where(np.isnan(factor), mean, filtered)
+
+
+FILTERS = {"lee": lee, "enhanced_lee": enhanced_lee, "frost": frost}
+
+
+def filter_tile(args):
+    """Filter the rows from start to end reading a halo of size // 2 rows"""
+    img, method, size, start, end, nrows, variance, looks, damping = args
+    half = size // 2
+    first = max(0, start - half)
+    values = read_rows(img, first, min(nrows, end + half))
+    filtered = FILTERS[method](values, size, variance, looks, damping)
+    filtered[np.isnan(values)] = np.nan
+    return filtered[start - first : end - first]
+
+
+def speckle_filter(img, method, size, img_out, looks=1, damping=1, nprocs=1):
+    """Apply a speckle filter in one pass over tiles of rows
+
+    Local statistics come from summed-area tables computed on each tile
+    together with a halo of half the neighborhood size, tiles are
+    processed in parallel and written in order.
+    """
+    region = Region()
+    nrows, ncols = region.rows, region.cols
+    tiles = [
+        (start, min(start + BLOCK_ROWS, nrows)) for start in range(0, nrows, BLOCK_ROWS)
+    ]
+    pool = Pool(nprocs) if nprocs > 1 else None
+    try:
+        variance = 0
+        if method == "lee":
+            variance = overall_variance(img, tiles, pool.imap if pool else map)
+        jobs = [
+            (img, method, size, start, end, nrows, variance, looks, damping)
+            for start, end in tiles
+        ]
+        with RasterRow(
+            img_out, mode="w", mtype="DCELL", overwrite=grass.overwrite()
+        ) as out:
+            newrow = Buffer((ncols,), mtype="DCELL")
+            for block in (pool.imap if pool else map)(filter_tile, jobs):
+                for row in block:
+                    newrow[:] = row
+                    out.put_row(newrow)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    grass.raster_history(img_out)
     return img_out
 
 
@@ -108,7 +274,10 @@ def main():
     method = options["method"]  # algorithm for speckle removal
     img = options["input"]  # name of input image
     img_out = options["output"]  # name of output image
-    size = options["size"]  # size of neighborhood
+    size = int(options["size"])  # size of neighborhood
+    looks = float(options["looks"])  # equivalent number of looks
+    damping = float(options["damping"])  # damping factor
+    nprocs = int(options["nprocs"])
 
     out = grass.core.find_file(img_out)
 
@@ -117,9 +286,12 @@ def main():
             _("Output map name already exists. " "Delete it or use overwrite flag")
         )
 
-    if method == "lee":
-        g.message(_("Applying Lee Filter"))
-        img_out = lee_filter(img, size, img_out)
+    if size % 2 == 0:
+        grass.fatal(_("The size of the neighborhood must be odd"))
+
+    if method in FILTERS:
+        g.message(_("Applying %s filter") % method)
+        img_out = speckle_filter(img, method, size, img_out, looks, damping, nprocs)
         g.message(_("Done."))
 
     else:
@@ -61,6 +61,14 @@
 #% description: Cache size for raster rows
 #% answer: 300
 #%end
+#%option
+#% key: nprocs
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Number of bands imported in parallel
+#% answer: 1
+#%end
 #%option G_OPT_F_OUTPUT
 #% key: register_output
 #% description: Name for output file to use with t.register
@@ -119,6 +127,7 @@ import glob
 import shutil
 import io
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from zipfile import ZipFile
 
 import grass.script as gs
@@ -129,6 +138,9 @@ class SentinelImporter(object):
     def __init__(self, input_dir, unzip_dir):
         # list of directories to cleanup
         self._dir_list = []
+        # projection check and EPSG code per SAFE directory
+        self._projection_cache = {}
+        self._epsg_cache = {}
 
         # check if input dir exists
         self.input_dir = input_dir
@@ -234,7 +246,7 @@ class SentinelImporter(object):
 
         return files
 
-    def import_products(self, reproject=False, link=False, override=False):
+    def _import_args(self, reproject=False, link=False, override=False):
         args = {}
         if link:
             module = "r.external"
@@ -255,28 +267,87 @@ class SentinelImporter(object):
                     else:
                         args["flags"] = "r"
 
+        return module, args
+
+    def _check_products_projection(self, reproject=False, link=False, override=False):
+        if override or not (link or (not link and not reproject)):
+            return
         for f in self.files:
-            if not override and (link or (not link and not reproject)):
-                if not self._check_projection(f):
-                    gs.fatal(
-                        _(
-                            "Projection of dataset does not appear to match current location. "
-                            "Force reprojecting dataset by -r flag."
-                        )
+            if not self._check_projection(f):
+                gs.fatal(
+                    _(
+                        "Projection of dataset does not appear to match current location. "
+                        "Force reprojecting dataset by -r flag."
                     )
+                )
 
+    def import_products(self, reproject=False, link=False, override=False):
+        module, args = self._import_args(reproject, link, override)
+        self._check_products_projection(reproject, link, override)
+
+        for f in self.files:
             self._import_file(f, module, args)
 
+    def process_products(
+        self, reproject=False, link=False, override=False, cloud_masks=False, nprocs=1
+    ):
+        """Import bands in parallel and finish each scene as soon as possible
+
+        Each band of each scene is imported by a pool of nprocs workers,
+        each import using the given memory limit. Once all bands of a scene
+        are imported, its metadata are written and its cloud mask imported
+        while the bands of the other scenes are still being imported.
+        """
+        module, args = self._import_args(reproject, link, override)
+        self._check_products_projection(reproject, link, override)
+
+        scene_files = {}
+        for f in self.files:
+            scene_files.setdefault(self._ip_from_path(f), []).append(f)
+        ip_meta = self._read_metadata()
+        scene_masks = {}
+        if cloud_masks:
+            for f in self._filter("MSK_CLOUDS_B00.gml"):
+                scene_masks.setdefault(self._ip_from_path(f), []).append(f)
+
+        def finish_scene(ip):
+            self.write_metadata(scene_files[ip], ip_meta)
+            for f in scene_masks.get(ip, []):
+                self._import_cloud_mask(f, override)
+
+        with ThreadPoolExecutor(nprocs) as band_pool, ThreadPoolExecutor(
+            1
+        ) as scene_pool:
+            remaining = {ip: len(files) for ip, files in scene_files.items()}
+            futures = {
+                band_pool.submit(self._import_file, f, module, args): ip
+                for ip, files in scene_files.items()
+                for f in files
+            }
+            scenes = []
+            for future in as_completed(futures):
+                future.result()
+                ip = futures[future]
+                remaining[ip] -= 1
+                if not remaining[ip]:
+                    scenes.append(scene_pool.submit(finish_scene, ip))
+            for future in scenes:
+                future.result()
+
     def _check_projection(self, filename):
-        try:
-            with open(os.devnull) as null:
-                gs.run_command(
-                    "r.in.gdal", flags="j", input=filename, quiet=True, stderr=null
-                )
-        except CalledModuleError as e:
-            return False
+        # all bands of a SAFE share the same projection
+        ip = self._ip_from_path(filename)
+        if ip not in self._projection_cache:
+            try:
+                with open(os.devnull) as null:
+                    gs.run_command(
+                        "r.in.gdal", flags="j", input=filename, quiet=True, stderr=null
+                    )
+                self._projection_cache[ip] = True
+            except CalledModuleError as e:
+                self._projection_cache[ip] = False
 
-        return True
+        return self._projection_cache[ip]
 
     def _raster_resolution(self, filename):
         try:
@@ -292,6 +363,9 @@ class SentinelImporter(object):
         return ret
 
     def _raster_epsg(self, filename):
+        ip = self._ip_from_path(filename)
+        if ip in self._epsg_cache:
+            return self._epsg_cache[ip]
         try:
             from osgeo import gdal, osr
         except ImportError as e:
@@ -303,6 +377,7 @@ class SentinelImporter(object):
 
         ret = srs.GetAuthorityCode(None)
         dsn = None
+        self._epsg_cache[ip] = ret
 
         return ret
 
@@ -313,18 +388,22 @@ class SentinelImporter(object):
     def _import_file(self, filename, module, args):
         mapname = self._map_name(filename)
         gs.message(_("Processing <{}>...").format(mapname))
+        # arguments are shared by parallel imports
+        args = dict(args)
         if module == "r.import":
             args["resolution_value"] = self._raster_resolution(filename)
         try:
             gs.run_command(module, input=filename, output=mapname, **args)
             if gs.raster_info(mapname)["datatype"] in ("FCELL", "DCELL"):
                 gs.message("Rounding to integer after reprojection")
-                gs.use_temp_region()
-                gs.run_command("g.region", raster=mapname)
+                # region passed by environment, safe for parallel imports
+                env = os.environ.copy()
+                env["GRASS_REGION"] = gs.region_env(raster=mapname)
                 gs.run_command(
                     "r.mapcalc",
                     quiet=True,
                     expression="tmp_%s = round(%s)" % (mapname, mapname),
+                    env=env,
                 )
                 gs.run_command(
                     "g.rename",
@@ -332,38 +411,40 @@ class SentinelImporter(object):
                     overwrite=True,
                     raster="tmp_%s,%s" % (mapname, mapname),
                 )
-                gs.del_temp_region()
             gs.raster_history(mapname)
         except CalledModuleError as e:
             pass  # error already printed
 
     def import_cloud_masks(self, override):
-        from osgeo import ogr
-
         files = self._filter("MSK_CLOUDS_B00.gml")
 
         for f in files:
-            safe_dir = os.path.dirname(f).split(os.path.sep)[-4]
-            items = safe_dir.split("_")
-            map_name = "_".join([items[5], items[2], "MSK", "CLOUDS"])
-            # check if any OGR layer
-            dsn = ogr.Open(f)
-            layer_count = dsn.GetLayerCount()
-            dsn.Destroy()
-            if layer_count < 1:
-                gs.info("No clouds layer found in <{}>. Import skipped".format(f))
-                continue
-            try:
-                gs.run_command(
-                    "v.import",
-                    input=f,
-                    flags="o" if override else None,  # same SRS as data
-                    output=map_name,
-                    quiet=True,
-                )
-                gs.vector_history(map_name)
-            except CalledModuleError as e:
-                pass  # error already printed
+            self._import_cloud_mask(f, override)
+
+    def _import_cloud_mask(self, f, override):
+        from osgeo import ogr
+
+        safe_dir = os.path.dirname(f).split(os.path.sep)[-4]
+        items = safe_dir.split("_")
+        map_name = "_".join([items[5], items[2], "MSK", "CLOUDS"])
+        # check if any OGR layer
+        dsn = ogr.Open(f)
+        layer_count = dsn.GetLayerCount()
+        dsn.Destroy()
+        if layer_count < 1:
+            gs.info("No clouds layer found in <{}>. Import skipped".format(f))
+            return
+        try:
+            gs.run_command(
+                "v.import",
+                input=f,
+                flags="o" if override else None,  # same SRS as data
+                output=map_name,
+                quiet=True,
+            )
+            gs.vector_history(map_name)
+        except CalledModuleError as e:
+            pass  # error already printed
 
     def print_products(self):
         for f in self.files:
@@ -483,8 +564,7 @@ class SentinelImporter(object):
     def _ip_from_path(path):
         return os.path.basename(path[: path.find(".SAFE")])
 
-    def write_metadata(self):
-        gs.message(_("Writing metadata to maps..."))
+    def _read_metadata(self):
         ip_meta = {}
         for mtd_file in self._filter("MTD_TL.xml"):
             ip = self._ip_from_path(mtd_file)
@@ -493,7 +573,14 @@ class SentinelImporter(object):
         if not ip_meta:
             gs.warning(_("Unable to determine timestamps. No metadata file found"))
 
-        for img_file in self.files:
+        return ip_meta
+
+    def write_metadata(self, files=None, ip_meta=None):
+        if ip_meta is None:
+            gs.message(_("Writing metadata to maps..."))
+            ip_meta = self._read_metadata()
+
+        for img_file in files or self.files:
             map_name = self._map_name(img_file)
             ip = self._ip_from_path(img_file)
             meta = ip_meta[ip]
@@ -614,12 +701,19 @@ def main():
         importer.print_products()
         return 0
 
-    importer.import_products(flags["r"], flags["l"], flags["o"])
-    importer.write_metadata()
+    nprocs = int(options["nprocs"])
+    if nprocs > 1:
+        # import bands in parallel, finishing each scene as soon as possible
+        importer.process_products(
+            flags["r"], flags["l"], flags["o"], flags["c"], nprocs
+        )
+    else:
+        importer.import_products(flags["r"], flags["l"], flags["o"])
+        importer.write_metadata()
 
-    if flags["c"]:
-        # import cloud mask if requested
-        importer.import_cloud_masks(flags["o"])
+        if flags["c"]:
+            # import cloud mask if requested
+            importer.import_cloud_masks(flags["o"])
 
     if options["register_output"]:
         # create t.register file if requested
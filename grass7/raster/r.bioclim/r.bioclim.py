@@ -78,18 +78,140 @@
 #% description: Number of parallel processes to launch
 #%End
 
-import sys
 import os
-import string
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+
 import grass.script as grass
-import atexit
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
 
+CNULL = -2147483648  # null value for CELL maps
+BLOCK_CELLS = 2 * 1024 * 1024  # number of cell values of all input maps per block
 
-def cleanup():
-    if tmp_pattern:
-        grass.run_command(
-            "g.remove", flags="f", type="raster", pattern=tmp_pattern, quiet=True
+# indices written as floating point maps, the others are rounded
+DCELL_BIO = (12, 13, 14, 16, 17)
+
+
+def read_series(names, start, end):
+    """Read rows from start to end (excluded) of a series of raster maps
+
+    Returns an array of (maps, rows, cols) with NaN for null cells.
+    """
+    series = []
+    for name in names:
+        with RasterRow(name) as rast:
+            rows = np.array([rast[row] for row in range(start, end)], dtype=np.float64)
+            if rast.mtype == "CELL":
+                rows[rows == CNULL] = np.nan
+        series.append(rows)
+    return np.array(series)
+
+
+def round_half_up(values):
+    """Round as the round() function of r.mapcalc, halves away from zero"""
+    return np.where(values >= 0, np.floor(values + 0.5), -np.floor(-values + 0.5))
+
+
+def quarter_values(series, starts, method):
+    """Aggregate a monthly series over the quarters beginning at starts
+
+    Quarters wrap around the end of the year. Null months are ignored as in
+    r.series, quarters without values are null.
+    """
+    windows = series[(starts[:, None] + np.arange(3)) % 12]
+    count = np.sum(~np.isnan(windows), axis=1)
+    total = np.nansum(windows, axis=1)
+    if method == "average":
+        total = total / count
+    total[count == 0] = np.nan
+    return total
+
+
+def extreme_index(values, method):
+    """Index of the maximum or minimum of values along the first axis, as the
+    max_raster and min_raster methods of r.series
+
+    Returns the index and a mask of the cells without values.
+    """
+    nodata = np.all(np.isnan(values), axis=0)
+    if method == "max":
+        index = np.argmax(np.where(np.isnan(values), -np.inf, values), axis=0)
+    else:
+        index = np.argmin(np.where(np.isnan(values), np.inf, values), axis=0)
+    return index, nodata
+
+
+def take_index(values, index, nodata):
+    """Pick values along the first axis at index, null where nodata"""
+    result = np.take_along_axis(values, index[np.newaxis], axis=0)[0]
+    result[nodata] = np.nan
+    return result
+
+
+def bioclim_block(args):
+    """Compute the bioclimatic indices for the rows from start to end (excluded)
+
+    Returns a dictionary with the index number as key.
+    """
+    tmin, tmax, tavg, prec, start, end, quartals, tinscale, toutscale = args
+    starts = np.arange(quartals) * (12 // quartals)
+    bio = {}
+    with warnings.catch_warnings(), np.errstate(invalid="ignore", divide="ignore"):
+        # all-null cells give NaN as the r.series methods do
+        warnings.simplefilter("ignore", RuntimeWarning)
+
+        tminv = read_series(tmin, start, end)
+        tmaxv = read_series(tmax, start, end)
+        if tavg:
+            tavgv = read_series(tavg, start, end)
+        else:
+            tavgv = (tmaxv + tminv) / 2.0
+
+        bio[1] = round_half_up(float(toutscale) * np.nanmean(tavgv, axis=0) / tinscale)
+        bio[2] = round_half_up(
+            float(toutscale) * np.nanmean(tmaxv - tminv, axis=0) / tinscale
+        )
+        bio[4] = round_half_up(100.0 * np.nanstd(tavgv, axis=0) / tinscale * toutscale)
+        bio[5] = round_half_up(float(toutscale) * np.nanmax(tmaxv, axis=0) / tinscale)
+        bio[6] = round_half_up(float(toutscale) * np.nanmin(tminv, axis=0) / tinscale)
+        bio[7] = bio[5] - bio[6]
+        bio[3] = round_half_up(100.0 * bio[2] / bio[7])
+        bio[3][bio[7] == 0] = np.nan
+
+        tavgq = quarter_values(tavgv, starts, "average")
+        bio[10] = round_half_up(float(toutscale) * np.nanmax(tavgq, axis=0) / tinscale)
+        bio[11] = round_half_up(float(toutscale) * np.nanmin(tavgq, axis=0) / tinscale)
+        if not prec:
+            return bio
+
+        precv = read_series(prec, start, end)
+        precq = quarter_values(precv, starts, "sum")
+        wettest = extreme_index(precq, "max")
+        driest = extreme_index(precq, "min")
+        warmest = extreme_index(tavgq, "max")
+        coldest = extreme_index(tavgq, "min")
+
+        bio[8] = round_half_up(take_index(tavgq, *wettest) * toutscale / tinscale)
+        bio[9] = round_half_up(take_index(tavgq, *driest) * toutscale / tinscale)
+        bio[12] = np.nansum(precv, axis=0)
+        bio[12][np.all(np.isnan(precv), axis=0)] = np.nan
+        bio[13] = np.nanmax(precv, axis=0)
+        bio[14] = np.nanmin(precv, axis=0)
+        precavg = np.nanmean(precv, axis=0)
+        bio[15] = np.where(
+            precavg == 0,
+            0,
+            round_half_up(100.0 * np.nanstd(precv, axis=0) / precavg),
         )
+        bio[16] = np.nanmax(precq, axis=0)
+        bio[17] = np.nanmin(precq, axis=0)
+        bio[18] = round_half_up(take_index(precq, *warmest))
+        bio[19] = round_half_up(take_index(precq, *coldest))
+    return bio
 
 
 def main():
@@ -103,10 +225,6 @@ def main():
     workers = int(options["workers"])
     quartals = int(options["quartals"])
 
-    qstep = 12 / quartals
-
-    mapset = grass.gisenv()["MAPSET"]
-
     # count input maps
     if len(tmin.split(",")) != 12:
         grass.fatal(_("12 maps with minimum temperatures are required"))
@@ -125,672 +243,71 @@ def main():
     if toutscale <= 0:
         grass.fatal(_("Output temperature scale must be positive"))
 
-    pid = os.getpid()
-
-    # all temporary raster maps must follow this naming pattern
-    tmp_pattern = "%s.*.%d" % (outpre, pid)
-
     tminl = tmin.split(",")
     tmaxl = tmax.split(",")
+    tavgl = tavg.split(",") if tavg else None
+    precl = prec.split(",") if prec else None
 
-    ps = {}
-
-    if not tavg:
-        # calculate monthly averages from min and max
-        grass.message(_("Calculating monthly averages from min and max"))
-        e = "$ta = ($tmax + $tmin) / 2.0"
-        if workers > 1:
-            for i in range(0, 12, workers):
-                jend = 12 - i
-                if jend > workers:
-                    jend = workers
-
-                for j in range(jend):
-                    ta = "%s.tavg%02d.%d" % (outpre, (i + j + 1), pid)
-                    ps[j] = grass.mapcalc_start(
-                        e, ta=ta, tmax=tmaxl[i + j], tmin=tminl[i + j]
-                    )
-
-                for j in range(jend):
-                    ps[j].wait()
-        else:
-            for i in range(12):
-                ta = "%s.tavg%02d.%d" % (outpre, (i + 1), pid)
-                grass.mapcalc(e, ta=ta, tmax=tmaxl[i], tmin=tminl[i])
-
-        tavg = grass.read_command(
-            "g.list",
-            quiet=True,
-            type="raster",
-            pattern="%s.tavg??.%d" % (outpre, pid),
-            separator=",",
-            mapset=".",
-        )
-        tavg = tavg.strip("\n")
-
-    tavgl = tavg.split(",")
-
-    # BIO1 = Annual Mean Temperature
-    grass.message(_("BIO1 = Annual Mean Temperature ..."))
-    output = outpre + "bio01." + str(pid)
-    grass.run_command("r.series", input=tavg, output=output, method="average")
-    grass.mapcalc(
-        "$bio = round(double($oscale) * $input / $iscale)",
-        bio=outpre + "bio01",
-        oscale=toutscale,
-        input=output,
-        iscale=tinscale,
-    )
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio01",
-        description="BIOCLIM01: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio01", history=os.environ["CMDLINE"])
-    grass.run_command("g.remove", flags="f", type="raster", name=output, quiet=True)
-
-    # BIO2 = Mean Diurnal Range (Mean of monthly (max temp - min temp))
-    grass.message(_("BIO2 = Mean Diurnal Range ..."))
-    e = "$tr = $tmax - $tmin"
-    if workers > 1:
-        for i in range(0, 12, workers):
-            jend = 12 - i
-            if jend > workers:
-                jend = workers
-
-            for j in range(jend):
-                tr = "%s.tr%02d.%d" % (outpre, (i + j + 1), pid)
-                ps[j] = grass.mapcalc_start(
-                    e, tr=tr, tmax=tmaxl[i + j], tmin=tminl[i + j]
-                )
-
-            for j in range(jend):
-                ps[j].wait()
-
+    if prec:
+        indices = list(range(1, 20))
     else:
-        for i in range(12):
-            tr = "%s.tr%02d.%d" % (outpre, (i + 1), pid)
-            grass.mapcalc(e, tr=tr, tmax=tmaxl[i], tmin=tminl[i])
-
-    tr = grass.read_command(
-        "g.list",
-        quiet=True,
-        type="raster",
-        pattern="%s.tr??.%d" % (outpre, pid),
-        separator=",",
-        mapset=".",
-    )
-
-    tr = tr.strip("\n")
-
-    output = outpre + "bio02." + str(pid)
-    grass.run_command("r.series", input=tr, output=output, method="average")
-    grass.mapcalc(
-        "$bio = round(double($oscale) * $input / $iscale)",
-        bio=outpre + "bio02",
-        oscale=toutscale,
-        input=output,
-        iscale=tinscale,
-    )
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio02",
-        description="BIOCLIM02: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio02", history=os.environ["CMDLINE"])
-    grass.run_command("g.remove", flags="f", type="raster", name=output, quiet=True)
-    grass.run_command(
-        "g.remove",
-        flags="f",
-        type="raster",
-        pattern="%s.tr??.%d" % (outpre, pid),
-        quiet=True,
-    )
-
-    # BIO4 = Temperature Seasonality (standard deviation * 100)
-    grass.message(_("BIO4 = Temperature Seasonality ..."))
-    output = outpre + "bio04." + str(pid)
-    grass.run_command("r.series", input=tavg, output=output, method="stddev")
-    grass.mapcalc(
-        "$bio = round(100.0 * $biotmp / $iscale * $oscale)",
-        bio=outpre + "bio04",
-        biotmp=output,
-        iscale=tinscale,
-        oscale=toutscale,
-    )
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio04",
-        description="BIOCLIM04: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio04", history=os.environ["CMDLINE"])
-    grass.run_command("g.remove", flags="f", type="raster", name=output, quiet=True)
-
-    # BIO5 = Max Temperature of Warmest Month
-    grass.message(_("BIO5 = Max Temperature of Warmest Month ..."))
-    output = outpre + "bio05." + str(pid)
-    grass.run_command("r.series", input=tmax, output=output, method="maximum")
-    grass.mapcalc(
-        "$bio = round(double($oscale) * $biotmp / $iscale)",
-        bio=outpre + "bio05",
-        oscale=toutscale,
-        iscale=tinscale,
-        biotmp=output,
-    )
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio05",
-        description="BIOCLIM05: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio05", history=os.environ["CMDLINE"])
-    grass.run_command("g.remove", flags="f", type="raster", name=output, quiet=True)
-
-    # BIO6 = Min Temperature of Coldest Month
-    grass.message(_("BIO6 = Min Temperature of Coldest Month ..."))
-    output = outpre + "bio06." + str(pid)
-    grass.run_command("r.series", input=tmin, output=output, method="minimum")
-    grass.mapcalc(
-        "$bio = round(double($oscale) * $biotmp / $iscale)",
-        bio=outpre + "bio06",
-        oscale=toutscale,
-        biotmp=output,
-        iscale=tinscale,
-    )
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio06",
-        description="BIOCLIM06: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio06", history=os.environ["CMDLINE"])
-    grass.run_command("g.remove", flags="f", type="raster", name=output, quiet=True)
-
-    # BIO7 = Temperature Annual Range (BIO5-BIO6)
-    grass.message(_("BIO7 = Temperature Annual Range ..."))
-    grass.mapcalc(
-        "$bio = $bio5 - $bio6",
-        bio=outpre + "bio07",
-        bio5=outpre + "bio05",
-        bio6=outpre + "bio06",
-    )
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio07",
-        description="BIOCLIM07: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio07", history=os.environ["CMDLINE"])
-
-    # BIO3 = Isothermality (BIO2/BIO7) (* 100)
-    grass.message(_("BIO3 = Isothermality (BIO2/BIO7) ..."))
-    grass.mapcalc(
-        "$bio = round(100.0 * $bio2 / $bio7)",
-        bio=outpre + "bio03",
-        bio2=outpre + "bio02",
-        bio7=outpre + "bio07",
-    )
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio03",
-        description="BIOCLIM03: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio03", history=os.environ["CMDLINE"])
-
-    # mean of mean for each quarter year
-    grass.message(_("Mean temperature for each quarter year ..."))
-    for i in range(quartals):
-        tavgq = "%s.tavgq.%02d.%d" % (outpre, i, pid)
-
-        m1 = int(i * qstep)
-        m2 = m1 + 1
-        if m2 > 11:
-            m2 = m2 - 12
-        m3 = m1 + 2
-        if m3 > 11:
-            m3 = m3 - 12
-        grass.run_command(
-            "r.series",
-            input="%s,%s,%s" % (tavgl[m1], tavgl[m2], tavgl[m3]),
-            output=tavgq,
-            method="average",
-        )
-
-    # BIO10 = Mean Temperature of Warmest Quarter
-    # BIO11 = Mean Temperature of Coldest Quarter
-    grass.message(_("BIO10 = Mean Temperature of Warmest Quarter,"))
-    grass.message(_("BIO11 = Mean Temperature of Coldest Quarter ..."))
-
-    tavgq = grass.read_command(
-        "g.list",
-        quiet=True,
-        type="raster",
-        pattern="%s.tavgq.??.%d" % (outpre, pid),
-        separator=",",
-        mapset=".",
-    )
-
-    tavgq = tavgq.strip("\n")
-    bio10 = outpre + "bio10." + str(pid)
-    bio11 = outpre + "bio11." + str(pid)
-    grass.run_command(
-        "r.series",
-        input=tavgq,
-        output="%s,%s" % (bio10, bio11),
-        method="maximum,minimum",
-    )
-
-    grass.mapcalc(
-        "$bio = round(double($oscale) * $biotmp / $iscale)",
-        bio=outpre + "bio10",
-        oscale=toutscale,
-        biotmp=bio10,
-        iscale=tinscale,
-    )
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio10",
-        description="BIOCLIM10: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio10", history=os.environ["CMDLINE"])
-    grass.mapcalc(
-        "$bio = round(double($oscale) * $biotmp / $iscale)",
-        bio=outpre + "bio11",
-        oscale=toutscale,
-        biotmp=bio11,
-        iscale=tinscale,
-    )
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio11",
-        description="BIOCLIM11: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio11", history=os.environ["CMDLINE"])
-
-    grass.run_command(
-        "g.remove", flags="f", type="raster", name="%s,%s" % (bio10, bio11), quiet=True
-    )
-
-    if not prec:
-        grass.run_command(
-            "g.remove", flags="f", type="raster", pattern=tmp_pattern, quiet=True
+        indices = list(range(1, 8)) + [10, 11]
+    outputs = ["%sbio%02d" % (outpre, i) for i in indices]
+
+    region = Region()
+    nrows, ncols = region.rows, region.cols
+    nmaps = len(tminl) + len(tmaxl) + len(tavgl or []) + len(precl or [])
+    block_rows = max(1, BLOCK_CELLS // (ncols * nmaps))
+    jobs = [
+        (
+            tminl,
+            tmaxl,
+            tavgl,
+            precl,
+            start,
+            min(start + block_rows, nrows),
+            quartals,
+            tinscale,
+            toutscale,
         )
-        sys.exit(1)
-
-    precl = prec.split(",")
-
-    # sum for each quarter year
-    grass.message(_("Precipitation for each quarter year ..."))
-    for i in range(quartals):
-        precq = "%s.precq.%02d.%d" % (outpre, i + 1, pid)
-
-        m1 = int(i * qstep)
-        m2 = m1 + 1
-        if m2 > 11:
-            m2 = m2 - 12
-        m3 = m1 + 2
-        if m3 > 11:
-            m3 = m3 - 12
+        for start in range(0, nrows, block_rows)
+    ]
+
+    grass.message(_("Calculating bioclimatic indices ..."))
+    pool = Pool(workers) if workers > 1 else None
+    rasters = []
+    try:
+        for i, name in zip(indices, outputs):
+            mtype = "DCELL" if i in DCELL_BIO else "CELL"
+            rast = RasterRow(name, mode="w", mtype=mtype, overwrite=grass.overwrite())
+            rast.open()
+            rasters.append((i, rast, Buffer((ncols,), mtype=mtype)))
+        for done, bio in enumerate((pool.imap if pool else map)(bioclim_block, jobs)):
+            grass.percent(done, len(jobs), 1)
+            for i, rast, newrow in rasters:
+                values = bio[i]
+                if rast.mtype == "CELL":
+                    values = np.where(np.isnan(values), CNULL, values)
+                for row in values:
+                    newrow[:] = row
+                    rast.put_row(newrow)
+        grass.percent(1, 1, 1)
+    finally:
+        for i, rast, newrow in rasters:
+            rast.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+    for i, name in zip(indices, outputs):
         grass.run_command(
-            "r.series",
-            input="%s,%s,%s" % (precl[m1], precl[m2], precl[m3]),
-            output=precq,
-            method="sum",
-        )
-
-    precq = grass.read_command(
-        "g.list",
-        quiet=True,
-        type="raster",
-        pattern="%s.precq.??.%d" % (outpre, pid),
-        separator=",",
-        mapset=".",
-    )
-
-    precq = precq.strip("\n")
-
-    # warmest and coldest quarter
-    warmestq = "%s.warmestq.%d" % (outpre, pid)
-    coldestq = "%s.coldestq.%d" % (outpre, pid)
-    grass.run_command(
-        "r.series",
-        input=tavgq,
-        output="%s,%s" % (warmestq, coldestq),
-        method="max_raster,min_raster",
-    )
-
-    tavgql = tavgq.split(",")
-
-    # wettest and driest quarter
-    wettestq = "%s.wettestq.%d" % (outpre, pid)
-    driestq = "%s.driestq.%d" % (outpre, pid)
-    grass.run_command(
-        "r.series",
-        input=precq,
-        output="%s,%s" % (wettestq, driestq),
-        method="max_raster,min_raster",
-    )
-
-    # BIO8 = Mean Temperature of Wettest Quarter
-    grass.message(_("BIO8 = Mean Temperature of Wettest Quarter ..."))
-
-    if quartals == 4:
-        grass.mapcalc(
-            "$bio = round(if($wettestq == 0, $tavgq0, \
-                    if($wettestq == 1, $tavgq1, \
-                    if($wettestq == 2, $tavgq2, \
-                    if($wettestq == 3, $tavgq3, null())))) \
-                    * $oscale / $iscale)",
-            bio=outpre + "bio08",
-            wettestq=wettestq,
-            tavgq0=tavgql[0],
-            tavgq1=tavgql[1],
-            tavgq2=tavgql[2],
-            tavgq3=tavgql[3],
-            oscale=toutscale,
-            iscale=tinscale,
+            "r.support",
+            map=name,
+            description="BIOCLIM%02d: Generated by r.bioclim" % i,
+            history=os.environ["CMDLINE"],
         )
-    else:
-        # quartals == 12
-        grass.mapcalc(
-            "$bio = round(if($wettestq ==  0, $tavgq0, \
-                    if($wettestq ==  1, $tavgq1, \
-                    if($wettestq ==  2, $tavgq2, \
-                    if($wettestq ==  3, $tavgq3, \
-                    if($wettestq ==  4, $tavgq4, \
-                    if($wettestq ==  5, $tavgq5, \
-                    if($wettestq ==  6, $tavgq6, \
-                    if($wettestq ==  7, $tavgq7, \
-                    if($wettestq ==  8, $tavgq8, \
-                    if($wettestq ==  9, $tavgq9, \
-                    if($wettestq == 10, $tavgq10, \
-                    if($wettestq == 11, $tavgq11, null())))))))))))) \
-                    * $oscale / $iscale)",
-            bio=outpre + "bio08",
-            wettestq=wettestq,
-            tavgq0=tavgql[0],
-            tavgq1=tavgql[1],
-            tavgq2=tavgql[2],
-            tavgq3=tavgql[3],
-            tavgq4=tavgql[4],
-            tavgq5=tavgql[5],
-            tavgq6=tavgql[6],
-            tavgq7=tavgql[7],
-            tavgq8=tavgql[8],
-            tavgq9=tavgql[9],
-            tavgq10=tavgql[10],
-            tavgq11=tavgql[11],
-            oscale=toutscale,
-            iscale=tinscale,
-        )
-
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio08",
-        description="BIOCLIM08: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio08", history=os.environ["CMDLINE"])
-
-    # BIO9 = Mean Temperature of Driest Quarter
-    grass.message(_("BIO9 = Mean Temperature of Driest Quarter ..."))
-
-    if quartals == 4:
-        grass.mapcalc(
-            "$bio = round(if($driestq == 0, $tavgq0, \
-                    if($driestq == 1, $tavgq1, \
-                    if($driestq == 2, $tavgq2, \
-                    if($driestq == 3, $tavgq3, null())))) \
-                    * $oscale / $iscale)",
-            bio=outpre + "bio09",
-            driestq=driestq,
-            tavgq0=tavgql[0],
-            tavgq1=tavgql[1],
-            tavgq2=tavgql[2],
-            tavgq3=tavgql[3],
-            oscale=toutscale,
-            iscale=tinscale,
-        )
-    else:
-        # quartals == 12
-        grass.mapcalc(
-            "$bio = round(if($driestq ==  0, $tavgq0, \
-                    if($driestq ==  1, $tavgq1, \
-                    if($driestq ==  2, $tavgq2, \
-                    if($driestq ==  3, $tavgq3, \
-                    if($driestq ==  4, $tavgq4, \
-                    if($driestq ==  5, $tavgq5, \
-                    if($driestq ==  6, $tavgq6, \
-                    if($driestq ==  7, $tavgq7, \
-                    if($driestq ==  8, $tavgq8, \
-                    if($driestq ==  9, $tavgq9, \
-                    if($driestq == 10, $tavgq10, \
-                    if($driestq == 11, $tavgq11, null())))))))))))) \
-                    * $oscale / $iscale)",
-            bio=outpre + "bio09",
-            driestq=driestq,
-            tavgq0=tavgql[0],
-            tavgq1=tavgql[1],
-            tavgq2=tavgql[2],
-            tavgq3=tavgql[3],
-            tavgq4=tavgql[4],
-            tavgq5=tavgql[5],
-            tavgq6=tavgql[6],
-            tavgq7=tavgql[7],
-            tavgq8=tavgql[8],
-            tavgq9=tavgql[9],
-            tavgq10=tavgql[10],
-            tavgq11=tavgql[11],
-            oscale=toutscale,
-            iscale=tinscale,
-        )
-
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio09",
-        description="BIOCLIM09: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio09", history=os.environ["CMDLINE"])
-
-    # BIO12 = Annual Precipitation
-    grass.message(_("BIO12 = Annual Precipitation ..."))
-    output = outpre + "bio12"
-    grass.run_command("r.series", input=prec, output=output, method="sum")
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio12",
-        description="BIOCLIM12: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio12", history=os.environ["CMDLINE"])
-
-    # BIO13 = Precipitation of Wettest Month
-    # BIO14 = Precipitation of Driest Month
-    grass.message(_("BIO13 = Precipitation of Wettest Month,"))
-    grass.message(_("BIO14 = Precipitation of Driest Month ..."))
-
-    bio13 = outpre + "bio13"
-    bio14 = outpre + "bio14"
-    grass.run_command(
-        "r.series",
-        input=prec,
-        output="%s,%s" % (bio13, bio14),
-        method="maximum,minimum",
-    )
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio13",
-        description="BIOCLIM13: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio13", history=os.environ["CMDLINE"])
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio14",
-        description="BIOCLIM14: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio14", history=os.environ["CMDLINE"])
-
-    # BIO15 = Precipitation Seasonality (Coefficient of Variation)
-    grass.message(_("BIO15 = Precipitation Seasonality ..."))
-    precavg = "%s.precavg.%d" % (outpre, pid)
-    precstddev = "%s.precstddev.%d" % (outpre, pid)
-    grass.run_command(
-        "r.series",
-        input=prec,
-        output="%s,%s" % (precavg, precstddev),
-        method="average,stddev",
-    )
-    grass.mapcalc(
-        "$bio = if($precavg == 0, 0, round(100.0 * $precstddev / $precavg))",
-        bio=outpre + "bio15",
-        precstddev=precstddev,
-        precavg=precavg,
-    )
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio15",
-        description="BIOCLIM15: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio15", history=os.environ["CMDLINE"])
-
-    # BIO16 = Precipitation of Wettest Quarter
-    # BIO17 = Precipitation of Driest Quarter
-    grass.message(_("BIO16 = Precipitation of Wettest Quarter,"))
-    grass.message(_("BIO17 = Precipitation of Driest Quarter ..."))
-
-    bio16 = outpre + "bio16"
-    bio17 = outpre + "bio17"
-    grass.run_command(
-        "r.series",
-        input=precq,
-        output="%s,%s" % (bio16, bio17),
-        method="maximum,minimum",
-    )
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio16",
-        description="BIOCLIM16: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio16", history=os.environ["CMDLINE"])
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio17",
-        description="BIOCLIM17: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio17", history=os.environ["CMDLINE"])
-
-    precql = precq.split(",")
-
-    # BIO18 = Precipitation of Warmest Quarter
-    grass.message(_("BIO18 = Precipitation of Warmest Quarter ..."))
-
-    if quartals == 4:
-        grass.mapcalc(
-            "$bio = round(if($warmestq == 0, $precq0, \
-                    if($warmestq == 1, $precq1, \
-                    if($warmestq == 2, $precq2, \
-                    if($warmestq == 3, $precq3, null())))))",
-            bio=outpre + "bio18",
-            warmestq=warmestq,
-            precq0=precql[0],
-            precq1=precql[1],
-            precq2=precql[2],
-            precq3=precql[3],
-        )
-    else:
-        # quartals == 12
-        grass.mapcalc(
-            "$bio = round(if($warmestq ==  0, $precq0, \
-                    if($warmestq ==  1, $precq1, \
-                    if($warmestq ==  2, $precq2, \
-                    if($warmestq ==  3, $precq3, \
-                    if($warmestq ==  4, $precq4, \
-                    if($warmestq ==  5, $precq5, \
-                    if($warmestq ==  6, $precq6, \
-                    if($warmestq ==  7, $precq7, \
-                    if($warmestq ==  8, $precq8, \
-                    if($warmestq ==  9, $precq9, \
-                    if($warmestq == 10, $precq10, \
-                    if($warmestq == 11, $precq11, null())))))))))))))",
-            bio=outpre + "bio18",
-            warmestq=warmestq,
-            precq0=precql[0],
-            precq1=precql[1],
-            precq2=precql[2],
-            precq3=precql[3],
-            precq4=precql[4],
-            precq5=precql[5],
-            precq6=precql[6],
-            precq7=precql[7],
-            precq8=precql[8],
-            precq9=precql[9],
-            precq10=precql[10],
-            precq11=precql[11],
-        )
-
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio18",
-        description="BIOCLIM18: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio18", history=os.environ["CMDLINE"])
-
-    # BIO19 = Precipitation of Coldest Quarter
-    grass.message(_("BIO19 = Precipitation of Coldest Quarter ..."))
-
-    if quartals == 4:
-        grass.mapcalc(
-            "$bio = round(if($coldestq == 0, $precq0, \
-                    if($coldestq == 1, $precq1, \
-                    if($coldestq == 2, $precq2, \
-                    if($coldestq == 3, $precq3, null())))))",
-            bio=outpre + "bio19",
-            coldestq=coldestq,
-            precq0=precql[0],
-            precq1=precql[1],
-            precq2=precql[2],
-            precq3=precql[3],
-        )
-    else:
-        # quartals == 12
-        grass.mapcalc(
-            "$bio = round(if($coldestq ==  0, $precq0, \
-                    if($coldestq ==  1, $precq1, \
-                    if($coldestq ==  2, $precq2, \
-                    if($coldestq ==  3, $precq3, \
-                    if($coldestq ==  4, $precq4, \
-                    if($coldestq ==  5, $precq5, \
-                    if($coldestq ==  6, $precq6, \
-                    if($coldestq ==  7, $precq7, \
-                    if($coldestq ==  8, $precq8, \
-                    if($coldestq ==  9, $precq9, \
-                    if($coldestq == 10, $precq10, \
-                    if($coldestq == 11, $precq11, null())))))))))))))",
-            bio=outpre + "bio19",
-            coldestq=coldestq,
-            precq0=precql[0],
-            precq1=precql[1],
-            precq2=precql[2],
-            precq3=precql[3],
-            precq4=precql[4],
-            precq5=precql[5],
-            precq6=precql[6],
-            precq7=precql[7],
-            precq8=precql[8],
-            precq9=precql[9],
-            precq10=precql[10],
-            precq11=precql[11],
-        )
-
-    grass.run_command(
-        "r.support",
-        map=outpre + "bio19",
-        description="BIOCLIM19: Generated by r.bioclim",
-    )
-    grass.run_command("r.support", map=outpre + "bio19", history=os.environ["CMDLINE"])
-
-    grass.run_command(
-        "g.remove", flags="f", type="raster", pattern=tmp_pattern, quiet=True
-    )
 
 
 if __name__ == "__main__":
     options, flags = grass.parser()
-    tmp_pattern = None
-    atexit.register(cleanup)
     main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+from grass.gunittest.case import TestCase
+from grass.gunittest.main import test
+
+
+class TestBioclimRounding(TestCase):
+    """Means of integer temperatures ending on .5 must be rounded as
+    round() of r.mapcalc, halves away from zero"""
+
+    output = "bioclim_"
+    months = [
+        "%s_%02d" % (prefix, i) for prefix in ("tmin", "tmax") for i in range(1, 13)
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.use_temp_region()
+        cls.runModule("g.region", n=2, s=0, e=3, w=0, res=1)
+        # -3 and -2 or 2 and 3, the mean is -2.5 or 2.5
+        values = {"tmin": "if(col() == 1, -3, 2)", "tmax": "if(col() == 1, -2, 3)"}
+        for name in cls.months:
+            cls.runModule("r.mapcalc", expression="%s = %s" % (name, values[name[:4]]))
+        cls.runModule(
+            "r.mapcalc",
+            expression="bioclim_ref01 = round((tmin_01 + tmax_01) / 2.0)",
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.runModule(
+            "g.remove", flags="f", type="raster", name=cls.months + ["bioclim_ref01"]
+        )
+        cls.runModule("g.remove", flags="f", type="raster", pattern="bioclim_bio*")
+        cls.del_temp_region()
+
+    def test_negative_halves(self):
+        """bio01 of -2.5 is -3 and of 2.5 is 3"""
+        self.assertModule(
+            "r.bioclim",
+            tmin=self.months[:12],
+            tmax=self.months[12:],
+            output=self.output,
+            toutscale=1,
+            overwrite=True,
+        )
+        self.assertRastersNoDifference(
+            actual="bioclim_bio01", reference="bioclim_ref01", precision=0
+        )
+        self.assertRasterMinMax(map="bioclim_bio01", refmin=-3, refmax=3)
+
+
+if __name__ == "__main__":
+    test()
@@ -99,6 +99,34 @@
 #% guisection: Calibration
 #%end
 #%option
+#% key: search
+#% type: string
+#% required: no
+#% multiple: no
+#% options: grid,halving
+#% answer: grid
+#% label: Strategy for searching the parameter combinations
+#% description: Successive halving starts with few repeats and drops the worse half of combinations before repeating more
+#% descriptions: grid;all combinations are simulated repeat times;halving;successive halving, only the best combinations are simulated repeat times
+#% guisection: Calibration
+#%end
+#%option
+#% key: min_repeat
+#% type: integer
+#% required: no
+#% multiple: no
+#% answer: 1
+#% description: Number of simulations of each combination in the first round of successive halving
+#% guisection: Calibration
+#%end
+#%option G_OPT_M_DIR
+#% key: cache
+#% required: no
+#% label: Directory for caching simulated patches
+#% description: Simulations found in the cache are reused, so interrupted or extended calibrations are faster
+#% guisection: Calibration
+#%end
+#%option
 #% key: random_seed
 #% type: integer
 #% required: no
@@ -272,10 +300,12 @@
 
 import sys
 import os
+import json
 import atexit
+import hashlib
 import numpy as np
 from io import StringIO
-from multiprocessing import Process, Queue
+from multiprocessing import Pool
 
 import grass.script.core as gcore
 import grass.script.raster as grast
@@ -306,33 +336,115 @@ def check_addon_installed(addon, fatal=True):
         )
 
 
-def run_one_combination(
-    comb_count,
-    comb_all,
-    repeat,
-    seed,
-    development_start,
-    compactness_mean,
-    compactness_range,
-    discount_factor,
-    patches_file,
-    fut_options,
-    threshold,
-    hist_bins_area_orig,
-    hist_range_area_orig,
-    hist_bins_compactness_orig,
-    hist_range_compactness_orig,
-    cell_size,
-    histogram_area_orig,
-    histogram_compactness_orig,
-    tmp_name,
-    queue,
+def raster_state(names):
+    """Return full names and modification times of the files of raster maps,
+    so that a map regenerated under the same name changes the state"""
+    state = []
+    for name in names.split(","):
+        if not name:
+            continue
+        found = gcore.find_file(name, element="cellhd")
+        mapset = os.path.dirname(os.path.dirname(found["file"]))
+        paths = [
+            os.path.join(mapset, element, found["name"])
+            for element in ("cellhd", "cell", "fcell")
+        ]
+        paths.append(os.path.join(mapset, "cell_misc", found["name"], "null"))
+        times = [os.path.getmtime(p) if os.path.exists(p) else None for p in paths]
+        state.append([found["fullname"], times])
+    return state
+
+
+def cache_context(options, patches_file, threshold):
+    """Return description of everything except compactness, discount factor
+    and seed which influences the simulated patches"""
+    with open(patches_file, "rb") as f:
+        patches = hashlib.sha1(f.read()).hexdigest()
+    keys = (
+        "development_start",
+        "development_pressure",
+        "predictors",
+        "n_dev_neighbourhood",
+        "devpot_params",
+        "num_neighbors",
+        "seed_search",
+        "development_pressure_approach",
+        "gamma",
+        "scaling_factor",
+        "subregions",
+        "demand",
+        "potential_weight",
+        "num_steps",
+        "incentive_power",
+        "subregions_potential",
+    )
+    context = dict((key, options[key]) for key in keys)
+    for key in ("devpot_params", "demand"):
+        context[key] = []
+        for name in options[key].split(","):
+            if not name:
+                continue
+            with open(name, "rb") as f:
+                context[key].append(hashlib.sha1(f.read()).hexdigest())
+    for key in (
+        "development_start",
+        "development_pressure",
+        "predictors",
+        "subregions",
+        "potential_weight",
+        "subregions_potential",
+    ):
+        context[key] = raster_state(options[key])
+    context["patches"] = patches
+    context["threshold"] = threshold
+    context["region"] = gcore.region()
+    return context
+
+
+def cache_file(
+    cache, context, compactness_mean, compactness_range, discount_factor, seed
 ):
+    """Return path of the cached patches of one simulation"""
+    key = json.dumps(
+        [context, compactness_mean, compactness_range, discount_factor, seed],
+        sort_keys=True,
+    )
+    return os.path.join(cache, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+
+def simulate_patches(args):
+    """Run one simulation and return area and perimeter of the new patches,
+    or None if the simulation failed. Simulations already in the cache are
+    not run again."""
+    (
+        comb_count,
+        comb_all,
+        i,
+        repeat,
+        seed,
+        development_start,
+        compactness_mean,
+        compactness_range,
+        discount_factor,
+        patches_file,
+        fut_options,
+        threshold,
+        tmp_name,
+        cache,
+        context,
+    ) = args
+    if cache:
+        path = cache_file(
+            cache, context, compactness_mean, compactness_range, discount_factor, seed
+        )
+        if os.path.exists(path):
+            return np.load(path)
+
     TMP_PROCESS = []
     # unique name, must be sql compliant
     suffix = (
         str(discount_factor) + str(compactness_mean) + str(compactness_range)
-    ).replace(".", "")
+    ).replace(".", "") + "_{}".format(seed)
     simulation_dev_end = tmp_name + "simulation_dev_end_" + suffix
     simulation_dev_diff = tmp_name + "simulation_dev_diff" + suffix
     tmp_clump = tmp_name + "tmp_clump" + suffix
@@ -340,69 +452,44 @@ def run_one_combination(
     TMP_PROCESS.append(simulation_dev_end)
     TMP_PROCESS.append(tmp_clump)
 
-    sum_dist_area = 0
-    sum_dist_compactness = 0
-    # offset seed
-    seed *= 10000
-    for i in range(repeat):
-        f_seed = seed + i
-        gcore.message(
-            _(
-                "Running calibration combination {comb_count}/{comb_all}"
-                " of simulation attempt {i}/{repeat} with random seed {s}...".format(
-                    comb_count=comb_count,
-                    comb_all=comb_all,
-                    i=i + 1,
-                    repeat=repeat,
-                    s=f_seed,
-                )
+    gcore.message(
+        _(
+            "Running calibration combination {comb_count}/{comb_all}"
+            " of simulation attempt {i}/{repeat} with random seed {s}...".format(
+                comb_count=comb_count,
+                comb_all=comb_all,
+                i=i + 1,
+                repeat=repeat,
+                s=seed,
             )
         )
-        try:
-            run_simulation(
-                development_start=development_start,
-                development_end=simulation_dev_end,
-                compactness_mean=compactness_mean,
-                compactness_range=compactness_range,
-                discount_factor=discount_factor,
-                patches_file=patches_file,
-                seed=f_seed,
-                fut_options=fut_options,
-            )
-        except CalledModuleError as e:
-            queue.put(None)
-            cleanup(tmp=TMP_PROCESS)
-            gcore.error(_("Running r.futures.pga failed. Details: {e}").format(e=e))
-            return
-        new_development(simulation_dev_end, simulation_dev_diff)
-
-        data = patch_analysis(simulation_dev_diff, threshold, tmp_clump)
-        sim_hist_area, sim_hist_compactness = create_histograms(
-            data,
-            hist_bins_area_orig,
-            hist_range_area_orig,
-            hist_bins_compactness_orig,
-            hist_range_compactness_orig,
-            cell_size,
-        )
-
-        sum_dist_area += compare_histograms(histogram_area_orig, sim_hist_area)
-        sum_dist_compactness += compare_histograms(
-            histogram_compactness_orig, sim_hist_compactness
+    )
+    try:
+        run_simulation(
+            development_start=development_start,
+            development_end=simulation_dev_end,
+            compactness_mean=compactness_mean,
+            compactness_range=compactness_range,
+            discount_factor=discount_factor,
+            patches_file=patches_file,
+            seed=seed,
+            fut_options=fut_options,
         )
-
-    mean_dist_area = sum_dist_area / repeat
-    mean_dist_compactness = sum_dist_compactness / repeat
-
-    data = {}
-    data["input_discount_factor"] = discount_factor
-    data["input_compactness_mean"] = compactness_mean
-    data["input_compactness_range"] = compactness_range
-    data["area_distance"] = mean_dist_area
-    data["compactness_distance"] = mean_dist_compactness
-    queue.put(data)
+    except CalledModuleError as e:
+        cleanup(tmp=TMP_PROCESS)
+        gcore.error(_("Running r.futures.pga failed. Details: {e}").format(e=e))
+        return None
+    new_development(simulation_dev_end, simulation_dev_diff)
+    data = patch_analysis(simulation_dev_diff, threshold, tmp_clump)
     cleanup(tmp=TMP_PROCESS)
 
+    if cache:
+        # write under temporary name so that an interrupted write is not reused
+        tmp_path = "{}.{}.npy".format(path[:-4], os.getpid())
+        np.save(tmp_path, data)
+        os.rename(tmp_path, path)
+    return data
+
 
 def run_simulation(
     development_start,
@@ -622,13 +709,21 @@ def compactness(area, perimeter):
     return perimeter / (2 * np.sqrt(np.pi * area))
 
 
-def process_calibration(calib_file):
-    disc, area_err, compact_mean, compact_range, compact_err = np.loadtxt(
-        calib_file, unpack=True, delimiter=","
-    )
+def combined_error(area_err, compact_err):
+    """Normalize area and compactness errors and average them"""
     norm_area_err = area_err / np.max(area_err)
     norm_compact_err = compact_err / np.max(compact_err)
     averaged_error = (norm_area_err + norm_compact_err) / 2
+    return norm_area_err, norm_compact_err, averaged_error
+
+
+def process_calibration(calib_file):
+    disc, area_err, compact_mean, compact_range, compact_err = np.loadtxt(
+        calib_file, unpack=True, delimiter=",", ndmin=2
+    )
+    norm_area_err, norm_compact_err, averaged_error = combined_error(
+        area_err, compact_err
+    )
     res = np.column_stack(
         (
             disc,
@@ -743,69 +838,134 @@ def main():
 
     seed = int(options["random_seed"])
     nprocs = int(options["nprocs"])
-    count = 0
-    proc_count = 0
-    queue_list = []
-    proc_list = []
-    num_all = len(compactness_means) * len(compactness_ranges) * len(discount_factors)
-    with open(options["calibration_results"], "w") as f:
-        for com_mean in compactness_means:
-            for com_range in compactness_ranges:
-                for discount_factor in discount_factors:
-                    count += 1
-                    q = Queue()
-                    p = Process(
-                        target=run_one_combination,
-                        args=(
-                            count,
-                            num_all,
-                            repeat,
-                            seed,
-                            dev_start,
-                            com_mean,
-                            com_range,
-                            discount_factor,
-                            patches_file,
-                            options,
-                            threshold,
-                            hist_bins_area_orig,
-                            hist_range_area_orig,
-                            hist_bins_compactness_orig,
-                            hist_range_compactness_orig,
-                            cell_size,
-                            histogram_area_orig,
-                            histogram_compactness_orig,
-                            tmp_name,
-                            q,
-                        ),
+    search = options["search"]
+    min_repeat = int(options["min_repeat"])
+    cache = options["cache"]
+    context = None
+    if cache:
+        if not os.path.exists(cache):
+            os.makedirs(cache)
+        context = cache_context(options, patches_file, threshold)
+
+    combinations = [
+        (com_mean, com_range, discount_factor)
+        for com_mean in compactness_means
+        for com_range in compactness_ranges
+        for discount_factor in discount_factors
+    ]
+    num_all = len(combinations)
+    # histogram distances of each simulation of the combinations
+    distances = [[] for each in combinations]
+    failed = set()
+
+    def simulate(candidates, repeats):
+        """Simulate the candidate combinations until they have repeats results"""
+        jobs = []
+        for k in candidates:
+            com_mean, com_range, discount_factor = combinations[k]
+            for i in range(len(distances[k]), repeats):
+                jobs.append(
+                    (
+                        k + 1,
+                        num_all,
+                        i,
+                        repeats,
+                        # offset seed
+                        (seed + k) * 10000 + i,
+                        dev_start,
+                        com_mean,
+                        com_range,
+                        discount_factor,
+                        patches_file,
+                        options,
+                        threshold,
+                        tmp_name,
+                        cache,
+                        context,
                     )
-                    p.start()
-                    queue_list.append(q)
-                    proc_list.append(p)
-                    proc_count += 1
-                    seed += 1
-                    if proc_count == nprocs or count == num_all:
-                        for i in range(proc_count):
-                            proc_list[i].join()
-                            data = queue_list[i].get()
-                            if not data:
-                                continue
-                            f.write(
-                                ",".join(
-                                    [
-                                        str(data["input_discount_factor"]),
-                                        str(data["area_distance"]),
-                                        str(data["input_compactness_mean"]),
-                                        str(data["input_compactness_range"]),
-                                        str(data["compactness_distance"]),
-                                    ]
-                                )
-                            )
-                            f.write("\n")
-                        f.flush()
-                        proc_count = 0
-                        proc_list = []
-                        queue_list = []
+                )
+        for job, data in zip(
+            jobs, (pool.imap if pool else map)(simulate_patches, jobs)
+        ):
+            k = job[0] - 1
+            if data is None:
+                failed.add(k)
+                continue
+            sim_hist_area, sim_hist_compactness = create_histograms(
+                data,
+                hist_bins_area_orig,
+                hist_range_area_orig,
+                hist_bins_compactness_orig,
+                hist_range_compactness_orig,
+                cell_size,
+            )
+            distances[k].append(
+                (
+                    compare_histograms(histogram_area_orig, sim_hist_area),
+                    compare_histograms(
+                        histogram_compactness_orig, sim_hist_compactness
+                    ),
+                )
+            )
+        return [k for k in candidates if k not in failed]
+
+    def mean_distances(k):
+        sum_dist_area = 0
+        sum_dist_compactness = 0
+        for dist_area, dist_compactness in distances[k]:
+            sum_dist_area += dist_area
+            sum_dist_compactness += dist_compactness
+        return (
+            sum_dist_area / len(distances[k]),
+            sum_dist_compactness / len(distances[k]),
+        )
+
+    pool = Pool(nprocs) if nprocs > 1 else None
+    try:
+        candidates = list(range(num_all))
+        if search == "halving":
+            repeats = max(1, min(min_repeat, repeat))
+            while repeats < repeat and len(candidates) > 1:
+                gcore.message(
+                    _(
+                        "Simulating {n} combinations {r} times...".format(
+                            n=len(candidates), r=repeats
+                        )
+                    )
+                )
+                candidates = simulate(candidates, repeats)
+                if not candidates:
+                    break
+                area_err, compact_err = np.array(
+                    [mean_distances(k) for k in candidates]
+                ).T
+                error = combined_error(area_err, compact_err)[2]
+                # keep the better half
+                best = np.argsort(error, kind="stable")[: (len(candidates) + 1) // 2]
+                candidates = sorted(candidates[b] for b in best)
+                repeats = min(2 * repeats, repeat)
+        candidates = simulate(candidates, repeat)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    with open(options["calibration_results"], "w") as f:
+        for k in candidates:
+            com_mean, com_range, discount_factor = combinations[k]
+            mean_dist_area, mean_dist_compactness = mean_distances(k)
+            f.write(
+                ",".join(
+                    [
+                        str(discount_factor),
+                        str(mean_dist_area),
+                        str(com_mean),
+                        str(com_range),
+                        str(mean_dist_compactness),
+                    ]
+                )
+            )
+            f.write("\n")
     # compute combined normalized error
     process_calibration(options["calibration_results"])
 
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import os
 import filecmp
+import shutil
 from grass.gunittest.case import TestCase
 from grass.gunittest.main import test
 
@@ -89,6 +90,7 @@ class TestPGACalib(TestCase):
                 os.remove(each)
             except OSError:
                 pass
+        shutil.rmtree("data/cache", ignore_errors=True)
 
     def test_pga_calib_library(self):
         """Test if generated patch library matches the reference"""
@@ -183,6 +185,55 @@ class TestPGACalib(TestCase):
             "Calibration results differ",
         )
 
+    def test_pga_calib_compactness_cache(self):
+        """Test if results of cached and parallel simulations match the reference"""
+        for i in range(2):
+            self.assertModule(
+                "r.futures.calib",
+                development_start="urban_1987",
+                development_end="urban_2002",
+                patch_threshold=0,
+                patch_sizes="data/out_library.txt",
+                compactness_mean=[0.1, 0.8],
+                compactness_range=[0.1],
+                discount_factor=[0.1],
+                calibration_results="data/out_calib.csv",
+                nprocs=2,
+                repeat=2,
+                random_seed=1,
+                cache="data/cache",
+                overwrite=True,
+                **self.pga_params
+            )
+            self.assertTrue(
+                filecmp.cmp("data/out_calib.csv", "data/ref_calib.csv", shallow=False),
+                "Calibration results differ",
+            )
+
+    def test_pga_calib_compactness_halving(self):
+        """Test if successive halving keeps only the best combination"""
+        self.assertModule(
+            "r.futures.calib",
+            development_start="urban_1987",
+            development_end="urban_2002",
+            patch_threshold=0,
+            patch_sizes="data/out_library.txt",
+            compactness_mean=[0.1, 0.8],
+            compactness_range=[0.1],
+            discount_factor=[0.1],
+            calibration_results="data/out_calib.csv",
+            nprocs=1,
+            repeat=2,
+            search="halving",
+            min_repeat=1,
+            random_seed=1,
+            **self.pga_params
+        )
+        with open("data/out_calib.csv") as f:
+            lines = f.read().splitlines()
+        # header and one combination
+        self.assertEqual(len(lines), 2)
+
 
 if __name__ == "__main__":
     test()
@@ -63,22 +63,31 @@
 #% key: n
 #% description: Do not propagate nulls
 #%end
+#%flag
+#% key: f
+#% description: Compute the filter with FFT convolution (faster for large size)
+#%end
 
 
 import os
 import sys
 import atexit
 import numpy as np
-from math import sqrt
 
 # from grass.exceptions import CalledModuleError
 import grass.script.core as gcore
 import grass.script.utils as gutils
 import grass.script.raster as grast
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
 
 TMPFILE = None
 TMP = []
 
+CNULL = -2147483648  # null value for CELL maps
+TILE_CELLS = 4 * 1024 * 1024  # approximate number of cells of an FFT tile
+
 
 def cleanup():
     if TMP:
@@ -102,6 +111,24 @@ def main():
             _("Methods gravity and kernel require options scaling_factor and gamma")
         )
 
+    matrix = distance_matrix(size)
+    if method == "occurrence":
+        matrix[matrix > 0] = 1
+    elif method == "gravity":
+        with np.errstate(divide="ignore"):
+            denom = np.power(matrix, gamma)
+            matrix = scale / denom
+            matrix[denom == 0] = 0
+    else:
+        matrix_ = scale * np.exp(-2 * matrix / gamma)
+        matrix = np.where(matrix > 0, matrix_, 0)
+
+    if flags["f"]:
+        gcore.message(_("Running development pressure filter..."))
+        fft_filter(input_dev, output, matrix, propagate_nulls=not flags["n"])
+        grast.raster_history(output)
+        return
+
     temp_map = "tmp_futures_devPressure_" + str(os.getpid()) + "_copy"
     temp_map_out = "tmp_futures_devPressure_" + str(os.getpid()) + "_out"
     temp_map_nulls = "tmp_futures_devPressure_" + str(os.getpid()) + "_nulls"
@@ -135,18 +162,6 @@ def main():
         rmfilter_inp = input_dev
         rmfilter_out = output
 
-    matrix = distance_matrix(size)
-    if method == "occurrence":
-        matrix[matrix > 0] = 1
-    elif method == "gravity":
-        with np.errstate(divide="ignore"):
-            denom = np.power(matrix, gamma)
-            matrix = scale / denom
-            matrix[denom == 0] = 0
-    else:
-        matrix_ = scale * np.exp(-2 * matrix / gamma)
-        matrix = np.where(matrix > 0, matrix_, 0)
-
     path = gcore.tempfile()
     global TMPFILE
     TMPFILE = path
@@ -175,32 +190,126 @@ def main():
 
 
 def distance_matrix(size):
-    matrix_size = 2 * size + 1
-    matrix = np.zeros((matrix_size, matrix_size))
-    center = size
-    for i in range(matrix_size):
-        for j in range(matrix_size):
-            dist = sqrt((i - center) * (i - center) + (j - center) * (j - center))
-            if dist <= size:
-                matrix[i, j] = dist
-    return matrix
+    rows, cols = np.indices((2 * size + 1, 2 * size + 1)) - size
+    dist = np.hypot(rows, cols)
+    return np.where(dist <= size, dist, 0)
 
 
 def write_filter(matrix):
     filter_text = ["TITLE development pressure"]
     filter_text.append("MATRIX %s" % matrix.shape[0])
-    for i in range(matrix.shape[0]):
-        line = ""
-        for j in range(matrix.shape[0]):
-            line += str(matrix[i, j])
-            line += " "
-        filter_text.append(line)
+    for row in matrix:
+        filter_text.append(" ".join(str(value) for value in row) + " ")
     filter_text.append("DIVISOR 1")
     filter_text.append("TYPE P")
 
     return "\n".join(filter_text)
 
 
+def read_tile(input, start, end):
+    """Read rows from start to end (excluded) of the current window,
+    with NaN for null cells"""
+    with RasterRow(input) as rast:
+        tile = np.array([rast[row] for row in range(start, end)], dtype=np.float64)
+        if rast.mtype == "CELL":
+            tile[tile == CNULL] = np.nan
+    return tile
+
+
+def set_region(region, size=0):
+    """Set the raster window of the current process to the region
+    enlarged by size cells on each side"""
+    reg = Region()
+    reg.north = region["n"] + size * region["nsres"]
+    reg.south = region["s"] - size * region["nsres"]
+    reg.east = region["e"] + size * region["ewres"]
+    reg.west = region["w"] - size * region["ewres"]
+    reg.nsres = region["nsres"]
+    reg.ewres = region["ewres"]
+    reg.adjust()
+    reg.set_raster_region()
+
+
+def fft_correlate(tile, matrix, fmatrix):
+    """Correlate the tile with the matrix using FFT, overlap-save style.
+
+    The result has the shape of the tile minus the matrix size plus one,
+    i.e. only cells whose whole window lies in the tile, which are not
+    affected by the circular wrap-around of the FFT.
+    """
+    k = matrix.shape[0] - 1
+    result = np.fft.irfft2(np.fft.rfft2(tile) * fmatrix, tile.shape)
+    return result[k:, k:]
+
+
+def window_sum(values, size):
+    """Sum values over (2 * size + 1) square windows fully inside the array,
+    using a summed-area table"""
+    k = 2 * size + 1
+    sat = np.zeros((values.shape[0] + 1, values.shape[1] + 1))
+    sat[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+    return sat[k:, k:] - sat[:-k, k:] - sat[k:, :-k] + sat[:-k, :-k]
+
+
+def fft_filter(input, output, matrix, propagate_nulls=True):
+    """Filter the input with the matrix as r.mfilter (TYPE P, DIVISOR 1) does,
+    using FFT convolution on tiles of rows with a halo of the matrix size.
+
+    Nulls are handled by convolving the zero-filled data and the null mask
+    separately: with propagate_nulls, cells with a null in their window are
+    null and the border cells keep the input values as in r.mfilter;
+    otherwise nulls and cells outside of the region count as zero and only
+    null input cells are null.
+    """
+    size = matrix.shape[0] // 2
+    region = gcore.region()
+    rows, cols = region["rows"], region["cols"]
+
+    ext_cols = cols + 2 * size
+    tile_rows = max(2 * size + 1, TILE_CELLS // ext_cols)
+    # filtered rows are kept on disk until the output is written
+    path = gcore.tempfile()
+    try:
+        result = np.memmap(path, dtype=np.float64, mode="w+", shape=(rows, cols))
+        # read the input in the region enlarged by the matrix size
+        set_region(region, size)
+        # correlation is a convolution with the flipped matrix
+        fmatrix = None
+        for start in range(0, rows, tile_rows):
+            end = min(start + tile_rows, rows)
+            tile = read_tile(input, start, end + 2 * size)
+            nulls = np.isnan(tile)
+            center = tile[size : size + end - start, size : size + cols]
+            if fmatrix is None or fmatrix.shape[0] != tile.shape[0]:
+                fmatrix = np.fft.rfft2(matrix[::-1, ::-1], tile.shape)
+            filtered = fft_correlate(np.where(nulls, 0, tile), matrix, fmatrix)
+            if propagate_nulls:
+                filtered[window_sum(nulls, size) > 0] = np.nan
+                # border cells are not filtered
+                border = np.zeros(filtered.shape, dtype=bool)
+                border[:, :size] = border[:, cols - size :] = True
+                border[: max(0, size - start)] = True
+                border[max(0, rows - size - start) :] = True
+                filtered[border] = center[border]
+            else:
+                filtered[np.isnan(center)] = np.nan
+            result[start:end] = filtered
+            gcore.percent(end, rows, 1)
+
+        # write the output in the current region
+        set_region(region)
+        with RasterRow(
+            output, mode="w", mtype="DCELL", overwrite=gcore.overwrite()
+        ) as out:
+            newrow = Buffer((cols,), mtype="DCELL")
+            for row in result:
+                newrow[:] = row
+                out.put_row(newrow)
+        del result
+    finally:
+        gutils.try_remove(path)
+
+
 if __name__ == "__main__":
     options, flags = gcore.parser()
     atexit.register(cleanup)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import grass.script as gs
 from grass.gunittest.case import TestCase
 from grass.gunittest.main import test
 
@@ -8,6 +9,7 @@ class TestDevpressure(TestCase):
 
     output = "devpressure_output"
     result = "result"
+    mfilter = "devpressure_mfilter"
 
     @classmethod
     def setUpClass(cls):
@@ -34,7 +36,9 @@ class TestDevpressure(TestCase):
         cls.del_temp_region()
 
     def tearDown(self):
-        self.runModule("g.remove", flags="f", type="raster", name=self.output)
+        self.runModule(
+            "g.remove", flags="f", type="raster", name=[self.output, self.mfilter]
+        )
 
     def test_devpressure_run(self):
         """Test if results is in expected limits"""
@@ -50,6 +54,46 @@ class TestDevpressure(TestCase):
             actual=self.output, reference=self.result, precision=1e-6
         )
 
+    def test_devpressure_fft(self):
+        """Test if FFT filter gives the same results"""
+        self.assertModule(
+            "r.futures.devpressure",
+            input="urban_2002",
+            output=self.output,
+            method="gravity",
+            size=15,
+            flags="nf",
+        )
+        self.assertRastersNoDifference(
+            actual=self.output, reference=self.result, precision=1e-6
+        )
+
+    def test_devpressure_fft_nulls(self):
+        """Test if FFT filter propagates nulls and keeps border cells as r.mfilter"""
+        self.assertModule(
+            "r.futures.devpressure",
+            input="urban_2002",
+            output=self.mfilter,
+            method="gravity",
+            size=15,
+        )
+        self.assertModule(
+            "r.futures.devpressure",
+            input="urban_2002",
+            output=self.output,
+            method="gravity",
+            size=15,
+            flags="f",
+        )
+        self.assertRastersNoDifference(
+            actual=self.output, reference=self.mfilter, precision=1e-6
+        )
+        univar = gs.parse_command("r.univar", map=self.mfilter, flags="g")
+        self.assertRasterFitsUnivar(
+            self.output,
+            reference=dict(n=int(univar["n"]), null_cells=int(univar["null_cells"])),
+        )
+
 
 if __name__ == "__main__":
     test()
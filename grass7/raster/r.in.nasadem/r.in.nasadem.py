@@ -102,6 +102,22 @@
 #% description: Cache size for raster rows
 #% answer: 300
 #%end
+#%option G_OPT_M_DIR
+#% key: cache
+#% label: Directory for caching downloaded NASADEM tiles
+#% description: Tiles found in this directory are not downloaded again
+#% required: no
+#%end
+#%option
+#% key: threads
+#% type: integer
+#% description: Number of tiles downloaded in parallel
+#% answer: 4
+#% required: no
+#%end
+#%option G_OPT_M_NPROCS
+#% description: Number of tiles imported in parallel
+#%end
 #%flag
 #% key: z
 #% description: Create zero elevation for missing tiles
@@ -115,6 +131,7 @@ import shutil
 import time
 import zipfile as zfile
 import subprocess
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from six.moves.urllib import request as urllib2
 
 try:
@@ -124,6 +141,9 @@ except ImportError:
 import grass.script as grass
 from grass.exceptions import CalledModuleError
 
+# number of imported tiles which are patched together while importing
+PATCH_TILES = 100
+
 # initialize global vars
 TMPLOC = None
 SRCGISRC = None
@@ -266,16 +286,20 @@ def import_local_tile(tile, local, pid, layer):
     return 1
 
 
-def download_tile(tile, url, pid, version, username, password):
+def download_tile(tile, url, pid, version, username, password, directory):
 
     grass.debug("Download tile: %s" % tile, debug=1)
     local_tile = "NASADEM_HGT_" + str(tile) + ".zip"
-
-    urllib2.urlcleanup()
+    path = os.path.join(directory, local_tile)
+    if os.path.exists(path):
+        grass.verbose(_("Tile %s found in <%s>") % (tile, directory))
+        return 1
 
     remote_tile = str(url) + "/" + version + "/2000.02.11/" + local_tile
     goturl = 1
 
+    # write to temporary file so that incomplete downloads are not cached
+    tmp_path = path + ".tmp." + str(pid)
     try:
         password_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
         password_manager.add_password(
@@ -284,28 +308,77 @@ def download_tile(tile, url, pid, version, username, password):
 
         cookie_jar = CookieJar()
 
+        # own opener for each download, the installed opener is shared by all threads
         opener = urllib2.build_opener(
             urllib2.HTTPBasicAuthHandler(password_manager),
             # urllib2.HTTPHandler(debuglevel=1),    # Uncomment these two lines to see
             # urllib2.HTTPSHandler(debuglevel=1),   # details of the requests/responses
             urllib2.HTTPCookieProcessor(cookie_jar),
         )
-        urllib2.install_opener(opener)
 
         request = urllib2.Request(remote_tile)
-        response = urllib2.urlopen(request)
+        response = opener.open(request)
 
-        fo = open(local_tile, "w+b")
-        fo.write(response.read())
-        fo.close
+        with open(tmp_path, "w+b") as fo:
+            fo.write(response.read())
+        os.rename(tmp_path, path)
         time.sleep(0.5)
     except:
+        grass.try_remove(tmp_path)
         goturl = 0
         pass
 
     return goturl
 
 
+def zero_tile(tile, ndeg, edeg, pid):
+    """Create tile with zeros"""
+    # north
+    if ndeg < -1:
+        tmpn = "%02d:59:59.5S" % (abs(ndeg) - 2)
+    else:
+        tmpn = "%02d:00:00.5N" % (ndeg + 1)
+    # south
+    if ndeg < 1:
+        tmps = "%02d:00:00.5S" % abs(ndeg)
+    else:
+        tmps = "%02d:59:59.5N" % (ndeg - 1)
+    # east
+    if edeg < -1:
+        tmpe = "%03d:59:59.5W" % (abs(edeg) - 2)
+    else:
+        tmpe = "%03d:00:00.5E" % (edeg + 1)
+    # west
+    if edeg < 1:
+        tmpw = "%03d:00:00.5W" % abs(edeg)
+    else:
+        tmpw = "%03d:59:59.5E" % (edeg - 1)
+
+    # tiles are imported in parallel, do not change the current region
+    env = os.environ.copy()
+    env["GRASS_REGION"] = grass.region_env(
+        n=tmpn, s=tmps, e=tmpe, w=tmpw, res="00:00:01"
+    )
+    grass.run_command(
+        "r.mapcalc",
+        expression="%s = 0" % (tile + ".r.in.nasadem.tmp." + str(pid)),
+        quiet=True,
+        env=env,
+    )
+
+
+def patch_tiles(tiles, output):
+    """Patch imported tiles and remove them"""
+    env = os.environ.copy()
+    env["GRASS_REGION"] = grass.region_env(raster=",".join(tiles))
+    grass.run_command(
+        "r.patch", input=",".join(tiles), output=output, quiet=True, env=env
+    )
+    grass.run_command(
+        "g.remove", type="raster", name=",".join(tiles), flags="f", quiet=True
+    )
+
+
 def cleanup():
     if not in_temp:
         return
@@ -370,6 +443,14 @@ def main():
     output = options["output"]
     dozerotile = flags["z"]
     reproj_res = options["resolution"]
+    cache = options["cache"]
+    if cache:
+        cache = os.path.abspath(cache)
+    threads = int(options["threads"])
+    nprocs = int(options["nprocs"])
+    for key, value in (("threads", threads), ("nprocs", nprocs)):
+        if value < 1:
+            grass.fatal(_("Option %s must be greater than 0") % key)
 
     overwrite = grass.overwrite()
 
@@ -395,6 +476,9 @@ def main():
     currdir = os.getcwd()
     pid = os.getpid()
 
+    if cache and not os.path.isdir(cache):
+        os.makedirs(cache)
+
     # change to temporary directory
     os.chdir(tmpdir)
     in_temp = True
@@ -493,14 +577,10 @@ def main():
     cols = abs(east - west)
     ntiles = rows * cols
     grass.message(_("Importing %d NASADEM tiles...") % ntiles, flag="i")
-    counter = 1
 
-    srtmtiles = ""
-    valid_tiles = 0
+    tiles = {}
     for ndeg in range(south, north):
         for edeg in range(west, east):
-            grass.percent(counter, ntiles, 1)
-            counter += 1
             if ndeg < 0:
                 tile = "s"
             else:
@@ -512,59 +592,82 @@ def main():
                 tile = tile + "e"
             tile = tile + "%03d" % abs(edeg)
             grass.debug("Tile: %s" % tile, debug=1)
-
+            tiles[tile] = (ndeg, edeg)
+
+    # tiles are downloaded by a pool of threads, each downloaded tile is
+    # imported by a pool of nprocs import processes and the imported tiles
+    # are patched in groups while the remaining tiles are processed
+    import_dir = local
+    if local is None and cache:
+        import_dir = cache
+    counter = 0
+    valid_tiles = 0
+    demtiles = []
+    imported = []
+    with ThreadPoolExecutor(threads) as download_pool, ThreadPoolExecutor(
+        nprocs
+    ) as import_pool:
+        downloads = {}
+        imports = {}
+        for tile in sorted(tiles):
             if local is None:
-                download_tile(tile, url, pid, nasadem_version, username, password)
-
-            gotit = import_local_tile(tile, local, pid, nasadem_layer)
-            if gotit == 1:
-                grass.verbose(_("Tile %s successfully imported") % tile)
-                valid_tiles += 1
-            elif dozerotile:
-                # create tile with zeros
-                # north
-                if ndeg < -1:
-                    tmpn = "%02d:59:59.5S" % (abs(ndeg) - 2)
-                else:
-                    tmpn = "%02d:00:00.5N" % (ndeg + 1)
-                # south
-                if ndeg < 1:
-                    tmps = "%02d:00:00.5S" % abs(ndeg)
-                else:
-                    tmps = "%02d:59:59.5N" % (ndeg - 1)
-                # east
-                if edeg < -1:
-                    tmpe = "%03d:59:59.5W" % (abs(edeg) - 2)
-                else:
-                    tmpe = "%03d:00:00.5E" % (edeg + 1)
-                # west
-                if edeg < 1:
-                    tmpw = "%03d:00:00.5W" % abs(edeg)
-                else:
-                    tmpw = "%03d:59:59.5E" % (edeg - 1)
-
-                grass.run_command("g.region", n=tmpn, s=tmps, e=tmpe, w=tmpw, res=res)
-                grass.run_command(
-                    "r.mapcalc",
-                    expression="%s = 0" % (tile + ".r.in.nasadem.tmp." + str(pid)),
-                    quiet=True,
+                future = download_pool.submit(
+                    download_tile,
+                    tile,
+                    url,
+                    pid,
+                    nasadem_version,
+                    username,
+                    password,
+                    cache or tmpdir,
                 )
-                grass.run_command("g.region", region=tmpregionname)
-
-    # g.list with sep = comma does not work ???
-    pattern = "*.r.in.nasadem.tmp.%d" % pid
-    demtiles = grass.read_command(
-        "g.list", type="raster", pattern=pattern, sep="newline", quiet=True
-    )
-
-    demtiles = demtiles.splitlines()
-    demtiles = ",".join(demtiles)
+                downloads[future] = tile
+            else:
+                future = import_pool.submit(
+                    import_local_tile, tile, import_dir, pid, nasadem_layer
+                )
+                imports[future] = tile
+        pending = set(downloads) | set(imports)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    tile = downloads[future]
+                    future.result()
+                    future = import_pool.submit(
+                        import_local_tile, tile, import_dir, pid, nasadem_layer
+                    )
+                    imports[future] = tile
+                    pending.add(future)
+                    continue
+
+                tile = imports[future]
+                gotit = future.result()
+                counter += 1
+                grass.percent(counter, ntiles, 1)
+                if gotit == 1:
+                    grass.verbose(_("Tile %s successfully imported") % tile)
+                    valid_tiles += 1
+                elif dozerotile:
+                    zero_tile(tile, tiles[tile][0], tiles[tile][1], pid)
+                else:
+                    continue
+                imported.append(tile + ".r.in.nasadem.tmp." + str(pid))
+                if kv["+proj"] == "longlat" and len(imported) >= PATCH_TILES:
+                    demtiles.append(
+                        "patch%d.r.in.nasadem.tmp.%d" % (len(demtiles), pid)
+                    )
+                    patch_tiles(sorted(imported), demtiles[-1])
+                    imported = []
+
+    demtiles = ",".join(demtiles + sorted(imported))
     grass.debug("'List of Tiles: %s" % demtiles, debug=1)
 
     if valid_tiles == 0:
-        grass.run_command(
-            "g.remove", type="raster", name=str(demtiles), flags="f", quiet=True
-        )
+        if demtiles:
+            grass.run_command(
+                "g.remove", type="raster", name=str(demtiles), flags="f", quiet=True
+            )
         grass.warning(_("No tiles imported"))
         if local is not None:
             grass.fatal(_("Please check if local folder <%s> is correct.") % local)
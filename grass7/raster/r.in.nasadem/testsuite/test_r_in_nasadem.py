@@ -0,0 +1,118 @@
+"""
+Name:      r.in.nasadem test
+Purpose:   Tests download, cache and import of NASADEM tiles
+           using a local HTTP server instead of the USGS server.
+
+Author:    GRASS development team
+Copyright: (C) 2021 by GRASS development team
+Licence:   This program is free software under the GNU General Public
+           License (>=v2). Read the file COPYING that comes with GRASS
+           for details.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import numpy as np
+
+from grass.gunittest.case import TestCase
+from grass.gunittest.main import test
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class TestNASADEM(TestCase):
+    """Import two 1 arcsec tiles crossing the -78 meridian"""
+
+    output = "nasadem_test"
+    version = "NASADEM_HGT.001"
+    tiles = {"n35w079": 100, "n35w078": 200}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.served = os.path.join(cls.tmpdir, "served")
+        cls.cache = os.path.join(cls.tmpdir, "cache")
+        tiles_dir = os.path.join(cls.served, cls.version, "2000.02.11")
+        os.makedirs(tiles_dir)
+        for tile, value in cls.tiles.items():
+            data = np.full((3601, 3601), value, dtype=">i2")
+            path = os.path.join(tiles_dir, "NASADEM_HGT_" + tile + ".zip")
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr(tile + ".hgt", data.tobytes())
+        handler = partial(QuietHandler, directory=cls.served)
+        cls.server = HTTPServer(("127.0.0.1", 0), handler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.url = "http://127.0.0.1:{}".format(cls.server.server_port)
+        cls.use_temp_region()
+        cls.runModule("g.region", n=230000, s=220000, w=690000, e=710000, res=90)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.del_temp_region()
+        shutil.rmtree(cls.tmpdir)
+        cls.runModule("g.remove", flags="f", type="raster", name=cls.output)
+
+    def test_download_cache(self):
+        """Test if tiles are downloaded in parallel and reused from cache"""
+        self.assertModule(
+            "r.in.nasadem",
+            output=self.output,
+            username="user",
+            password="password",
+            url=self.url,
+            cache=self.cache,
+            threads=2,
+            nprocs=2,
+            resolution=90,
+            method="nearest",
+            overwrite=True,
+        )
+        self.assertRasterMinMax(self.output, refmin=100, refmax=200)
+        for tile in self.tiles:
+            self.assertFileExists(
+                os.path.join(self.cache, "NASADEM_HGT_" + tile + ".zip")
+            )
+
+        # tiles are not available anymore, but found in the cache
+        self.assertModule(
+            "r.in.nasadem",
+            output=self.output,
+            username="user",
+            password="password",
+            url=self.url + "/missing",
+            cache=self.cache,
+            resolution=90,
+            method="nearest",
+            overwrite=True,
+        )
+        self.assertRasterMinMax(self.output, refmin=100, refmax=200)
+
+    def test_invalid_nprocs(self):
+        """Test if pool sizes below 1 are rejected"""
+        for key in ("threads", "nprocs"):
+            self.assertModuleFail(
+                "r.in.nasadem",
+                output=self.output,
+                username="user",
+                password="password",
+                url=self.url,
+                resolution=90,
+                overwrite=True,
+                **{key: 0}
+            )
+
+
+if __name__ == "__main__":
+    test()
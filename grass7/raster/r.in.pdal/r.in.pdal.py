@@ -154,17 +154,27 @@
 #%end
 
 import os
-import sys
 
 import grass.script as grass
 import json
 import time
 
+import numpy as np
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
 # i18N
 import gettext
 
 gettext.install("grassmods", os.path.join(os.getenv("GISBASE"), "locale"))
 
+CNULL = -2147483648  # null value for CELL maps
+CHUNK_BYTES = 64 * 1024 * 1024  # size of the text read from PDAL at once
+CHUNK_POINTS = 4 * 1024 * 1024  # number of points read from the spool file
+# methods which need all values of a cell
+ORDER_METHODS = ("median", "percentile", "skewness", "trimmean")
+
 
 def footprint_to_vectormap(infile, footprint):
     """The function generates a footprint as vectormap of the input las-file.
@@ -331,6 +341,282 @@ def scan_extent(infile):
     return n, s, w, e, t, b
 
 
+def set_region(region):
+    """Set the raster region of the current process
+
+    Args:
+        region(dict): Region as returned by grass.script.region()
+    """
+    reg = Region()
+    reg.north = region["n"]
+    reg.south = region["s"]
+    reg.east = region["e"]
+    reg.west = region["w"]
+    reg.nsres = region["nsres"]
+    reg.ewres = region["ewres"]
+    reg.adjust()
+    reg.set_raster_region()
+
+
+def pdal_points(command, spool=None):
+    """Generator of the points written as text by a PDAL pipeline, in chunks
+    of x, y, z arrays. The chunks are appended in binary form to the spool
+    file if given.
+
+    Args:
+        command(list): PDAL pipeline command writing X,Y,Z to stdout
+        spool(file): Binary file to write the chunks to
+    """
+    proc = grass.Popen(command, stdout=grass.PIPE)
+    # skip header
+    proc.stdout.readline()
+    while True:
+        lines = proc.stdout.readlines(CHUNK_BYTES)
+        if not lines:
+            break
+        values = b",".join(line.strip() for line in lines if line.strip())
+        chunk = np.array(values.split(b","), dtype=np.float64).reshape(-1, 3)
+        if spool:
+            chunk.tofile(spool)
+        yield chunk
+    if proc.wait() != 0:
+        grass.fatal(_("pdal pipeline is broken..."))
+
+
+def spooled_points(spool):
+    """Generator of the points of a spool file written by pdal_points
+
+    Args:
+        spool(string): Name of the spool file
+    """
+    with open(spool, "rb") as f:
+        while True:
+            chunk = np.fromfile(f, dtype=np.float64, count=CHUNK_POINTS * 3)
+            if not chunk.size:
+                break
+            yield chunk.reshape(-1, 3)
+
+
+def bin_points(chunks, region, first, last, zrange, zscale, keep_values):
+    """Accumulate the statistics of the points falling in the rows from
+    first to last (excluded) of the region
+
+    Args:
+        chunks: Iterable of x, y, z point arrays
+        region(dict): Region as returned by grass.script.region()
+        first(int): First row of the band
+        last(int): Row following the last row of the band
+        zrange(tuple): Minimum and maximum z value or None
+        zscale(float): Scale to apply to z values
+        keep_values(bool): Keep the cell index and z value of all points
+
+    Returns:
+        dict: Arrays of the per-cell count, sum, sum of squares, minimum and
+        maximum, and if keep_values the cell index and z of the points
+    """
+    ncells = (last - first) * region["cols"]
+    acc = {
+        "n": np.zeros(ncells, dtype=np.int64),
+        "sum": np.zeros(ncells),
+        "sumsq": np.zeros(ncells),
+        "min": np.full(ncells, np.inf),
+        "max": np.full(ncells, -np.inf),
+    }
+    cells = []
+    values = []
+    for chunk in chunks:
+        x = chunk[:, 0]
+        y = chunk[:, 1]
+        z = chunk[:, 2] * zscale
+        inside = (y > region["s"]) & (y <= region["n"])
+        inside &= (x >= region["w"]) & (x < region["e"])
+        if zrange:
+            inside &= (z >= zrange[0]) & (z <= zrange[1])
+        row = np.floor((region["n"] - y[inside]) / region["nsres"]).astype(np.int64)
+        col = np.floor((x[inside] - region["w"]) / region["ewres"]).astype(np.int64)
+        z = z[inside]
+        # guard against rounding at the south and east edges
+        row = np.minimum(row, region["rows"] - 1)
+        col = np.minimum(col, region["cols"] - 1)
+        band = (row >= first) & (row < last)
+        cell = (row[band] - first) * region["cols"] + col[band]
+        z = z[band]
+        acc["n"] += np.bincount(cell, minlength=ncells)
+        acc["sum"] += np.bincount(cell, weights=z, minlength=ncells)
+        acc["sumsq"] += np.bincount(cell, weights=z * z, minlength=ncells)
+        np.minimum.at(acc["min"], cell, z)
+        np.maximum.at(acc["max"], cell, z)
+        if keep_values:
+            cells.append(cell)
+            values.append(z)
+    if keep_values:
+        acc["cell"] = np.concatenate(cells) if cells else np.empty(0, np.int64)
+        acc["z"] = np.concatenate(values) if values else np.empty(0)
+    return acc
+
+
+def cell_statistics(acc, methods, pth, trim):
+    """Compute the per-cell statistics as r.in.xyz does
+
+    Args:
+        acc(dict): Accumulators as returned by bin_points
+        methods(list): Statistics to compute
+        pth(int): Percentile for the percentile method
+        trim(float): Percent of values discarded on both ends for trimmean
+
+    Returns:
+        dict: Array of each method, NaN for empty cells
+    """
+    n = acc["n"]
+    empty = n == 0
+    stats = {"n": n}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = acc["sum"] / n
+        variance = (acc["sumsq"] - acc["sum"] * acc["sum"] / n) / n
+        variance[variance < 1e-15] = 0.0
+        stddev = np.sqrt(variance)
+        stats["min"] = np.where(empty, np.nan, acc["min"])
+        stats["max"] = np.where(empty, np.nan, acc["max"])
+        stats["range"] = stats["max"] - stats["min"]
+        stats["sum"] = np.where(empty, np.nan, acc["sum"])
+        stats["mean"] = mean
+        stats["variance"] = variance
+        stats["stddev"] = stddev
+        stats["coeff_var"] = 100.0 * stddev / mean
+
+        if not any(method in ORDER_METHODS for method in methods):
+            return stats
+
+        # sort the values by cell, then by value
+        order = np.lexsort((acc["z"], acc["cell"]))
+        # padded so that empty cells at the end have a valid index
+        z = np.append(acc["z"][order], np.nan)
+        start = np.concatenate(([0], np.cumsum(n)[:-1]))
+        last = np.maximum(start + n - 1, 0)
+        half = np.minimum(start + n // 2, last)
+        stats["median"] = np.where(
+            n % 2, z[half], (z[np.maximum(half - 1, 0)] + z[half]) / 2.0
+        )
+        if pth:
+            # rank of the pth percentile as in r.in.xyz
+            rank = np.floor(pth * n / 100.0).astype(np.int64)
+            stats["percentile"] = z[start + np.clip(rank, 0, np.maximum(n - 1, 0))]
+        if trim:
+            k = np.floor(n * trim / 100.0 + 0.5).astype(np.int64)
+            csum = np.concatenate(([0.0], np.cumsum(z)))
+            kept = n - 2 * k
+            trimmed = (csum[start + n - k] - csum[start + k]) / kept
+            stats["trimmean"] = np.where(kept > 0, trimmed, np.nan)
+        dev3 = np.bincount(
+            acc["cell"],
+            weights=(acc["z"] - mean[acc["cell"]]) ** 3,
+            minlength=n.size,
+        )
+        stats["skewness"] = dev3 / ((n - 1) * stddev**3)
+
+    for method in stats:
+        if method != "n":
+            stats[method] = np.where(empty, np.nan, stats[method])
+    return stats
+
+
+def write_band(rasters, stats, ncols):
+    """Write the rows of a band of the statistics to the output maps
+
+    Args:
+        rasters(list): Tuples of open RasterRow, Buffer and method
+        stats(dict): Arrays as returned by cell_statistics
+        ncols(int): Number of columns of the region
+    """
+    for rast, newrow, method in rasters:
+        values = stats[method].reshape(-1, ncols)
+        if rast.mtype == "CELL":
+            values = np.where(np.isnan(values), CNULL, values)
+        for row in values:
+            newrow[:] = row
+            rast.put_row(newrow)
+
+
+def import_points(
+    command, methods, outfiles, output_type, zrange, zscale, percent, pth, trim
+):
+    """Bin the points of a PDAL pipeline into raster maps, computing all
+    statistics in one pass over the points
+
+    The region is processed in bands of rows holding the given percent of
+    the map. If several bands are needed, the points are kept in a binary
+    spool file after the first pass instead of running the pipeline again.
+
+    Args:
+        command(list): PDAL pipeline command writing X,Y,Z to stdout
+        methods(list): Statistics to compute
+        outfiles(list): Names of the output maps, one per method
+        output_type(string): Type of the output maps except for n
+        zrange(tuple): Minimum and maximum z value or None
+        zscale(float): Scale to apply to z values
+        percent(int): Percent of the map to keep in memory
+        pth(int): Percentile for the percentile method
+        trim(float): Percent of values discarded on both ends for trimmean
+    """
+    region = grass.region()
+    set_region(region)
+    nrows, ncols = region["rows"], region["cols"]
+    band_rows = max(1, int(np.ceil(nrows * percent / 100.0)))
+    keep_values = any(method in ORDER_METHODS for method in methods)
+
+    spool = None
+    rasters = []
+    try:
+        for method, outfile in zip(methods, outfiles):
+            mtype = "CELL" if method == "n" else output_type
+            rast = RasterRow(outfile, mode="w", mtype=mtype, overwrite=True)
+            rast.open()
+            rasters.append((rast, Buffer((ncols,), mtype=mtype), method))
+
+        for first in range(0, nrows, band_rows):
+            last = min(first + band_rows, nrows)
+            if first == 0:
+                if last < nrows:
+                    spool = grass.tempfile()
+                    with open(spool, "wb") as f:
+                        acc = bin_points(
+                            pdal_points(command, f),
+                            region,
+                            first,
+                            last,
+                            zrange,
+                            zscale,
+                            keep_values,
+                        )
+                else:
+                    acc = bin_points(
+                        pdal_points(command),
+                        region,
+                        first,
+                        last,
+                        zrange,
+                        zscale,
+                        keep_values,
+                    )
+            else:
+                acc = bin_points(
+                    spooled_points(spool),
+                    region,
+                    first,
+                    last,
+                    zrange,
+                    zscale,
+                    keep_values,
+                )
+            write_band(rasters, cell_statistics(acc, methods, pth, trim), ncols)
+            grass.percent(last, nrows, 1)
+    finally:
+        for rast, newrow, method in rasters:
+            rast.close()
+        if spool:
+            os.remove(spool)
+
+
 def main():
     # parameters
     infile = options["input"]
@@ -357,16 +643,14 @@ def main():
                 % (outfiles, methods)
             )
         )
+    if "percentile" in methods.split(",") and not pth:
+        grass.fatal(_("The pth option is required for the percentile method"))
+    if "trimmean" in methods.split(",") and not trim:
+        grass.fatal(_("The trim option is required for the trimmean method"))
 
     # overwrite auf true setzen
     os.environ["GRASS_OVERWRITE"] = "1"
 
-    # to hide non-error messages from subprocesses
-    if grass.verbosity() <= 2:
-        outdev = open(os.devnull, "w")
-    else:
-        outdev = sys.stdout
-
     # use temporary region
     grass.use_temp_region()
 
@@ -444,9 +728,6 @@ def main():
         with open(tmp_file_json, "w") as f:
             json.dump(data, f)
 
-        tmp_xyz = grass.tempfile()
-        if tmp_xyz is None:
-            grass.fatal("Unable to create temporary files")
         command_pdal1 = options["pdal_cmd"].split(" ")
         if options["pdal_cmd"] != "pdal":
             v_index = None
@@ -461,48 +742,20 @@ def main():
             tmp_file_json2 = tmp_file_json
         command_pdal1.extend(["pipeline", "--input", tmp_file_json2])
 
-        fh = open(tmp_xyz, "wb")
-        if grass.call(command_pdal1, stdout=fh) != 0:
-            fh.close()
-            # check to see if pdal pipeline executed properly
-            print(command_pdal1)
-            grass.fatal(_("pdal pipeline is broken..."))
-        else:
-            fh.close()
-
-        for i in range(len(methods.split(","))):
-            method = methods.split(",")[i]
-            outfile = outfiles.split(",")[i]
-
-            grass.message(_("Generating output raster map <%s>...") % outfile)
-
-            command_pdal2 = [
-                "r.in.xyz",
-                "input=" + tmp_xyz,
-                "output=" + outfile,
-                "skip=1",
-                "separator=comma",
-                "method=" + method,
-            ]
-
-            if zrange:
-                command_pdal2.append("zrange=" + zrange)
-            if zscale:
-                command_pdal2.append("zscale=" + zscale)
-            if output_type:
-                command_pdal2.append("type=" + output_type)
-            if percent:
-                command_pdal2.append("percent=" + percent)
-            if pth:
-                command_pdal2.append("pth=" + pth)
-            if trim:
-                command_pdal2.append("trim=" + trim)
-
-            if grass.call(command_pdal2, stdout=outdev) != 0:
-                # check to see if r.in.xyz executed properly
-                os.remove(tmp_xyz)
-                grass.fatal(_("r.in.xyz is broken..."))
+        grass.message(_("Generating output raster maps <%s>...") % outfiles)
+        import_points(
+            command_pdal1,
+            methods.split(","),
+            outfiles.split(","),
+            output_type,
+            [float(z) for z in zrange.split(",")] if zrange else None,
+            float(zscale) if zscale else 1.0,
+            int(percent) if percent else 100,
+            int(pth) if pth else None,
+            float(trim) if trim else None,
+        )
 
+        for outfile in outfiles.split(","):
             # metadata
             empty_history = grass.tempfile()
             if empty_history is None:
@@ -533,7 +786,6 @@ def main():
                 quiet=True,
             )
         os.remove(tmp_file_json)
-        os.remove(tmp_xyz)
         grass.del_temp_region()
 
 
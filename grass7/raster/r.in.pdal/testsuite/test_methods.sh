@@ -0,0 +1,56 @@
+#!/usr/bin/env bash
+
+set -e
+set -x
+
+basename="test_rinpdal_methods_"
+
+g.region n=20 s=10 e=30 w=20 res=2.5
+
+echo "All statistics computed in one pass should match r.in.xyz"
+
+methods="n min max range sum mean stddev median"
+outputs=""
+for method in $methods; do
+    r.in.xyz data/points.txt output=${basename}xyz_${method} x=1 y=2 z=3 \
+        separator=comma method=${method} type=DCELL
+    outputs="${outputs},${basename}pdal_${method}"
+done
+
+g.region align=${basename}xyz_n
+r.in.pdal input=data/points.las output=${outputs#,} \
+    method=$(echo $methods | tr ' ' ',') type=DCELL resolution=2.5
+
+for method in $methods; do
+    r.mapcalc "${basename}diff = abs(${basename}pdal_${method} - ${basename}xyz_${method})" \
+        --overwrite
+    echo "Maximum difference for ${method} should be zero"
+    r.univar ${basename}diff -g | grep -e "^max=0$"
+done
+
+echo "Order statistics should match r.in.xyz"
+
+methods="percentile trimmean skewness"
+outputs=""
+for method in $methods; do
+    r.in.xyz data/points.txt output=${basename}xyz_${method} x=1 y=2 z=3 \
+        separator=comma method=${method} type=DCELL pth=25 trim=10
+    outputs="${outputs},${basename}pdal_${method}"
+done
+
+r.in.pdal input=data/points.las output=${outputs#,} \
+    method=$(echo $methods | tr ' ' ',') type=DCELL resolution=2.5 \
+    pth=25 trim=10
+
+for method in $methods; do
+    r.mapcalc "${basename}diff = abs(${basename}pdal_${method} - ${basename}xyz_${method})" \
+        --overwrite
+    echo "Maximum difference for ${method} should be below 1e-9"
+    eval $(r.univar ${basename}diff -g | grep -e "^max=")
+    awk -v max=$max 'BEGIN { exit !(max < 1e-9) }'
+done
+
+echo "Test successful
+When running manually maps can be now removed with:
+  g.remove type=rast pattern='test_rinpdal_methods_*' -f
+However, the region was changed to whatever the test needed."
@@ -82,6 +82,22 @@
 #% description: Resolution of output raster map (required if location projection not longlat)
 #% guisection: Output
 #%end
+#%option G_OPT_M_DIR
+#% key: cache
+#% label: Directory for caching downloaded SRTM tiles
+#% description: Tiles found in this directory are not downloaded again
+#% required: no
+#%end
+#%option
+#% key: threads
+#% type: integer
+#% description: Number of tiles downloaded in parallel
+#% answer: 4
+#% required: no
+#%end
+#%option G_OPT_M_NPROCS
+#% description: Number of tiles imported in parallel
+#%end
 #%flag
 #%  key: n
 #%  description: Fill null cells
@@ -122,6 +138,7 @@ import os
 import atexit
 import numpy as np
 import subprocess
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from six.moves.urllib import request as urllib2
 
 try:
@@ -132,16 +149,21 @@ import time
 import grass.script as grass
 from grass.exceptions import CalledModuleError
 
+# number of imported tiles which are patched together while importing
+PATCH_TILES = 100
 
-def import_local_tile(tile, local, pid, srtmv3, one):
-    output = tile + ".r.in.srtm.tmp." + str(pid)
+
+def tile_file(tile, srtmv3, one):
     if srtmv3:
         if one:
-            local_tile = str(tile) + ".SRTMGL1.hgt.zip"
-        else:
-            local_tile = str(tile) + ".SRTMGL3.hgt.zip"
-    else:
-        local_tile = str(tile) + ".hgt.zip"
+            return str(tile) + ".SRTMGL1.hgt.zip"
+        return str(tile) + ".SRTMGL3.hgt.zip"
+    return str(tile) + ".hgt.zip"
+
+
+def import_local_tile(tile, local, pid, srtmv3, one):
+    output = tile + ".r.in.srtm.tmp." + str(pid)
+    local_tile = tile_file(tile, srtmv3, one)
 
     path = os.path.join(local, local_tile)
     if os.path.exists(path):
@@ -178,81 +200,126 @@ def import_local_tile(tile, local, pid, srtmv3, one):
     return 0
 
 
-def download_tile(tile, url, pid, srtmv3, one, username, password):
+def download_tile(tile, url, pid, srtmv3, one, username, password, directory):
 
     grass.debug("Download tile: %s" % tile, debug=1)
-    output = tile + ".r.in.srtm.tmp." + str(pid)
-    if srtmv3:
-        if one:
-            local_tile = str(tile) + ".SRTMGL1.hgt.zip"
-        else:
-            local_tile = str(tile) + ".SRTMGL3.hgt.zip"
-    else:
-        local_tile = str(tile) + ".hgt.zip"
-
-    urllib2.urlcleanup()
+    local_tile = tile_file(tile, srtmv3, one)
+    path = os.path.join(directory, local_tile)
+    if os.path.exists(path):
+        grass.verbose(_("Tile %s found in <%s>") % (tile, directory))
+        return 1
 
     if srtmv3:
-        remote_tile = str(url) + local_tile
-        goturl = 1
-
-        try:
-            password_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-            password_manager.add_password(
-                None, "https://urs.earthdata.nasa.gov", username, password
-            )
-
-            cookie_jar = CookieJar()
-
-            opener = urllib2.build_opener(
-                urllib2.HTTPBasicAuthHandler(password_manager),
-                # urllib2.HTTPHandler(debuglevel=1),    # Uncomment these two lines to see
-                # urllib2.HTTPSHandler(debuglevel=1),   # details of the requests/responses
-                urllib2.HTTPCookieProcessor(cookie_jar),
+        remote_tiles = [str(url) + local_tile]
+    else:
+        # SRTM subdirs: Africa, Australia, Eurasia, Islands, North_America, South_America
+        remote_tiles = [
+            str(url) + str(srtmdir) + "/" + local_tile
+            for srtmdir in (
+                "Africa",
+                "Australia",
+                "Eurasia",
+                "Islands",
+                "North_America",
+                "South_America",
             )
-            urllib2.install_opener(opener)
+        ]
 
-            request = urllib2.Request(remote_tile)
-            response = urllib2.urlopen(request)
+    password_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
+    password_manager.add_password(
+        None, "https://urs.earthdata.nasa.gov", username, password
+    )
+    cookie_jar = CookieJar()
+    # own opener for each download, the installed opener is shared by all threads
+    opener = urllib2.build_opener(
+        urllib2.HTTPBasicAuthHandler(password_manager),
+        # urllib2.HTTPHandler(debuglevel=1),    # Uncomment these two lines to see
+        # urllib2.HTTPSHandler(debuglevel=1),   # details of the requests/responses
+        urllib2.HTTPCookieProcessor(cookie_jar),
+    )
 
-            fo = open(local_tile, "w+b")
-            fo.write(response.read())
-            fo.close
+    # write to temporary file so that incomplete downloads are not cached
+    tmp_path = path + ".tmp." + str(pid)
+    for remote_tile in remote_tiles:
+        try:
+            response = opener.open(urllib2.Request(remote_tile))
+            with open(tmp_path, "w+b") as fo:
+                fo.write(response.read())
+            os.rename(tmp_path, path)
             time.sleep(0.5)
-        except:
-            goturl = 0
-            pass
+            return 1
+        except Exception:
+            grass.try_remove(tmp_path)
 
-        return goturl
+    return 0
 
-    # SRTM subdirs: Africa, Australia, Eurasia, Islands, North_America, South_America
-    for srtmdir in (
-        "Africa",
-        "Australia",
-        "Eurasia",
-        "Islands",
-        "North_America",
-        "South_America",
-    ):
-        remote_tile = str(url) + str(srtmdir) + "/" + local_tile
-        goturl = 1
 
-        try:
-            response = urllib2.urlopen(request)
-            fo = open(local_tile, "w+b")
-            fo.write(response.read())
-            fo.close
-            time.sleep(0.5)
-            # does not work:
-            # urllib.urlretrieve(remote_tile, local_tile, data = None)
-        except:
-            goturl = 0
-            pass
+def zero_tile(tile, ndeg, edeg, one, res, pid):
+    """Create tile with zeros"""
+    if one:
+        # north
+        if ndeg < -1:
+            tmpn = "%02d:59:59.5S" % (abs(ndeg) - 2)
+        else:
+            tmpn = "%02d:00:00.5N" % (ndeg + 1)
+        # south
+        if ndeg < 1:
+            tmps = "%02d:00:00.5S" % abs(ndeg)
+        else:
+            tmps = "%02d:59:59.5N" % (ndeg - 1)
+        # east
+        if edeg < -1:
+            tmpe = "%03d:59:59.5W" % (abs(edeg) - 2)
+        else:
+            tmpe = "%03d:00:00.5E" % (edeg + 1)
+        # west
+        if edeg < 1:
+            tmpw = "%03d:00:00.5W" % abs(edeg)
+        else:
+            tmpw = "%03d:59:59.5E" % (edeg - 1)
+    else:
+        # north
+        if ndeg < -1:
+            tmpn = "%02d:59:58.5S" % (abs(ndeg) - 2)
+        else:
+            tmpn = "%02d:00:01.5N" % (ndeg + 1)
+        # south
+        if ndeg < 1:
+            tmps = "%02d:00:01.5S" % abs(ndeg)
+        else:
+            tmps = "%02d:59:58.5N" % (ndeg - 1)
+        # east
+        if edeg < -1:
+            tmpe = "%03d:59:58.5W" % (abs(edeg) - 2)
+        else:
+            tmpe = "%03d:00:01.5E" % (edeg + 1)
+        # west
+        if edeg < 1:
+            tmpw = "%03d:00:01.5W" % abs(edeg)
+        else:
+            tmpw = "%03d:59:58.5E" % (edeg - 1)
 
-        if goturl == 1:
-            return 1
+    # tiles are imported in parallel, do not change the current region
+    env = os.environ.copy()
+    env["GRASS_REGION"] = grass.region_env(n=tmpn, s=tmps, e=tmpe, w=tmpw, res=res)
+    grass.run_command(
+        "r.mapcalc",
+        expression="%s = 0" % (tile + ".r.in.srtm.tmp." + str(pid)),
+        quiet=True,
+        env=env,
+    )
 
-    return 0
+
+def patch_tiles(tiles, output):
+    """Patch imported tiles and remove them"""
+    env = os.environ.copy()
+    env["GRASS_REGION"] = grass.region_env(raster=",".join(tiles))
+    grass.run_command(
+        "r.patch", input=",".join(tiles), output=output, quiet=True, env=env
+    )
+    grass.run_command(
+        "g.remove", type="raster", name=",".join(tiles), flags="f", quiet=True
+    )
 
 
 def cleanup():
@@ -321,6 +388,14 @@ def main():
     one = flags["1"]
     dozerotile = flags["z"]
     reproj_res = options["resolution"]
+    cache = options["cache"]
+    if cache:
+        cache = os.path.abspath(cache)
+    threads = int(options["threads"])
+    nprocs = int(options["nprocs"])
+    for key, value in (("threads", threads), ("nprocs", nprocs)):
+        if value < 1:
+            grass.fatal(_("Option %s must be greater than 0") % key)
 
     overwrite = grass.overwrite()
 
@@ -369,6 +444,10 @@ def main():
     in_temp = True
     if local is None:
         local = tmpdir
+    if not cache:
+        cache = tmpdir
+    elif not os.path.isdir(cache):
+        os.makedirs(cache)
 
     # save region
     tmpregionname = "r_in_srtm_tmp_region"
@@ -455,14 +534,10 @@ def main():
     cols = abs(east - west)
     ntiles = rows * cols
     grass.message(_("Importing %d SRTM tiles...") % ntiles, flag="i")
-    counter = 1
 
-    srtmtiles = ""
-    valid_tiles = 0
+    tiles = {}
     for ndeg in range(south, north):
         for edeg in range(west, east):
-            grass.percent(counter, ntiles, 1)
-            counter += 1
             if ndeg < 0:
                 tile = "S"
             else:
@@ -474,83 +549,82 @@ def main():
                 tile = tile + "E"
             tile = tile + "%03d" % abs(edeg)
             grass.debug("Tile: %s" % tile, debug=1)
+            tiles[tile] = (ndeg, edeg)
 
-            if local != tmpdir:
-                gotit = import_local_tile(tile, local, pid, srtmv3, one)
-            else:
-                gotit = download_tile(tile, url, pid, srtmv3, one, username, password)
+    # tiles are downloaded by a pool of threads, each downloaded tile is
+    # imported by a pool of nprocs import processes and the imported tiles
+    # are patched in groups while the remaining tiles are processed
+    counter = 0
+    valid_tiles = 0
+    srtmtiles = []
+    imported = []
+    with ThreadPoolExecutor(threads) as download_pool, ThreadPoolExecutor(
+        nprocs
+    ) as import_pool:
+        downloads = {}
+        imports = {}
+        if local != tmpdir:
+            for tile in sorted(tiles):
+                future = import_pool.submit(
+                    import_local_tile, tile, local, pid, srtmv3, one
+                )
+                imports[future] = tile
+        else:
+            for tile in sorted(tiles):
+                future = download_pool.submit(
+                    download_tile,
+                    tile,
+                    url,
+                    pid,
+                    srtmv3,
+                    one,
+                    username,
+                    password,
+                    cache,
+                )
+                downloads[future] = tile
+        pending = set(downloads) | set(imports)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    tile = downloads[future]
+                    if future.result() == 1:
+                        future = import_pool.submit(
+                            import_local_tile, tile, cache, pid, srtmv3, one
+                        )
+                        imports[future] = tile
+                        pending.add(future)
+                        continue
+                    gotit = 0
+                else:
+                    tile = imports[future]
+                    gotit = future.result()
+
+                counter += 1
+                grass.percent(counter, ntiles, 1)
                 if gotit == 1:
-                    gotit = import_local_tile(tile, tmpdir, pid, srtmv3, one)
-            if gotit == 1:
-                grass.verbose(_("Tile %s successfully imported") % tile)
-                valid_tiles += 1
-            elif dozerotile:
-                # create tile with zeros
-                if one:
-                    # north
-                    if ndeg < -1:
-                        tmpn = "%02d:59:59.5S" % (abs(ndeg) - 2)
-                    else:
-                        tmpn = "%02d:00:00.5N" % (ndeg + 1)
-                    # south
-                    if ndeg < 1:
-                        tmps = "%02d:00:00.5S" % abs(ndeg)
-                    else:
-                        tmps = "%02d:59:59.5N" % (ndeg - 1)
-                    # east
-                    if edeg < -1:
-                        tmpe = "%03d:59:59.5W" % (abs(edeg) - 2)
-                    else:
-                        tmpe = "%03d:00:00.5E" % (edeg + 1)
-                    # west
-                    if edeg < 1:
-                        tmpw = "%03d:00:00.5W" % abs(edeg)
-                    else:
-                        tmpw = "%03d:59:59.5E" % (edeg - 1)
+                    grass.verbose(_("Tile %s successfully imported") % tile)
+                    valid_tiles += 1
+                elif dozerotile:
+                    zero_tile(tile, tiles[tile][0], tiles[tile][1], one, res, pid)
                 else:
-                    # north
-                    if ndeg < -1:
-                        tmpn = "%02d:59:58.5S" % (abs(ndeg) - 2)
-                    else:
-                        tmpn = "%02d:00:01.5N" % (ndeg + 1)
-                    # south
-                    if ndeg < 1:
-                        tmps = "%02d:00:01.5S" % abs(ndeg)
-                    else:
-                        tmps = "%02d:59:58.5N" % (ndeg - 1)
-                    # east
-                    if edeg < -1:
-                        tmpe = "%03d:59:58.5W" % (abs(edeg) - 2)
-                    else:
-                        tmpe = "%03d:00:01.5E" % (edeg + 1)
-                    # west
-                    if edeg < 1:
-                        tmpw = "%03d:00:01.5W" % abs(edeg)
-                    else:
-                        tmpw = "%03d:59:58.5E" % (edeg - 1)
-
-                grass.run_command("g.region", n=tmpn, s=tmps, e=tmpe, w=tmpw, res=res)
-                grass.run_command(
-                    "r.mapcalc",
-                    expression="%s = 0" % (tile + ".r.in.srtm.tmp." + str(pid)),
-                    quiet=True,
-                )
-                grass.run_command("g.region", region=tmpregionname)
+                    continue
+                imported.append(tile + ".r.in.srtm.tmp." + str(pid))
+                if kv["+proj"] == "longlat" and len(imported) >= PATCH_TILES:
+                    srtmtiles.append("patch%d.r.in.srtm.tmp.%d" % (len(srtmtiles), pid))
+                    patch_tiles(sorted(imported), srtmtiles[-1])
+                    imported = []
 
-    # g.list with sep = comma does not work ???
     pattern = "*.r.in.srtm.tmp.%d" % pid
-    srtmtiles = grass.read_command(
-        "g.list", type="raster", pattern=pattern, sep="newline", quiet=True
-    )
-
-    srtmtiles = srtmtiles.splitlines()
-    srtmtiles = ",".join(srtmtiles)
+    srtmtiles = ",".join(srtmtiles + sorted(imported))
     grass.debug("'List of Tiles: %s" % srtmtiles, debug=1)
 
     if valid_tiles == 0:
-        grass.run_command(
-            "g.remove", type="raster", name=str(srtmtiles), flags="f", quiet=True
-        )
+        if srtmtiles:
+            grass.run_command(
+                "g.remove", type="raster", name=str(srtmtiles), flags="f", quiet=True
+            )
         grass.warning(_("No tiles imported"))
         if local != tmpdir:
             grass.fatal(_("Please check if local folder <%s> is correct.") % local)
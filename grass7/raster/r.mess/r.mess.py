@@ -107,6 +107,17 @@
 #% guisection: Output
 #%end
 
+#%flag
+#% key: s
+#% label: Compute all output layers in a single pass
+#% description: Reference distributions are built from streamed histograms and all layers are computed in one pass over the projection layers
+#%end
+
+#%option G_OPT_M_NPROCS
+#% description: Number of parallel processes (only used with the -s flag)
+#% answer: 1
+#%end
+
 # import libraries
 import os
 import sys
@@ -116,8 +127,13 @@ import atexit
 import tempfile
 import operator
 import string
+from multiprocessing import Pool
 import grass.script as gs
 from grass.script import db as db
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+import grass.lib.raster as libraster
 
 # for Python 3 compatibility
 try:
@@ -136,6 +152,9 @@ RECL_MESNEG = """\
 1\tnovel conditions
 """
 
+CNULL = -2147483648  # null value for CELL maps
+BLOCK_ROWS = 256  # number of rows read at once by the single-pass engine
+
 # ----------------------------------------------------------------------------
 # Functions
 # ----------------------------------------------------------------------------
@@ -190,6 +209,268 @@ def compute_ies(INtmprule, INipi, INtmpf2, INenvmin, INenvmax):
     gs.write_command("r.colors", map=INipi, rules="-", stdin=COLORS_MES, quiet=True)
 
 
+# ----------------------------------------------------------------------------
+# Single-pass engine
+# ----------------------------------------------------------------------------
+
+# reference frequency tables, set in the worker processes
+TABLES = None
+
+
+def set_region(region):
+    """Set the raster region of the current process
+
+    :param dict region: region as returned by grass.script.region()
+    """
+    reg = Region()
+    reg.north = region["n"]
+    reg.south = region["s"]
+    reg.east = region["e"]
+    reg.west = region["w"]
+    reg.nsres = region["nsres"]
+    reg.ewres = region["ewres"]
+    reg.adjust()
+    reg.set_raster_region()
+
+
+def read_rows(name, start, end):
+    """Read rows from start to end (excluded) as a float array, NaN for nulls"""
+    with RasterRow(name) as rast:
+        rows = np.array([rast[row] for row in xrange(start, end)], dtype=np.float64)
+        if rast.mtype == "CELL":
+            rows[rows == CNULL] = np.nan
+    return rows
+
+
+def read_points(vector, region):
+    """Return the row and column of the points of a vector map in the region,
+    and the total number of points
+    """
+    lines = gs.read_command(
+        "v.out.ascii", input=vector, type="point", format="point", separator="|"
+    ).splitlines()
+    coords = np.array([line.split("|")[:2] for line in lines if line], dtype=float)
+    coords = coords.reshape(-1, 2)
+    rows = np.floor((region["n"] - coords[:, 1]) / region["nsres"]).astype(int)
+    cols = np.floor((coords[:, 0] - region["w"]) / region["ewres"]).astype(int)
+    inside = (rows >= 0) & (rows < region["rows"]) & (cols >= 0)
+    inside &= cols < region["cols"]
+    return rows[inside], cols[inside], len(coords)
+
+
+def reference_samples(layer, reference, points, region):
+    """Yield the values of a reference variable in blocks
+
+    Non-zero cells of the reference map are used, or all cells with a
+    value in the first environmental layer if no reference map is given.
+    With reference points, the values at the points are read instead.
+    """
+    if points is not None:
+        rows, cols = points
+        samples = np.full(rows.size, np.nan)
+        with RasterRow(layer) as rast:
+            for row in np.unique(rows):
+                values = np.array(rast[int(row)], dtype=np.float64)
+                if rast.mtype == "CELL":
+                    values[values == CNULL] = np.nan
+                sel = rows == row
+                samples[sel] = values[cols[sel]]
+        yield samples
+        return
+    name, presence = reference
+    for start in xrange(0, region["rows"], BLOCK_ROWS):
+        end = min(start + BLOCK_ROWS, region["rows"])
+        ref = read_rows(name, start, end)
+        if presence:
+            # as the mask, any non-zero cell with a value is a reference cell
+            sel = (ref != 0) & ~np.isnan(ref)
+        else:
+            sel = ~np.isnan(ref)
+        yield read_rows(layer, start, end)[sel]
+
+
+def reference_table(args):
+    """Compute the frequency table of the scaled values of a reference
+    variable with a histogram updated block by block
+
+    Returns the sorted distinct values, their cumulative frequency in
+    percent and the number of samples without value.
+    """
+    layer, reference, points, region, digits2 = args
+    set_region(region)
+    values = np.empty(0)
+    counts = np.empty(0)
+    missing = 0
+    for samples in reference_samples(layer, reference, points, region):
+        valid = ~np.isnan(samples)
+        missing += samples.size - valid.sum()
+        block, block_counts = np.unique(
+            np.trunc(samples[valid] * digits2), return_counts=True
+        )
+        values, inverse = np.unique(
+            np.concatenate((values, block)), return_inverse=True
+        )
+        counts = np.bincount(
+            inverse.ravel(), weights=np.concatenate((counts, block_counts))
+        )
+    return values, np.cumsum(counts) / np.sum(counts) * 100, missing
+
+
+def similarity(x, values, cumperc):
+    """Compute the environmental similarity of the scaled values x with
+    respect to the reference frequency table, as the recode rules and the
+    map algebra expression of compute_ies
+    """
+    envmin = values[0]
+    envmax = values[-1]
+    index = np.searchsorted(values, x, side="right")
+    perc = np.where(index > 0, cumperc[np.maximum(index - 1, 0)], 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(
+            perc == 0,
+            (x - envmin) / (envmax - envmin) * 100.0,
+            np.where(
+                perc <= 50,
+                2 * perc,
+                np.where(
+                    perc < 100,
+                    2 * (100 - perc),
+                    (envmax - x) / (envmax - envmin) * 100.0,
+                ),
+            ),
+        )
+
+
+def init_tables(tables):
+    """Make the reference frequency tables available to a worker"""
+    global TABLES
+    TABLES = tables
+
+
+def mess_block(args):
+    """Compute the IES of all variables and the MESS statistics for the rows
+    from start to end (excluded)
+
+    The mask is not applied, as in the layers computed with r.mapcalc.
+    """
+    layers, start, end, region, digits2 = args
+    set_region(region)
+    libraster.Rast_suppress_masking()
+    ies = np.array(
+        [
+            similarity(np.trunc(read_rows(layer, start, end) * digits2), *table)
+            for layer, table in zip(layers, TABLES)
+        ]
+    )
+    libraster.Rast_unsuppress_masking()
+    nodata = np.isnan(ies).all(axis=0)
+    with np.errstate(invalid="ignore"):
+        mes = np.fmin.reduce(ies, axis=0)
+        mod = np.where(
+            nodata, CNULL, np.argmin(np.where(np.isnan(ies), np.inf, ies), 0)
+        )
+        novel = np.where(nodata, CNULL, mes < 0)
+        negative = ies <= -0.01 / digits2
+        sumneg = np.where(
+            negative.any(axis=0), np.where(negative, ies, 0).sum(axis=0), np.nan
+        )
+        countneg = (ies <= -0.0001 / digits2).sum(axis=0)
+    return ies, {
+        "mes": mes,
+        "mod": mod,
+        "novel": novel,
+        "sumneg": sumneg,
+        "countneg": countneg,
+    }
+
+
+def mess_engine(ref, proj, reference, ref_vect, regions, digits2, outputs, nprocs):
+    """Compute the IES and MESS layers in one pass over the projection layers
+
+    The frequency tables of the reference variables are computed in
+    parallel, after which blocks of rows of the projection layers are
+    processed in parallel and written in order.
+
+    :param list ref: reference variables
+    :param list proj: projection variables
+    :param tuple reference: name of the map delimiting the reference cells and
+                            whether it is a presence (1) map
+    :param str ref_vect: name of the reference points map or None
+    :param tuple regions: regions of the reference and projection layers
+    :param int digits2: scale factor of the variables
+    :param dict outputs: names of the output layers; the key "ies" holds the
+                         list of IES layers, other keys as returned by
+                         mess_block
+    :param int nprocs: number of parallel processes
+    """
+    region_ref, region_proj = regions
+    points = None
+    if ref_vect:
+        rows, cols, npoints = read_points(ref_vect, region_ref)
+        points = (rows, cols)
+
+    pool = Pool(nprocs) if nprocs > 1 else None
+    try:
+        tables = []
+        jobs = [(layer, reference, points, region_ref, digits2) for layer in ref]
+        for layer, table in zip(
+            ref, (pool.map if pool else map)(reference_table, jobs)
+        ):
+            values, cumperc, missing = table
+            if not values.size:
+                gs.fatal(_("The reference layer <{}> has no values").format(layer))
+            if ref_vect and missing + npoints - len(rows):
+                gs.info(
+                    _(
+                        "Please note that there were {} points without "
+                        "value for {}. This is probably because they are "
+                        "outside the computational region or mask"
+                    ).format(missing + npoints - len(rows), layer)
+                )
+            tables.append((values, cumperc))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    nrows = region_proj["rows"]
+    ncols = region_proj["cols"]
+    jobs = [
+        (proj, start, min(start + BLOCK_ROWS, nrows), region_proj, digits2)
+        for start in xrange(0, nrows, BLOCK_ROWS)
+    ]
+    if nprocs > 1:
+        pool = Pool(nprocs, initializer=init_tables, initargs=(tables,))
+    else:
+        init_tables(tables)
+
+    maps = [(None, "DCELL", name) for name in outputs["ies"]]
+    for key in ("mes", "mod", "novel", "sumneg", "countneg"):
+        if outputs.get(key):
+            mtype = "DCELL" if key in ("mes", "sumneg") else "CELL"
+            maps.append((key, mtype, outputs[key]))
+
+    set_region(region_proj)
+    rasters = []
+    try:
+        for key, mtype, name in maps:
+            rast = RasterRow(name, mode="w", mtype=mtype, overwrite=gs.overwrite())
+            rast.open()
+            rasters.append((rast, Buffer((ncols,), mtype=mtype), key))
+        for ies, stats in (pool.imap if pool else map)(mess_block, jobs):
+            for i, (rast, newrow, key) in enumerate(rasters):
+                block = ies[i] if key is None else stats[key]
+                for row in block:
+                    newrow[:] = row
+                    rast.put_row(newrow)
+    finally:
+        for rast, newrow, key in rasters:
+            rast.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+
 def main(options, flags):
 
     gisbase = os.getenv("GISBASE")
@@ -251,6 +532,7 @@ def main(options, flags):
     fln = flags["n"]
     fli = flags["i"]
     flc = flags["c"]
+    fls = flags["s"]
 
     # digits / precision
     digits = int(options["digits"])
@@ -267,18 +549,56 @@ def main(options, flags):
     with open(tmphist, "w") as text_file:
         text_file.write(hist)
 
+    # Compute all layers in one pass
+    if fls:
+        region_ref = gs.region()
+        if RP:
+            gs.run_command("g.region", quiet=True, raster=PROJ[0])
+        region_2 = gs.parse_command("g.region", flags="g")
+        outputs = {"ies": [] if fli else ipi, "mes": opc}
+        if fln:
+            outputs["novel"] = "{}_novel".format(opl)
+        if flm:
+            outputs["mod"] = "{}_MoD".format(opl)
+        if flk:
+            outputs["sumneg"] = "{}_SumNeg".format(opl)
+        if flc:
+            outputs["countneg"] = "{}_CountNeg".format(opl)
+        mess_engine(
+            REF,
+            PROJ,
+            (ref_rast or REF[0], bool(ref_rast)),
+            ref_vect,
+            (region_ref, gs.region()),
+            digits2,
+            outputs,
+            int(options["nprocs"]),
+        )
+        for i in xrange(len(outputs["ies"])):
+            gs.write_command(
+                "r.colors", map=ipi[i], rules="-", stdin=COLORS_MES, quiet=True
+            )
+            gs.run_command(
+                "r.support",
+                map=ipi[i],
+                title="IES {}".format(REF[i]),
+                units="0-100 (relative score",
+                description="Environmental similarity {}".format(REF[i]),
+                loadhistory=tmphist,
+            )
+
     # Create reference layer if not defined
-    if not ref_rast and not ref_vect:
+    if not fls and not ref_rast and not ref_vect:
         ref_rast = tmpname("tmp0")
         gs.mapcalc("$i = if(isnull($r),null(),1)", i=ref_rast, r=REF[0], quiet=True)
 
     # Create the recode table - Reference distribution is raster
     citiam = gs.find_file(name="MASK", element="cell", mapset=gs.gisenv()["MAPSET"])
-    if citiam["fullname"]:
+    if citiam["fullname"] and not fls:
         rname = tmpname("tmp3")
         gs.mapcalc("$rname = MASK", rname=rname, quiet=True)
 
-    if ref_rast:
+    if ref_rast and not fls:
         vtl = ref_rast
 
         # Create temporary layer based on reference layer
@@ -380,7 +700,7 @@ def main(options, flags):
             gs.del_temp_region()
 
     # Create the recode table - Reference distribution is vector
-    else:
+    elif not fls:
         vtl = ref_vect
 
         # Copy point layer and add columns for variables
@@ -522,7 +842,8 @@ def main(options, flags):
         gs.run_command("g.region", quiet=True, raster=PROJ[0])
 
     # MES
-    gs.run_command("r.series", quiet=True, output=opc, input=ipi, method="minimum")
+    if not fls:
+        gs.run_command("r.series", quiet=True, output=opc, input=ipi, method="minimum")
     gs.write_command("r.colors", map=opc, rules="-", stdin=COLORS_MES, quiet=True)
 
     # Write layer metadata
@@ -538,7 +859,10 @@ def main(options, flags):
     # Area with negative MES
     if fln:
         mod1 = "{}_novel".format(opl)
-        gs.mapcalc("$mod1 = int(if( $opc < 0, 1, 0))", mod1=mod1, opc=opc, quiet=True)
+        if not fls:
+            gs.mapcalc(
+                "$mod1 = int(if( $opc < 0, 1, 0))", mod1=mod1, opc=opc, quiet=True
+            )
 
         # Write category labels
         gs.write_command(
@@ -558,12 +882,13 @@ def main(options, flags):
 
     # Most dissimilar variable (MoD)
     if flm:
-        tmpf4 = tmpname("tmp9")
         mod2 = "{}_MoD".format(opl)
-        gs.run_command(
-            "r.series", quiet=True, output=tmpf4, input=ipi, method="min_raster"
-        )
-        gs.mapcalc("$mod2 = int($tmpf4)", mod2=mod2, tmpf4=tmpf4, quiet=True)
+        if not fls:
+            tmpf4 = tmpname("tmp9")
+            gs.run_command(
+                "r.series", quiet=True, output=tmpf4, input=ipi, method="min_raster"
+            )
+            gs.mapcalc("$mod2 = int($tmpf4)", mod2=mod2, tmpf4=tmpf4, quiet=True)
 
         fd4, tmpcat = tempfile.mkstemp()
         with open(tmpcat, "w") as text_file:
@@ -588,14 +913,15 @@ def main(options, flags):
     if flk:
         mod3 = "{}_SumNeg".format(opl)
         c0 = -0.01 / digits2
-        gs.run_command(
-            "r.series",
-            quiet=True,
-            input=ipi,
-            method="sum",
-            range=("-inf", c0),
-            output=mod3,
-        )
+        if not fls:
+            gs.run_command(
+                "r.series",
+                quiet=True,
+                input=ipi,
+                method="sum",
+                range=("-inf", c0),
+                output=mod3,
+            )
         gs.write_command("r.colors", map=mod3, rules="-", stdin=COLORS_MES, quiet=True)
 
         # Write layer metadata
@@ -611,21 +937,22 @@ def main(options, flags):
 
     # Number of layers with negative values
     if flc:
-        tmpf5 = tmpname("tmp10")
         mod4 = "{}_CountNeg".format(opl)
-        MinMes = gs.read_command("r.info", quiet=True, flags="r", map=opc)
-        MinMes = str.splitlines(MinMes)
-        MinMes = float(np.hstack([i.split("=") for i in MinMes])[1])
-        c0 = -0.0001 / digits2
-        gs.run_command(
-            "r.series",
-            quiet=True,
-            input=ipi,
-            output=tmpf5,
-            method="count",
-            range=(MinMes, c0),
-        )
-        gs.mapcalc("$mod4 = int($tmpf5)", mod4=mod4, tmpf5=tmpf5, quiet=True)
+        if not fls:
+            tmpf5 = tmpname("tmp10")
+            MinMes = gs.read_command("r.info", quiet=True, flags="r", map=opc)
+            MinMes = str.splitlines(MinMes)
+            MinMes = float(np.hstack([i.split("=") for i in MinMes])[1])
+            c0 = -0.0001 / digits2
+            gs.run_command(
+                "r.series",
+                quiet=True,
+                input=ipi,
+                output=tmpf5,
+                method="count",
+                range=(MinMes, c0),
+            )
+            gs.mapcalc("$mod4 = int($tmpf5)", mod4=mod4, tmpf5=tmpf5, quiet=True)
 
         # Write layer metadata
         gs.run_command(
@@ -639,7 +966,7 @@ def main(options, flags):
         )
 
     # Remove IES layers
-    if fli:
+    if fli and not fls:
         gs.run_command("g.remove", quiet=True, flags="f", type="raster", name=ipi)
     # Clean up tmp file
     os.remove(tmphist)
@@ -49,16 +49,18 @@
 #% answer: ols
 #% multiple: no
 #%end
+#%option G_OPT_M_NPROCS
+#% answer: 1
+#%end
 
 
 import os
 import sys
 
 import csv
-import numpy as np
-from numpy.linalg.linalg import LinAlgError
+from multiprocessing import Pool
 
-# statsmodels lazy imported at the end of the file
+import numpy as np
 
 if "GISBASE" not in os.environ:
     sys.stderr.write("You must be in GRASS GIS to run this program.\n")
@@ -67,64 +69,143 @@ if "GISBASE" not in os.environ:
 import grass.script as grass
 from grass.pygrass import raster
 from grass.pygrass.gis.region import Region
+from grass.pygrass.raster.buffer import Buffer
 
 CNULL = -2147483648  # null value for CELL maps
 FNULL = np.nan  # null value for FCELL and DCELL maps
 
+BLOCK_CELLS = 8 * 1024 * 1024  # number of pixel * sample * factor values per block
 
-def get_val_or_null(map, row, col):
-    """
-    Return map value of the cell or FNULL (if the cell is null)
-    """
-    value = map.get(row, col)
-    if map.mtype == "CELL" and value == CNULL:
-        value = FNULL
-    return value
+# parameters of the robust linear model (defaults of statsmodels RLM)
+HUBER_T = 1.345  # tuning constant of the Huber norm
+MAD_NORM = 0.6744897501960817  # normal quantile at 3/4, scales MAD to sigma
+RLM_MAXITER = 50
+RLM_TOL = 1e-8
 
 
-def fit(y, x, model="ols"):
-    """Ordinary least squares.
+def read_rows(name, start, end):
+    """Read rows from start to end (excluded) as a float array, FNULL for nulls"""
+    with raster.RasterRow(name) as map:
+        rows = np.array([map[row] for row in range(start, end)], dtype=np.float64)
+        if map.mtype == "CELL":
+            rows[rows == CNULL] = FNULL
+    return rows
 
-    :param x:   MxN matrix of data points
-    :param x:   numpy.array
-    :param y:   vector of M output values
+
+def least_squares(y, x, weights=None):
+    """Solve the least squares problems of all pixels at once.
+
+    :param y:   PxM matrix of output values of P pixels
     :param y:   numpy.array
-    :return:    vector b of coefficients (x * b = y)
+    :param x:   PxMxN array of data points of P pixels
+    :param x:   numpy.array
+    :param weights: PxM matrix of weights or None
+    :return:    PxN matrix of coefficients (x * b = y)
+
+    The pseudoinverse is used as in statsmodels, so that a singular
+    system gives the minimum norm solution.
+    """
+    if weights is not None:
+        sqrt_w = np.sqrt(weights)
+        y = y * sqrt_w
+        x = x * sqrt_w[:, :, np.newaxis]
+    return np.einsum("pns,ps->pn", np.linalg.pinv(x), y)
+
+
+def residuals(y, x, coefs, valid):
+    """Return the residuals of the pixels, FNULL for no-data samples"""
+    resid = y - np.einsum("psn,pn->ps", x, coefs)
+    resid[~valid] = FNULL
+    return resid
+
+
+def mad_scale(resid):
+    """Median absolute deviation (around 0) of the residuals of each pixel"""
+    return np.nanmedian(np.abs(resid), axis=1) / MAD_NORM
+
+
+def huber_weights(z):
+    """Weights of the Huber norm"""
+    absz = np.abs(z)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(absz <= HUBER_T, 1.0, HUBER_T / absz)
+
+
+def huber_rho(z):
+    """Objective function of the Huber norm"""
+    absz = np.abs(z)
+    return np.where(absz <= HUBER_T, z**2 / 2.0, HUBER_T * absz - HUBER_T**2 / 2.0)
+
+
+def fit_ols(y, x, valid):
+    """Ordinary least squares of all pixels"""
+    return least_squares(y, x)
+
+
+def fit_rlm(y, x, valid):
+    """Robust linear model of all pixels, fitted by iteratively reweighted
+    least squares with the Huber norm and the MAD scale estimate.
+    Pixels are iterated until the change of their deviance is below the
+    tolerance.
     """
-    # if a X sample has nan value,
-    # then the fitting procedure crashes.
-    # Delete no-data samples from the data
-    factor_count = x.shape[1]
-    nan_idx = np.logical_or(np.isnan(y), np.isnan(x).any(axis=1))
-    if nan_idx.any():
-        y = y[~nan_idx]
-        x = x[~nan_idx]
-    if x.shape[0] < x.shape[1]:
-        # The system can't be solved
-        return [FNULL for i in range(factor_count)]
-
-    if model == "ols":
-        model = sm.OLS(y, x)
-    elif model == "rlm":
-        model = sm.robust.robust_linear_model.RLM(y, x)
-    else:
-        raise NotImplementedError("Model %s doesn't implemented" % (model,))
-
-    try:
-        results = model.fit()
-        coefs = results.params
-    except LinAlgError:
-        coefs = [FNULL for i in range(factor_count)]
+    coefs = least_squares(y, x)
+    resid = residuals(y, x, coefs, valid)
+    scale = mad_scale(resid)
+    deviance = np.full(y.shape[0], np.inf)
+    # a zero scale means a perfect fit
+    active = np.flatnonzero(scale > 0)
+    for i in range(RLM_MAXITER):
+        if not active.size:
+            break
+        ya, xa, va = y[active], x[active], valid[active]
+        weights = huber_weights(resid[active] / scale[active, np.newaxis])
+        weights[~va] = 0
+        coefs[active] = least_squares(ya, xa, weights)
+        resid[active] = residuals(ya, xa, coefs[active], va)
+        scale[active] = mad_scale(resid[active])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dev = np.nansum(huber_rho(resid[active] / scale[active, np.newaxis]), 1)
+        done = (np.abs(dev - deviance[active]) <= RLM_TOL) | (scale[active] == 0)
+        deviance[active] = dev
+        active = active[~done]
     return coefs
 
 
+MODELS = {"ols": fit_ols, "rlm": fit_rlm}
+
+
+def fit_block(args):
+    """Fit the regression of the pixels in the rows from start to end (excluded)
+
+    :return:    NxRxC array of coefficients, FNULL where the system can't
+                be solved
+    """
+    y_names, x_names, start, end, model = args
+    y = np.array([read_rows(name, start, end) for name in y_names])
+    x = np.array([[read_rows(name, start, end) for name in names] for names in x_names])
+    sample_count, factor_count, rows, cols = x.shape
+    # pixels first: (pixels, samples) and (pixels, samples, factors)
+    y = y.reshape(sample_count, -1).T.copy()
+    x = x.reshape(sample_count, factor_count, -1).transpose(2, 0, 1).copy()
+
+    # no-data samples are removed from the fit by zero rows
+    valid = ~np.logical_or(np.isnan(y), np.isnan(x).any(axis=2))
+    y[~valid] = 0
+    x[~valid] = 0
+
+    coefs = MODELS[model](y, x, valid)
+    # The system can't be solved
+    coefs[valid.sum(axis=1) < factor_count] = FNULL
+    return coefs.T.reshape(factor_count, rows, cols)
+
+
 def get_sample_names(filename, delimiter=","):
     """
     Analyse settings file, returns
     """
     with open(filename) as settings:
         reader = csv.reader(settings, delimiter=delimiter)
-        headers = reader.next()
+        headers = next(reader)
         inputs = []
         outputs = []
         for row in reader:
@@ -161,104 +242,64 @@ class DataModel(object):
         self.sample_count = len(self.y_names)
         self.factor_count = len(self.x_names[0])
 
-        self._y_rasters = []
-        self._x_rasters = []
-        self._b_rasters = []
-        self._init_rasters()
-
-    def x(self, s, f):
-        """Return input map (X) from sample number s and factor number f."""
-        return self._x_rasters[s][f]
+        self._check_rasters()
 
-    def y(self, s):
-        """Return output map (Y) from sample number s."""
-        return self._y_rasters[s]
-
-    def b(self, s):
-        return self._b_rasters[s]
-
-    def _init_rasters(self):
+    def _check_rasters(self):
         for name in self.y_names:
-            map = raster.RasterSegment(name)
-            if not map.exist():
+            if not raster.RasterRow(name).exist():
                 raise ValueError("Raster map %s doesn't exist" % (name,))
-            self._y_rasters.append(map)
 
         for names in self.x_names:
-            maps = []
             for name in names:
-                map = raster.RasterSegment(name)
-                if not map.exist():
+                if not raster.RasterRow(name).exist():
                     raise ValueError("Raster map %s doesn't exist" % (name,))
-                maps.append(map)
             # Check count of X samples
-            assert len(maps) == self.factor_count
-
-            self._x_rasters.append(maps)
-
-        # Rasters of the regression coefitients
-        for i in range(self.factor_count):
-            name = self.b_names[i]
-            map = raster.RasterSegment(name)
-            self._b_rasters.append(map)
-
-    def open_rasters(self, overwrite):
-        for i in range(self.sample_count):
-            map = self.y(i)
-            map.open()
-
-        for j in range(self.factor_count):
-            map = self.b(j)
-            map.open("w", mtype=self.mtype, overwrite=overwrite)
-            for i in range(self.sample_count):
-                map = self.x(i, j)
-                map.open()
-
-    def close_rasters(self):
-        for i in range(self.sample_count):
-            map = self.y(i)
-            map.close()
-
-        for j in range(self.factor_count):
-            map = self.b(j)
-            map.close()
-            for i in range(self.sample_count):
-                map = self.x(i, j)
-                map.close()
-
-    def get_sample(self, row, col):
-        """Return X and Y matrices for one pixel sample"""
-        X = np.empty((self.sample_count, self.factor_count))
-        Y = np.empty(self.sample_count)
-        for snum in range(self.sample_count):
-            y = self.y(snum)
-            Y[snum] = get_val_or_null(y, row, col)
-            for fnum in range(self.factor_count):
-                x = self.x(snum, fnum)
-                X[snum, fnum] = get_val_or_null(x, row, col)
-
-        return Y, X
-
-    def fit(self, model="ols", overwrite=None):
+            assert len(names) == self.factor_count
+
+    def fit(self, model="ols", overwrite=None, nprocs=1):
+        """Fit the model for all pixels, block of rows by block of rows.
+
+        Blocks are fitted in parallel by nprocs processes and the
+        coefficients are written in order.
+        """
+        if model not in MODELS:
+            raise NotImplementedError("Model %s doesn't implemented" % (model,))
+        reg = Region()
+        rows, cols = reg.rows, reg.cols
+        block_rows = max(
+            1, BLOCK_CELLS // (cols * self.sample_count * self.factor_count)
+        )
+        jobs = [
+            (self.y_names, self.x_names, start, min(start + block_rows, rows), model)
+            for start in range(0, rows, block_rows)
+        ]
+
+        pool = Pool(nprocs) if nprocs > 1 else None
+        b_rasters = []
         try:
-            reg = Region()
-            self.open_rasters(overwrite=overwrite)
-            rows, cols = reg.rows, reg.cols
-            for r in range(rows):
-                for c in range(cols):
-                    Y, X = self.get_sample(r, c)
-                    coefs = fit(Y, X, model)
-                    for i in range(self.factor_count):
-                        b = self.b(i)
-                        b.put(r, c, coefs[i])
+            for name in self.b_names:
+                b = raster.RasterRow(name)
+                b.open("w", mtype=self.mtype, overwrite=overwrite)
+                b_rasters.append(b)
+            newrow = Buffer((cols,), mtype=self.mtype)
+            for coefs in (pool.imap if pool else map)(fit_block, jobs):
+                for b, block in zip(b_rasters, coefs):
+                    for row in block:
+                        newrow[:] = row
+                        b.put_row(newrow)
         finally:
-            self.close_rasters()
+            for b in b_rasters:
+                b.close()
+            if pool:
+                pool.close()
+                pool.join()
 
 
 def main(options, flags):
     samples = options["samples"]
     res_pref = options["result_prefix"]
     model_type = options["model"]
+    nprocs = int(options["nprocs"])
     if not os.path.isfile(samples):
         sys.stderr.write("File '%s' doesn't exist.\n" % (samples,))
         sys.exit(1)
@@ -266,19 +307,10 @@ def main(options, flags):
     headers, outputs, inputs = get_sample_names(samples)
 
     model = DataModel(headers, outputs, inputs, res_pref)
-    model.fit(model=model_type, overwrite=grass.overwrite())
+    model.fit(model=model_type, overwrite=grass.overwrite(), nprocs=nprocs)
     sys.exit(0)
 
 
 if __name__ == "__main__":
     options, flags = grass.parser()
-
-    # lazy import (global to avoid import in a loop)
-    try:
-        import statsmodels.api as sm
-    except ImportError:
-        grass.fatal(
-            _("Cannot import statsmodels." " Install python-statmodels package first")
-        )
-
     main(options, flags)
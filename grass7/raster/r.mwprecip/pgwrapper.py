@@ -57,6 +57,23 @@ class pgwrapper:
             self.connection.rollback()
             pass
 
+    def fetchchunks(self, sql, size):
+        """!Fetch the results of the SQL statement in chunks.
+        @param sql              : SQL statement to execute.
+        @param size             : Number of rows of each chunk.
+        """
+        cursor = self.connection.cursor(name="chunks")
+        cursor.itersize = size
+        cursor.execute(sql)
+        try:
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
     def executeSql(self, sql, results=True, commit=False):
         # Excute the SQL statement.
         # self.print_message (sql)
@@ -12,12 +12,18 @@ import atexit
 import shutil
 import csv
 import glob
+import io
 import re
+import struct
 from collections import defaultdict
 from datetime import datetime, timedelta
 from math import sin, cos, atan2, degrees, radians, tan, sqrt, fabs
+from multiprocessing import Pool, Queue
+
+import numpy as np
 
 from grass.script import core as grass
+from grass.script import array as garray
 from grass.exceptions import CalledModuleError
 
 ##########################################################
@@ -193,6 +199,23 @@ from grass.exceptions import CalledModuleError
 #% required: no
 #%end
 
+#%option G_OPT_STRDS_OUTPUT
+#% key: strds
+#% label: Name of space time raster dataset of interpolated time windows
+#% description: Time windows are read by one query and interpolated in parallel
+#% guisection: Interpolation
+#% required: no
+#%end
+
+#%option
+#% key: nprocs
+#% type: integer
+#% label: Number of processes for interpolation of time windows
+#% description: Used with parameter strds
+#% guisection: Interpolation
+#% answer: 1
+#%end
+
 
 ##########################################################
 ############## guisection: database work #################
@@ -250,6 +273,27 @@ record_tb_name = "record"
 comp_precip = "computed_precip"
 comp_precip_gauge = "rgauge_rec"
 R = 6371
+# number of records computed at once
+chunk_rows = 100000
+# PostgreSQL binary copy header and trailer, timestamps are microseconds from 2000
+pg_copy_header = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+pg_copy_trailer = struct.pack("!h", -1)
+pg_epoch = np.datetime64("2000-01-01T00:00:00", "us")
+precip_row = np.dtype(
+    [
+        ("nfields", ">i2"),
+        ("linkid_len", ">i4"),
+        ("linkid", ">i4"),
+        ("time_len", ">i4"),
+        ("time", ">i8"),
+        ("precip_len", ">i4"),
+        ("precip", ">f4"),
+    ]
+)
+# number of cell-point distances computed at once by IDW
+idw_cells = 4000000
+# temporary mapset of interpolation worker
+temp_mapset = None
 mesuretime = 0
 restime = 0
 temp_windows_names = []
@@ -1269,26 +1313,7 @@ def grassWork():
     )
 
     if not flags["q"]:
-        grass.run_command(
-            "v.in.ogr",
-            input="PG:",
-            layer="link",
-            output="link",
-            flags="t",
-            type="line",
-            quiet=True,
-        )
-
-        grass.run_command(
-            "g.region",
-            vect="link",
-            res="00:00:01",
-            n="n+ 00:00:20",
-            w="w-00:00:20",
-            e="e+00:00:20",
-            s="s-00:00:20",
-            quiet=True,
-        )
+        setLinkRegion()
     # 00:00:1
     try:
         with open(os.path.join(path, "l_timewindow"), "r") as f:
@@ -1318,6 +1343,246 @@ def grassWork():
         print("I/O error({}): {}".format(e.errno, e))
 
 
+def setLinkRegion():
+    grass.run_command(
+        "v.in.ogr",
+        input="PG:",
+        layer="link",
+        output="link",
+        flags="t",
+        type="line",
+        quiet=True,
+    )
+
+    grass.run_command(
+        "g.region",
+        vect="link",
+        res="00:00:01",
+        n="n+ 00:00:20",
+        w="w-00:00:20",
+        e="e+00:00:20",
+        s="s-00:00:20",
+        quiet=True,
+    )
+
+
+def grassWorkBulk(db):
+    """Interpolate all time windows, points of the windows are read by one
+    query and interpolated by nprocs processes, each in its temporary mapset.
+    The maps are registered as space time raster dataset
+    """
+    database = options["database"]
+    user = options["user"]
+    password = options["password"]
+    itype = options["interpolation"]
+    nprocs = int(options["nprocs"])
+
+    dbConnGrass(database, user, password)
+
+    with open(os.path.join(path, "linkpointsname"), "r") as f:
+        points = f.read()
+    with open(os.path.join(path, "l_timewindow"), "r") as f:
+        windows = f.read().splitlines()
+
+    if not flags["q"]:
+        setLinkRegion()
+
+    print_message("Reading points of time windows...")
+    sql = (
+        "select w.win, ST_X(p.geom), ST_Y(p.geom), w.precip_mm_h from %s.%s as p "
+        "join (%s) as w on p.linkid = w.linkid where w.precip_mm_h is not null "
+        "order by w.win"
+        % (
+            schema_name,
+            points,
+            " union all ".join(
+                "select '%s' as win, linkid, precip_mm_h from %s.%s"
+                % (win, schema_name, win)
+                for win in windows
+            ),
+        )
+    )
+    win_points = defaultdict(list)
+    for rows in db.fetchchunks(sql, chunk_rows):
+        for win, x, y, z in rows:
+            win_points[win].append((x, y, z))
+
+    region = grass.region()
+    tasks = []
+    for win in windows:
+        if win not in win_points:
+            print_message("Time window %s has no points, skipped" % win)
+            continue
+        out = schema_name + "." + win + "_" + itype
+        tasks.append((out, itype, np.array(win_points[win], dtype=float), region))
+    del win_points
+
+    print_message("Interpolating %d time windows..." % len(tasks))
+    mapsets = []
+    pool = None
+    if nprocs > 1:
+        queue = Queue()
+        for i in range(nprocs):
+            mapset = createTempMapset("tmp_mwprecip_%d_%d" % (os.getpid(), i))
+            mapsets.append(mapset)
+            queue.put(mapset)
+        pool = Pool(nprocs, initInterpolWorker, (queue, grass.region_env()))
+    try:
+        for out, mapset in (pool.imap if pool else map)(interpolateWindow, tasks):
+            if mapset:
+                grass.run_command(
+                    "g.copy",
+                    raster="%s@%s,%s" % (out, mapset, out),
+                    overwrite=True,
+                    quiet=True,
+                )
+    except CalledModuleError as e:
+        grass.fatal("Interpolation of time windows failed. %s" % e)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        for mapset, gisrc in mapsets:
+            shutil.rmtree(mapset, ignore_errors=True)
+            grass.try_remove(gisrc)
+
+    registerWindows([task[0] for task in tasks])
+
+
+def createTempMapset(name):
+    """Create mapset in current location, return path of mapset and gisrc
+    file of the mapset"""
+    env = grass.gisenv()
+    location = os.path.join(env["GISDBASE"], env["LOCATION_NAME"])
+    mapset = os.path.join(location, name)
+    os.mkdir(mapset)
+    shutil.copy(
+        os.path.join(location, "PERMANENT", "DEFAULT_WIND"),
+        os.path.join(mapset, "WIND"),
+    )
+    gisrc = grass.tempfile()
+    with open(gisrc, "w") as f:
+        f.write("MAPSET: %s\n" % name)
+        f.write("GISDBASE: %s\n" % env["GISDBASE"])
+        f.write("LOCATION_NAME: %s\n" % env["LOCATION_NAME"])
+        f.write("GUI: text\n")
+    return mapset, gisrc
+
+
+def initInterpolWorker(queue, region):
+    """Switch worker process to its temporary mapset and region"""
+    global temp_mapset
+    mapset, gisrc = queue.get()
+    temp_mapset = os.path.basename(mapset)
+    os.environ["GISRC"] = gisrc
+    os.environ["GRASS_REGION"] = region
+
+
+def interpolateWindow(task):
+    """Interpolate points (x, y, precipitation) of one time window, return
+    name of map and mapset of the map or None if current mapset"""
+    out, itype, points, region = task
+
+    if itype == "idw":
+        raster = garray.array()
+        raster[...] = idwInterpolation(points, region)
+        raster.write(mapname=out, overwrite=True)
+    else:
+        vector = "tmp_mwprecip_points_%d" % os.getpid()
+        grass.write_command(
+            "v.in.ascii",
+            input="-",
+            output=vector,
+            flags="zt",
+            z=3,
+            separator="pipe",
+            stdin="\n".join("%r|%r|%r" % tuple(point) for point in points.tolist()),
+            overwrite=True,
+            quiet=True,
+        )
+        if itype == "rst":
+            grass.run_command(
+                "v.surf.rst", input=vector, elevation=out, overwrite=True, quiet=True
+            )
+        else:
+            grass.run_command(
+                "v.surf.bspline",
+                input=vector,
+                raster_output=out,
+                overwrite=True,
+                quiet=True,
+            )
+        grass.run_command("g.remove", type="vector", name=vector, flags="f", quiet=True)
+
+    if options["color"]:
+        grass.run_command("r.colors", map=out, rules=options["color"], quiet=True)
+    return out, temp_mapset
+
+
+def idwInterpolation(points, region, npoints=12, power=2.0):
+    """Interpolate points (x, y, z) to cells of the region by inverse
+    distance weighting of npoints nearest points as v.surf.idw does
+    """
+    x, y, z = points.T
+    xs = region["w"] + (np.arange(region["cols"]) + 0.5) * region["ewres"]
+    ys = region["n"] - (np.arange(region["rows"]) + 0.5) * region["nsres"]
+    npoints = min(npoints, len(z))
+    result = np.empty((len(ys), len(xs)))
+    step = max(1, idw_cells // (len(xs) * len(z)))
+
+    for row in range(0, len(ys), step):
+        dx = xs[None, :, None] - x
+        dy = ys[row : row + step, None, None] - y
+        dist = dx ** 2 + dy ** 2
+        if npoints < len(z):
+            near = np.argpartition(dist, npoints - 1, axis=-1)[..., :npoints]
+            dist = np.take_along_axis(dist, near, axis=-1)
+            values = z[near]
+        else:
+            values = np.broadcast_to(z, dist.shape)
+        with np.errstate(divide="ignore"):
+            weight = 1 / dist ** (power / 2)
+        # cell on a point gets value of the point
+        exact = dist == 0
+        weight = np.where(exact.any(axis=-1, keepdims=True), exact, weight)
+        result[row : row + step] = (weight * values).sum(axis=-1) / weight.sum(axis=-1)
+    return result
+
+
+def registerWindows(maps):
+    """Register interpolated maps of time windows as space time raster
+    dataset, time of window is taken from its name"""
+    interval = {"minute": 60, "hour": 3600}.get(options["interval"], 86400)
+    reg_file = os.path.join(path, "strds_register")
+    with open(reg_file, "w") as f:
+        for out in maps:
+            win = out.split(".", 1)[1].rsplit("_", 1)[0]
+            start = datetime.strptime(win[len("l" + view) :], "%Y_%m_%d_%H_%M")
+            end = start + timedelta(seconds=interval)
+            f.write("%s|%s|%s\n" % (out, start, end))
+
+    print_message("Registering maps to space time raster dataset...")
+    grass.run_command(
+        "t.create",
+        type="strds",
+        output=options["strds"],
+        title="Precipitation from microwave links",
+        description="Interpolation %s of time windows" % options["interpolation"],
+        temporaltype="absolute",
+        semantictype="mean",
+        overwrite=grass.overwrite(),
+        quiet=True,
+    )
+    grass.run_command(
+        "t.register",
+        input=options["strds"],
+        type="raster",
+        file=reg_file,
+        overwrite=grass.overwrite(),
+        quiet=True,
+    )
+
+
 def precipInterpolationCustom(points_nat, win):
     # grass.run_command('v.surf.rst',input=points_nat,zcolumn = attribute_col,elevation=out, overwrite=True)
     itype = options["interpolation"]
@@ -1377,14 +1642,7 @@ def computePrecip(db):
     Awx = options["aw"]
     Aw = float(Awx)
     ##nuber of link and record in table link
-    xx = db.count("record")
     link_num = db.count("link")
-    ##select values for computing
-    sql = (
-        " select time, txpower-rxpower as a,lenght,polarization,frequency,linkid from %s order by recordid limit %d ; "
-        % (record_tb_name, xx)
-    )
-    resu = db.executeSql(sql, True, True)
 
     sql = "create table %s.%s ( linkid integer,time timestamp, precip real);" % (
         schema_name,
@@ -1397,11 +1655,6 @@ def computePrecip(db):
     ##optimalization of commits
     db.setIsoLvl(0)
 
-    try:
-        io = open(os.path.join(path, "precip"), "wr")
-    except IOError as e:
-        print("I/O error({}): {}".format(e.errno, e))
-
     ##choose baseline source (quantile, user values, ) get dict linkid, baseline
     links_dict = getBaselDict(db)
     ##check if baseline from text is correct
@@ -1420,42 +1673,84 @@ def computePrecip(db):
 
     print_message("Computing precipitation...")
 
-    recordid = 1
-    temp = []
-    for record in resu:
-        # if missing baseline. Link will be skip
-        if record[5] in links_dict and (record[4] / 1000000) > 10:
-            # coef_a_k[alpha, k]
-            coef_a_k = computeAlphaK(record[4], record[3])
-
-            # read value from dictionary
-            baseline_decibel = links_dict[record[5]]
-            # final precipiatation is R1
-            Ar = record[1] - baseline_decibel - Aw
-            if Ar > 0:
-
-                yr = Ar / (record[2] / 1000)
-                R1 = (yr / coef_a_k[1]) ** (1 / coef_a_k[0])
-            else:
-                R1 = 0
-            # string for output flatfile
-
-            out = str(record[5]) + "|" + str(record[0]) + "|" + str(R1) + "\n"
-            temp.append(out)
-            recordid += 1
-
-    ##write values to flat file
+    ##select values for computing, the records are read and written in chunks
+    sql = (
+        " select time, txpower-rxpower as a,lenght,polarization,frequency,linkid from %s order by recordid ; "
+        % record_tb_name
+    )
+    copy_sql = "COPY %s.%s (linkid, time, precip) FROM STDIN WITH BINARY" % (
+        schema_name,
+        comp_precip,
+    )
+    coefs = {}
     try:
-        io.writelines(temp)
-        io.close()
-    except IOError as e:
-        print("I/O error({}): {}".format(e.errno, e))
+        for records in db.fetchchunks(sql, chunk_rows):
+            linkid, time_us, precip = computePrecipChunk(records, links_dict, Aw, coefs)
+            db.cursor.copy_expert(
+                copy_sql, io.BytesIO(precipToBinary(linkid, time_us, precip))
+            )
+        db.connection.commit()
+    except Exception as e:
+        db.connection.rollback()
+        grass.fatal("Unable to write precipitation to database. %s" % e)
+
+
+def computePrecipChunk(records, links_dict, Aw, coefs):
+    """Compute precipitation of the records (time, attenuation, length,
+    polarization, frequency, linkid) at once, skip records without baseline
+    or with frequency up to 10 GHz.
+    Coefficients alpha, k are stored in coefs per (frequency, polarization).
+    Return arrays of linkid, time in microseconds from 2000 and precipitation
+    """
+    time, a, lenght, polarization, frequency, linkid = zip(*records)
+    frequency = np.array(frequency, dtype=float)
+    polarization = np.array(polarization)
+    linkid = np.array(linkid, dtype=np.int64)
+
+    # baseline of each record, NaN if missing
+    links, link_idx = np.unique(linkid, return_inverse=True)
+    baseline_decibel = np.array(
+        [links_dict.get(link, np.nan) for link in links.tolist()], dtype=float
+    )[link_idx]
+    valid = ~np.isnan(baseline_decibel) & (frequency / 1000000 > 10)
+
+    # coef_a_k[alpha, k] for each distinct frequency and polarization
+    pairs, pair_idx = np.unique(
+        np.rec.fromarrays([frequency[valid], polarization[valid]]),
+        return_inverse=True,
+    )
+    for pair in pairs.tolist():
+        if pair not in coefs:
+            coefs[pair] = computeAlphaK(*pair)
+    coef_a_k = np.array([coefs[pair] for pair in pairs.tolist()], dtype=float)
+    coef_a_k = coef_a_k.reshape(-1, 2)[pair_idx]
+
+    # final precipiatation is R1
+    Ar = np.array(a, dtype=float)[valid] - baseline_decibel[valid] - Aw
+    rain = Ar > 0
+    yr = Ar[rain] / (np.array(lenght, dtype=float)[valid][rain] / 1000)
+    R1 = np.zeros(len(Ar))
+    R1[rain] = (yr / coef_a_k[rain, 1]) ** (1 / coef_a_k[rain, 0])
+
+    time_us = np.array(
+        [t.replace(tzinfo=None) for t, v in zip(time, valid.tolist()) if v],
+        dtype="datetime64[us]",
+    )
+    return linkid[valid], (time_us - pg_epoch).astype(np.int64), R1
 
-    print_message("Writing precipitation to database...")
-    io1 = open(os.path.join(path, "precip"), "r")
-    db.copyfrom(io1, "%s.%s" % (schema_name, comp_precip))
-    io1.close()
-    os.remove(os.path.join(path, "precip"))
+
+def precipToBinary(linkid, time_us, precip):
+    """Return rows of linkid, time and precipitation in PostgreSQL binary
+    copy format"""
+    rows = np.empty(len(linkid), dtype=precip_row)
+    rows["nfields"] = 3
+    rows["linkid_len"] = 4
+    rows["linkid"] = linkid
+    rows["time_len"] = 8
+    rows["time"] = time_us
+    rows["precip_len"] = 4
+    rows["precip"] = precip
+    return pg_copy_header + rows.tobytes() + pg_copy_trailer
 
 
 def makeTimeWin(db, typeid, table):
@@ -1809,6 +2104,9 @@ def main():
                 "Timestamp 'fromtime' is not valid. Use format'YYYY-MM-DD H:M:S' "
             )
 
+    if options["strds"] and options["isettings"]:
+        grass.fatal("Parameter 'isettings' can not be used with 'strds'")
+
     ##check settings of baseline is valid
     if (
         not options["baseltime"]
@@ -1881,12 +2179,14 @@ def main():
 
     ##grass work
     if flags["g"]:
-        grassWork()
+        if options["strds"]:
+            grassWorkBulk(db)
+        else:
+            grassWork()
 
     print_message("DONE")
 
 
 if __name__ == "__main__":
     options, flags = grass.parser()
-
-main()
+    main()
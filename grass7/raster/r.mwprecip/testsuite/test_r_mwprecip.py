@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import importlib.util
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from grass.gunittest.case import TestCase
+from grass.gunittest.main import test
+
+# the module name contains a dot, load it from its file
+spec = importlib.util.spec_from_file_location(
+    "mwprecip",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "r.mwprecip.py"),
+)
+mwprecip = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mwprecip)
+
+
+def compute_precip_records(records, links_dict, Aw):
+    """Previous computation of precipitation record by record"""
+    result = []
+    for record in records:
+        # if missing baseline. Link will be skip
+        if record[5] in links_dict and (record[4] / 1000000) > 10:
+            coef_a_k = mwprecip.computeAlphaK(record[4], record[3])
+            baseline_decibel = links_dict[record[5]]
+            Ar = record[1] - baseline_decibel - Aw
+            if Ar > 0:
+                yr = Ar / (record[2] / 1000)
+                R1 = (yr / coef_a_k[1]) ** (1 / coef_a_k[0])
+            else:
+                R1 = 0
+            result.append((record[5], record[0], R1))
+    return result
+
+
+class TestComputePrecip(TestCase):
+    """Vectorised precipitation and binary copy rows without database"""
+
+    def test_precip_chunk(self):
+        """Compare computePrecipChunk with the record by record computation"""
+        rng = np.random.RandomState(42)
+        start = datetime(2014, 10, 1, 12)
+        records = []
+        for i in range(500):
+            records.append(
+                (
+                    start + timedelta(minutes=i),
+                    float(rng.uniform(40, 60)),
+                    float(rng.uniform(500, 20000)),
+                    rng.choice(["h", "v"]),
+                    # frequencies up to 10 GHz are skipped
+                    float(rng.choice([8.0e6, 10.0e6, 18.0e6, 23.0e6, 38.0e6])),
+                    int(rng.randint(1, 8)),
+                )
+            )
+        # links 6 and 7 have no baseline
+        links_dict = {link: float(rng.uniform(40, 50)) for link in range(1, 6)}
+        Aw = 1.5
+
+        reference = compute_precip_records(records, links_dict, Aw)
+        coefs = {}
+        linkid, time_us, precip = mwprecip.computePrecipChunk(
+            records, links_dict, Aw, coefs
+        )
+
+        self.assertEqual(len(linkid), len(reference))
+        self.assertTrue(len(reference) > 0)
+        self.assertTrue(any(R1 == 0 for link, time, R1 in reference))
+        self.assertTrue(any(R1 > 0 for link, time, R1 in reference))
+        self.assertEqual(linkid.tolist(), [link for link, time, R1 in reference])
+        self.assertEqual(
+            time_us.tolist(),
+            [
+                (time - datetime(2000, 1, 1)) // timedelta(microseconds=1)
+                for link, time, R1 in reference
+            ],
+        )
+        np.testing.assert_allclose(
+            precip, [R1 for link, time, R1 in reference], rtol=1e-12
+        )
+        # coefficients are computed once per frequency and polarization
+        self.assertTrue(all(freq / 1000000 > 10 for freq, pol in coefs))
+
+    def test_precip_binary(self):
+        """Check bytes of the binary copy of a known row"""
+        data = mwprecip.precipToBinary(
+            np.array([7]), np.array([1000000]), np.array([1.5])
+        )
+        expected = (
+            b"PGCOPY\n\xff\r\n\x00"
+            + b"\x00\x00\x00\x00"  # flags
+            + b"\x00\x00\x00\x00"  # header extension
+            + b"\x00\x03"  # number of fields
+            + b"\x00\x00\x00\x04\x00\x00\x00\x07"  # linkid
+            + b"\x00\x00\x00\x08\x00\x00\x00\x00\x00\x0f\x42\x40"  # time
+            + b"\x00\x00\x00\x04"
+            + struct.pack(">f", 1.5)  # precipitation
+            + b"\xff\xff"  # trailer
+        )
+        self.assertEqual(data, expected)
+
+
+if __name__ == "__main__":
+    test()
@@ -101,8 +101,63 @@ try:  # You can run the tests outside of grass where those imports are not avail
 except ImportError:
     pass
 
+import glob
+import os
 import sys
 
+# maximum number of kernel values held in memory by the diversity filter
+KERNEL_BLOCK_SIZE = 2**24
+# criteria of the diversity filter closer than this are considered equal
+TIE_TOLERANCE = 1e-12
+
+
+def read_csv(file_path, skip_header=1):
+    """
+    Read the header and the values of a csv file. The values are cached in a binary
+    npy file next to the csv file, so next reads only map the cache while the csv
+    file does not change. The name of the cache holds the header size, the size and
+    the modification time of the csv file.
+
+    :param file_path: Path to the csv data file
+    :param skip_header: Header size (in line) (default=1)
+
+    :type file_path: string
+    :type skip_header: int
+
+    :return: Return 2 arrays, the header and the values
+    :rtype: ndarray
+    """
+    header = np.array([])
+    if skip_header != 0:
+        with open(file_path) as f:
+            header = np.array(
+                [f.readline().rstrip("\r\n").split(",") for i in range(skip_header)]
+            )
+
+    stat = os.stat(file_path)
+    prefix = os.path.join(
+        os.path.dirname(file_path), "." + os.path.basename(file_path) + "."
+    )
+    cache = "{}{}-{}-{}.npy".format(prefix, skip_header, stat.st_size, stat.st_mtime_ns)
+    if os.path.isfile(cache):
+        return header, np.load(cache, mmap_mode="r")
+
+    data = np.loadtxt(file_path, delimiter=",", skiprows=skip_header, ndmin=2)
+    tmp = "{}.{}".format(cache, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            np.save(f, data)
+        os.rename(tmp, cache)
+        # Remove the caches of previous versions of the csv file
+        for old_cache in glob.glob(glob.escape(prefix) + "*.npy"):
+            if old_cache != cache:
+                os.remove(old_cache)
+    except (IOError, OSError):  # The directory of the csv file can be read only
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+
+    return header, data
+
 
 def load_data(file_path, labeled=False, skip_header=1, scale=True):
 
@@ -122,14 +177,7 @@ def load_data(file_path, labeled=False, skip_header=1, scale=True):
     :return: Return 4 arrays, the features X, the IDs, the labels y and the header
     :rtype: ndarray
     """
-    data = np.genfromtxt(file_path, delimiter=",", skip_header=0, dtype=None)
-
-    header = np.array([])
-
-    if skip_header != 0:
-        header = data[0:skip_header, :]
-    data = data[skip_header:, :]  # Remove header
-    data = data.astype(np.float)
+    header, data = read_csv(file_path, skip_header)
 
     ID = data[:, 0]  # get only row 0s
     if labeled:
@@ -420,22 +468,73 @@ def diversity_filter(samples, uncertain_samples_index, nbr, diversity_lambda=0.2
     """
     L = diversity_lambda
     m = samples.shape[0]  # Number of samples
-    samples_cpy = np.empty(samples.shape)
-    samples_cpy[:] = samples
+    # Keep the whole kernel matrix if it is small enough, otherwise compute its rows by blocks
+    kernel = rbf_kernel(samples, samples) if m * m <= KERNEL_BLOCK_SIZE else None
+    block = max(1, KERNEL_BLOCK_SIZE // m)
+
+    kept = np.ones(m, dtype=bool)
+    nbr_kept = m
+    sum_dist = np.empty(
+        m
+    )  # For each sample, the sum of the distances to the other kept samples
+    dist_to_closest = np.empty(m)
+    closest = np.empty(m, dtype=int)  # Index of the closest kept sample
+    for start in range(0, m, block):
+        index = np.arange(start, min(start + block, m))
+        dist = kernel_rows(samples, index, kernel)
+        closest[index] = dist.argmax(axis=1)
+        dist_to_closest[index] = dist[np.arange(index.size), closest[index]]
+        dist[np.arange(index.size), index] = 0
+        sum_dist[index] = dist.sum(axis=1)
+
+    for i in range(uncertain_samples_index.shape[0] - nbr):
+        average_dist = sum_dist / max(nbr_kept - 1, 1)
+        criterion = L * dist_to_closest + (1 - L) * (1.0 / m) * average_dist
+        criterion[~kept] = np.NINF
+        # The statistics are updated incrementally, so equal criteria can differ by
+        # rounding errors: ties go to the lowest index as with np.argmax
+        discard = np.argmax(criterion >= criterion.max() - TIE_TOLERANCE)
+        kept[discard] = False  # Remove the sample to discard
+        nbr_kept -= 1
+
+        # Update the statistics of the kept samples without the discarded one
+        dist = kernel_rows(samples, np.array([discard]), kernel)[0]
+        dist[discard] = 0
+        sum_dist -= dist
+        update = (kept & (closest == discard)).nonzero()[0]
+        for start in range(0, update.size, block):
+            index = update[start : start + block]
+            dist = kernel_rows(samples, index, kernel)
+            dist[:, ~kept] = np.NINF
+            closest[index] = dist.argmax(axis=1)
+            dist_to_closest[index] = dist[np.arange(index.size), closest[index]]
+
+    return uncertain_samples_index[kept[: uncertain_samples_index.shape[0]]]
+
+
+def kernel_rows(samples, index, kernel=None):
+    """
+    Compute some rows of the kernel matrix between the samples (or take them from the
+    precomputed matrix). The distance between a sample and itself is set to -inf.
 
-    selected_sample_index = uncertain_samples_index  # At the begining, take all samples
+    :param samples: Samples to consider
+    :param index: Indexes of the rows
+    :param kernel: Precomputed kernel matrix (default=None)
 
-    while selected_sample_index.shape[0] > nbr:
+    :type samples: ndarray(#samples x #features)
+    :type index: ndarray(#rows)
+    :type kernel: ndarray(#samples x #samples)
 
-        dist_to_closest = distance_to_closest(samples_cpy)
-        average_dist = average_distance(samples_cpy)
-        discard = np.argmax(L * dist_to_closest + (1 - L) * (1.0 / m) * average_dist)
-        selected_sample_index = np.delete(
-            selected_sample_index, discard
-        )  # Remove the sample to discard
-        samples_cpy = np.delete(samples_cpy, discard, axis=0)
+    :return: The distance between the samples of the rows and all the samples
+    :rtype: ndarray(#rows x #samples)
+    """
+    if kernel is not None:
+        dist = kernel[index]
+    else:
+        dist = rbf_kernel(samples[index], samples)
+    dist[np.arange(index.size), index] = np.NINF
 
-    return selected_sample_index
+    return dist
 
 
 def distance_to_closest(samples):
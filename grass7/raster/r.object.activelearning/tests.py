@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # encoding: utf-8
 import unittest
+import glob
 import os
 import numpy as np
 from sklearn.metrics.pairwise import rbf_kernel
@@ -23,6 +24,23 @@ def silent_remove(filename):
             raise
 
 
+def reference_diversity_filter(samples, index, nbr, diversity_lambda=0.25):
+    """
+    Original heuristic of the diversity filter, recomputing every criterion after each
+    discarded sample. Ties go to the lowest index.
+    """
+    m = samples.shape[0]
+    remaining = np.copy(samples)
+    while index.shape[0] > nbr:
+        criterion = diversity_lambda * al.distance_to_closest(remaining) + (
+            1 - diversity_lambda
+        ) / m * al.average_distance(remaining)
+        discard = np.argmax(criterion >= criterion.max() - al.TIE_TOLERANCE)
+        index = np.delete(index, discard)
+        remaining = np.delete(remaining, discard, axis=0)
+    return index
+
+
 class Test(unittest.TestCase):
     def test_linear_scale(self):
 
@@ -116,6 +134,71 @@ class Test(unittest.TestCase):
             (samples == np.array([a, b, b_bis, c, d, e, f, g, h, i])).all()
         )  # Check that the original array was not modified
 
+    def test_diversity_filter_blocks(self):
+        # Same selection as the original heuristic, with the whole kernel matrix or by blocks
+        samples = np.random.RandomState(0).rand(60, 4)
+        samples[1] = samples[0]
+        index = np.arange(100, 160)
+        reference = reference_diversity_filter(samples, index, 10)
+
+        kernel_block_size = al.KERNEL_BLOCK_SIZE
+        try:
+            for block_size in (kernel_block_size, 100):
+                al.KERNEL_BLOCK_SIZE = block_size
+                selected_samples = al.diversity_filter(samples, index, 10)
+                self.assertTrue((selected_samples == reference).all())
+        finally:
+            al.KERNEL_BLOCK_SIZE = kernel_block_size
+
+    def test_diversity_filter_ties(self):
+        # Ties of the last pair (nbr=1) and of duplicated samples go to the lowest index
+        rng = np.random.RandomState(1)
+        for i in range(50):
+            samples = rng.rand(rng.randint(2, 12), 3)
+            samples[rng.randint(samples.shape[0])] = samples[0]
+            index = np.arange(samples.shape[0])
+            for nbr in (1, 2):
+                reference = reference_diversity_filter(samples, index, nbr)
+                selected_samples = al.diversity_filter(samples, index, nbr)
+                self.assertTrue((selected_samples == reference).all())
+
+        # Two identical pairs: the first sample of each pair is discarded
+        samples = np.array([[0, 0], [0, 0], [5, 5], [5, 5]])
+        selected_samples = al.diversity_filter(samples, np.arange(4), 2)
+        self.assertTrue((selected_samples == [1, 3]).all())
+
+    def test_read_csv_cache(self):
+        filename = "unittest_data.csv"
+        caches = ".unittest_data.csv.*.npy"
+        data = np.array([["cat", "attr1"], [1, 3.5], [2, 4.5]])
+        np.savetxt(filename, data, delimiter=",", fmt="%s")
+
+        header, values = al.read_csv(filename)
+        self.assertEqual(len(glob.glob(caches)), 1)
+        header_cached, values_cached = al.read_csv(filename)
+
+        self.assertTrue((header == [["cat", "attr1"]]).all())
+        self.assertTrue((header_cached == header).all())
+        self.assertTrue((values == [[1, 3.5], [2, 4.5]]).all())
+        self.assertTrue((values_cached == values).all())
+
+        # Another header size is not read from the cache
+        header, values = al.read_csv(filename, skip_header=2)
+        self.assertTrue((values == [[2, 4.5]]).all())
+
+        # A csv file rewritten with the same modification time is read again
+        stat = os.stat(filename)
+        data = np.array([["cat", "attr1"], [1, 3.5], [2, 4.5], [3, 5.5]])
+        np.savetxt(filename, data, delimiter=",", fmt="%s")
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        header, values = al.read_csv(filename)
+        self.assertTrue((values == [[1, 3.5], [2, 4.5], [3, 5.5]]).all())
+        self.assertEqual(len(glob.glob(caches)), 1)
+
+        silent_remove(filename)
+        for cache in glob.glob(caches):
+            silent_remove(cache)
+
     def test_write_result_file(self):
         X = np.array([[11.0, 3.5, 4.7], [22.0, 4.5, 6.7]])
         header = np.array(["ID", "attr1", "attr2", "attr3"])
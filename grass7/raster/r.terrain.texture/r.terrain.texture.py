@@ -76,6 +76,16 @@
 #% guisection: Optional
 #%end
 
+#%option G_OPT_M_NPROCS
+#% description: Number of tiles processed in parallel by the tiled computation
+#% guisection: Optional
+#%end
+
+#%flag
+#% key: t
+#% description: Compute texture, convexity and concavity in tiles with NumPy
+#%end
+
 #%option G_OPT_R_OUTPUT
 #% description: Output terrain texture:
 #% key: texture
@@ -106,16 +116,25 @@ import sys
 import random
 import string
 import math
+import warnings
 import numpy as np
+from multiprocessing import Pool
 from subprocess import PIPE
 import atexit
 import grass.script as gs
+from grass.pygrass.gis.region import Region
 from grass.pygrass.modules.shortcuts import general as g
 from grass.pygrass.modules.shortcuts import raster as r
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
 from grass.script.utils import parse_key_val
 
 TMP_RAST = []
 
+CNULL = -2147483648  # null value for CELL maps
+TILE_ROWS = 256  # number of output rows computed per tile
+MEDIAN_CELLS = 8 * 1024 * 1024  # number of window cells sorted at once
+
 
 def cleanup():
     gs.message("Deleting intermediate files...")
@@ -174,6 +193,277 @@ def laplacian_matrix(w):
     return s
 
 
+def read_rows(elevation, start, end):
+    """Read rows from start to end (excluded) of the current window,
+    with NaN for null cells"""
+    with RasterRow(elevation) as rast:
+        rows = np.array([rast[row] for row in range(start, end)], dtype=np.float64)
+        if rast.mtype == "CELL":
+            rows[rows == CNULL] = np.nan
+    return rows
+
+
+def set_region(region, size=0):
+    """Set the raster window of the current process to the region
+    enlarged by size cells on each side"""
+    reg = Region()
+    reg.north = region["n"] + size * region["nsres"]
+    reg.south = region["s"] - size * region["nsres"]
+    reg.east = region["e"] + size * region["ewres"]
+    reg.west = region["w"] - size * region["ewres"]
+    reg.nsres = region["nsres"]
+    reg.ewres = region["ewres"]
+    reg.adjust()
+    reg.set_raster_region()
+
+
+def shifted(padded, pad, drow, dcol, shape):
+    """Return view of the padded array shifted by drow and dcol cells"""
+    return padded[
+        pad + drow : pad + drow + shape[0], pad + dcol : pad + dcol + shape[1]
+    ]
+
+
+def median_filter(values, size):
+    """Median of the non-null cells in a circular window as r.neighbors -c"""
+    half = size // 2
+    offsets = [
+        (i, j)
+        for i in range(-half, half + 1)
+        for j in range(-half, half + 1)
+        if i * i + j * j <= half * half
+    ]
+    padded = np.pad(values, half, constant_values=np.nan)
+    rows, cols = values.shape
+    median = np.empty(values.shape)
+    step = max(1, MEDIAN_CELLS // (len(offsets) * cols))
+    with warnings.catch_warnings():
+        # windows without data are null
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for start in range(0, rows, step):
+            end = min(start + step, rows)
+            stack = np.array(
+                [
+                    padded[
+                        half + i + start : half + i + end, half + j : half + j + cols
+                    ]
+                    for i, j in offsets
+                ]
+            )
+            median[start:end] = np.nanmedian(stack, axis=0)
+    return median
+
+
+def grow(values, radius):
+    """Fill null cells with the value of the nearest non-null cell closer
+    than radius cells as r.grow"""
+    offsets = sorted(
+        (
+            (i, j)
+            for i in range(-radius, radius + 1)
+            for j in range(-radius, radius + 1)
+            if 0 < i * i + j * j < radius * radius
+        ),
+        key=lambda offset: offset[0] ** 2 + offset[1] ** 2,
+    )
+    padded = np.pad(values, radius, constant_values=np.nan)
+    grown = values.copy()
+    for i, j in offsets:
+        nulls = np.isnan(grown)
+        if not nulls.any():
+            break
+        grown[nulls] = shifted(padded, radius, i, j, values.shape)[nulls]
+    return grown
+
+
+def laplacian_filter(values, size):
+    """Filter with the laplacian_matrix kernel as r.mfilter (DIVISOR 1),
+    cells with a null cell in their window are null"""
+    half = size // 2
+    padded = np.pad(values, half, constant_values=np.nan)
+    filtered = np.zeros(values.shape)
+    # same order of summation as r.mfilter
+    for i in range(-half, half + 1):
+        for j in range(-half, half + 1):
+            weight = size * size - 1 if i == j == 0 else -1
+            filtered += shifted(padded, half, i, j, values.shape) * weight
+    return filtered
+
+
+def resamp_weights(res, bartlett_radius, gauss_radius):
+    """Weights of the bartlett,gauss filter of r.resamp.filter for cell offsets"""
+    k = int(bartlett_radius / res)
+    dist = np.arange(-k, k + 1) * res
+    weights = np.maximum(0, 1 - np.abs(dist) / bartlett_radius)
+    return weights * np.exp(-2 * np.square(dist / gauss_radius))
+
+
+def resamp_filter(values, weights, axis):
+    """Weighted mean of the non-null cells along axis as r.resamp.filter"""
+    half = len(weights) // 2
+    valid = ~np.isnan(values)
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (half, half)
+    data = np.pad(np.where(valid, values, 0), pad)
+    count = np.pad(valid.astype(np.float64), pad)
+    total = np.zeros(values.shape)
+    wsum = np.zeros(values.shape)
+    window = [slice(None), slice(None)]
+    for i, weight in enumerate(weights):
+        if weight == 0:
+            continue
+        window[axis] = slice(i, i + values.shape[axis])
+        total += weight * data[tuple(window)]
+        wsum += weight * count[tuple(window)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        filtered = total / wsum
+    filtered[wsum == 0] = np.nan
+    return filtered
+
+
+def texture_tile(args):
+    """Compute texture, convexity and concavity of the rows from start to end
+
+    The elevation is read with a halo of halo cells around the tile. Texture
+    is computed from the cells of the current region, convexity and
+    concavity from the region grown by filter_size cells, as the
+    r.neighbors, r.grow, r.mfilter and r.resamp.filter steps do.
+    """
+    (
+        elevation,
+        start,
+        end,
+        rows,
+        cols,
+        halo,
+        filter_size,
+        flat_thres,
+        curv_thres,
+        row_weights,
+        col_weights,
+    ) = args
+    elev = read_rows(elevation, start, end + 2 * halo)
+    # row and column of the tile cells in the current region
+    region_rows = np.arange(start - halo, end + halo)[:, np.newaxis]
+    region_cols = np.arange(-halo, cols + halo)[np.newaxis, :]
+
+    def inside(border):
+        return (
+            (region_rows >= -border)
+            & (region_rows < rows + border)
+            & (region_cols >= -border)
+            & (region_cols < cols + border)
+        )
+
+    def density(features):
+        filtered = resamp_filter(features, col_weights, axis=1)
+        filtered = resamp_filter(filtered, row_weights, axis=0)
+        return filtered[halo : halo + end - start, halo : halo + cols] * 100
+
+    # terrain surface texture
+    elev_region = np.where(inside(0), elev, np.nan)
+    median = median_filter(elev_region, filter_size)
+    with np.errstate(invalid="ignore"):
+        pitpeaks = np.where(np.abs(elev_region - median) > flat_thres, 1.0, 0.0)
+    pitpeaks[np.isnan(elev_region) | np.isnan(median)] = np.nan
+    texture = density(pitpeaks)
+
+    # terrain convexity and concavity
+    grown_region = inside(filter_size)
+    dem_grown = grow(np.where(grown_region, elev, np.nan), filter_size)
+    dem_grown[~grown_region] = np.nan
+    laplacian = laplacian_filter(dem_grown, filter_size)
+    # border cells of the grown region are not filtered by r.mfilter
+    border = grown_region & ~inside(filter_size - filter_size // 2)
+    laplacian[border] = dem_grown[border]
+    nulls = np.isnan(laplacian)
+    with np.errstate(invalid="ignore"):
+        convexities = np.where(laplacian > curv_thres, 1.0, 0.0)
+        concavities = np.where(laplacian < -curv_thres, 1.0, 0.0)
+    convexities[nulls] = np.nan
+    concavities[nulls] = np.nan
+    convexity = density(convexities)
+    concavity = density(concavities)
+
+    # outputs are masked by the elevation
+    nulls = np.isnan(elev[halo : halo + end - start, halo : halo + cols])
+    for output in (texture, convexity, concavity):
+        output[nulls] = np.nan
+    return texture, convexity, concavity
+
+
+def texture_engine(
+    elevation,
+    texture,
+    convexity,
+    concavity,
+    filter_size,
+    counting_size,
+    flat_thres,
+    curv_thres,
+    nprocs,
+):
+    """Compute terrain texture, convexity and concavity in tiles of rows
+
+    The median filter, pit and peak extraction, growing, Laplacian filter
+    and the resampling filters are computed in one pass over tiles read
+    with a halo covering all the windows, tiles are processed in parallel.
+    """
+    region = gs.region()
+    rows, cols = region["rows"], region["cols"]
+    window_radius = (counting_size - 1) / 2
+    y_radius = float(region["ewres"]) * window_radius
+    x_radius = float(region["nsres"]) * window_radius
+    # r.resamp.filter is separable, bartlett uses the first and gauss
+    # the second radius
+    row_weights = resamp_weights(region["nsres"], x_radius, y_radius)
+    col_weights = resamp_weights(region["ewres"], x_radius, y_radius)
+    halo = max(len(row_weights), len(col_weights)) // 2 + filter_size // 2 + filter_size
+
+    jobs = [
+        (
+            elevation,
+            start,
+            min(start + TILE_ROWS, rows),
+            rows,
+            cols,
+            halo,
+            filter_size,
+            flat_thres,
+            curv_thres,
+            row_weights,
+            col_weights,
+        )
+        for start in range(0, rows, TILE_ROWS)
+    ]
+    outputs = [
+        RasterRow(name, mode="w", mtype="FCELL", overwrite=gs.overwrite())
+        for name in (texture, convexity, concavity)
+    ]
+    # workers read the elevation in the region enlarged by halo, they are
+    # started before the outputs are open in the current region
+    pool = Pool(max(1, nprocs), initializer=set_region, initargs=(region, halo))
+    try:
+        set_region(region)
+        for output in outputs:
+            output.open()
+        newrow = Buffer((cols,), mtype="FCELL")
+        done = 0
+        for tile in pool.imap(texture_tile, jobs):
+            for output, values in zip(outputs, tile):
+                for row in values:
+                    newrow[:] = row
+                    output.put_row(newrow)
+            done += len(tile[0])
+            gs.percent(done, rows, 1)
+    finally:
+        pool.close()
+        pool.join()
+        for output in outputs:
+            if output.is_open():
+                output.close()
+
+
 def categories(nclasses):
     if nclasses == 8:
         s = """1|steep, high convexity, fine-textured
@@ -364,131 +654,150 @@ def main():
             "Need to supply a slope raster in order to produce the terrain classification"
         )
 
-    # Terrain Surface Texture -------------------------------------------------
-    # smooth the dem
-    gs.message("Calculating terrain surface texture...")
-    gs.message(
-        "1. Smoothing input DEM with a {n}x{n} median filter...".format(n=filter_size)
-    )
-    filtered_dem = temp_map("tmp_filtered_dem")
-    gs.run_command(
-        "r.neighbors",
-        input=elevation,
-        method="median",
-        size=filter_size,
-        output=filtered_dem,
-        flags="c",
-        quiet=True,
-    )
-
-    # extract the pits and peaks based on the threshold
-    pitpeaks = temp_map("tmp_pitpeaks")
-    gs.message("2. Extracting pits and peaks with difference > thres...")
-    r.mapcalc(
-        expression="{x} = if ( abs({dem}-{median})>{thres}, 1, 0)".format(
-            x=pitpeaks, dem=elevation, thres=flat_thres, median=filtered_dem
-        ),
-        quiet=True,
-    )
+    if flags["t"]:
+        gs.message("Calculating terrain surface texture, convexity and concavity...")
+        texture_engine(
+            elevation,
+            texture,
+            convexity,
+            concavity,
+            filter_size,
+            counting_size,
+            flat_thres,
+            curv_thres,
+            int(options["nprocs"]),
+        )
+    else:
+        # Terrain Surface Texture -------------------------------------------------
+        # smooth the dem
+        gs.message("Calculating terrain surface texture...")
+        gs.message(
+            "1. Smoothing input DEM with a {n}x{n} median filter...".format(
+                n=filter_size
+            )
+        )
+        filtered_dem = temp_map("tmp_filtered_dem")
+        gs.run_command(
+            "r.neighbors",
+            input=elevation,
+            method="median",
+            size=filter_size,
+            output=filtered_dem,
+            flags="c",
+            quiet=True,
+        )
 
-    # calculate density of pits and peaks
-    gs.message("3. Using resampling filter to create terrain texture...")
-    window_radius = (counting_size - 1) / 2
-    y_radius = float(current_reg["ewres"]) * window_radius
-    x_radius = float(current_reg["nsres"]) * window_radius
-    resample = temp_map("tmp_density")
-    r.resamp_filter(
-        input=pitpeaks,
-        output=resample,
-        filter=["bartlett", "gauss"],
-        radius=[x_radius, y_radius],
-        quiet=True,
-    )
+        # extract the pits and peaks based on the threshold
+        pitpeaks = temp_map("tmp_pitpeaks")
+        gs.message("2. Extracting pits and peaks with difference > thres...")
+        r.mapcalc(
+            expression="{x} = if ( abs({dem}-{median})>{thres}, 1, 0)".format(
+                x=pitpeaks, dem=elevation, thres=flat_thres, median=filtered_dem
+            ),
+            quiet=True,
+        )
 
-    # convert to percentage
-    gs.message("4. Converting to percentage...")
-    r.mask(raster=elevation, overwrite=True, quiet=True)
-    r.mapcalc(
-        expression="{x} = float({y} * 100)".format(x=texture, y=resample), quiet=True
-    )
-    r.mask(flags="r", quiet=True)
-    r.colors(map=texture, color="haxby", quiet=True)
+        # calculate density of pits and peaks
+        gs.message("3. Using resampling filter to create terrain texture...")
+        window_radius = (counting_size - 1) / 2
+        y_radius = float(current_reg["ewres"]) * window_radius
+        x_radius = float(current_reg["nsres"]) * window_radius
+        resample = temp_map("tmp_density")
+        r.resamp_filter(
+            input=pitpeaks,
+            output=resample,
+            filter=["bartlett", "gauss"],
+            radius=[x_radius, y_radius],
+            quiet=True,
+        )
 
-    # Terrain convexity/concavity ---------------------------------------------
-    # surface curvature using lacplacian filter
-    gs.message("Calculating terrain convexity and concavity...")
-    gs.message("1. Calculating terrain curvature using laplacian filter...")
-
-    # grow the map to remove border effects and run laplacian filter
-    dem_grown = temp_map("tmp_elevation_grown")
-    laplacian = temp_map("tmp_laplacian")
-    g.region(
-        n=float(current_reg["n"]) + (float(current_reg["nsres"]) * filter_size),
-        s=float(current_reg["s"]) - (float(current_reg["nsres"]) * filter_size),
-        w=float(current_reg["w"]) - (float(current_reg["ewres"]) * filter_size),
-        e=float(current_reg["e"]) + (float(current_reg["ewres"]) * filter_size),
-    )
+        # convert to percentage
+        gs.message("4. Converting to percentage...")
+        r.mask(raster=elevation, overwrite=True, quiet=True)
+        r.mapcalc(
+            expression="{x} = float({y} * 100)".format(x=texture, y=resample),
+            quiet=True,
+        )
+        r.mask(flags="r", quiet=True)
+
+        # Terrain convexity/concavity ---------------------------------------------
+        # surface curvature using lacplacian filter
+        gs.message("Calculating terrain convexity and concavity...")
+        gs.message("1. Calculating terrain curvature using laplacian filter...")
+
+        # grow the map to remove border effects and run laplacian filter
+        dem_grown = temp_map("tmp_elevation_grown")
+        laplacian = temp_map("tmp_laplacian")
+        g.region(
+            n=float(current_reg["n"]) + (float(current_reg["nsres"]) * filter_size),
+            s=float(current_reg["s"]) - (float(current_reg["nsres"]) * filter_size),
+            w=float(current_reg["w"]) - (float(current_reg["ewres"]) * filter_size),
+            e=float(current_reg["e"]) + (float(current_reg["ewres"]) * filter_size),
+        )
 
-    r.grow(input=elevation, output=dem_grown, radius=filter_size, quiet=True)
-    r.mfilter(
-        input=dem_grown,
-        output=laplacian,
-        filter=string_to_rules(laplacian_matrix(filter_size)),
-        quiet=True,
-    )
+        r.grow(input=elevation, output=dem_grown, radius=filter_size, quiet=True)
+        r.mfilter(
+            input=dem_grown,
+            output=laplacian,
+            filter=string_to_rules(laplacian_matrix(filter_size)),
+            quiet=True,
+        )
 
-    # extract convex and concave pixels
-    gs.message("2. Extracting convexities and concavities...")
-    convexities = temp_map("tmp_convexities")
-    concavities = temp_map("tmp_concavities")
+        # extract convex and concave pixels
+        gs.message("2. Extracting convexities and concavities...")
+        convexities = temp_map("tmp_convexities")
+        concavities = temp_map("tmp_concavities")
 
-    r.mapcalc(
-        expression="{x} = if({laplacian}>{thres}, 1, 0)".format(
-            x=convexities, laplacian=laplacian, thres=curv_thres
-        ),
-        quiet=True,
-    )
-    r.mapcalc(
-        expression="{x} = if({laplacian}<-{thres}, 1, 0)".format(
-            x=concavities, laplacian=laplacian, thres=curv_thres
-        ),
-        quiet=True,
-    )
+        r.mapcalc(
+            expression="{x} = if({laplacian}>{thres}, 1, 0)".format(
+                x=convexities, laplacian=laplacian, thres=curv_thres
+            ),
+            quiet=True,
+        )
+        r.mapcalc(
+            expression="{x} = if({laplacian}<-{thres}, 1, 0)".format(
+                x=concavities, laplacian=laplacian, thres=curv_thres
+            ),
+            quiet=True,
+        )
 
-    # calculate density of convexities and concavities
-    gs.message("3. Using resampling filter to create surface convexity/concavity...")
-    resample_convex = temp_map("tmp_convex")
-    resample_concav = temp_map("tmp_concav")
-    r.resamp_filter(
-        input=convexities,
-        output=resample_convex,
-        filter=["bartlett", "gauss"],
-        radius=[x_radius, y_radius],
-        quiet=True,
-    )
-    r.resamp_filter(
-        input=concavities,
-        output=resample_concav,
-        filter=["bartlett", "gauss"],
-        radius=[x_radius, y_radius],
-        quiet=True,
-    )
+        # calculate density of convexities and concavities
+        gs.message(
+            "3. Using resampling filter to create surface convexity/concavity..."
+        )
+        resample_convex = temp_map("tmp_convex")
+        resample_concav = temp_map("tmp_concav")
+        r.resamp_filter(
+            input=convexities,
+            output=resample_convex,
+            filter=["bartlett", "gauss"],
+            radius=[x_radius, y_radius],
+            quiet=True,
+        )
+        r.resamp_filter(
+            input=concavities,
+            output=resample_concav,
+            filter=["bartlett", "gauss"],
+            radius=[x_radius, y_radius],
+            quiet=True,
+        )
 
-    # convert to percentages
-    gs.message("4. Converting to percentages...")
-    g.region(**current_reg)
-    r.mask(raster=elevation, overwrite=True, quiet=True)
-    r.mapcalc(
-        expression="{x} = float({y} * 100)".format(x=convexity, y=resample_convex),
-        quiet=True,
-    )
-    r.mapcalc(
-        expression="{x} = float({y} * 100)".format(x=concavity, y=resample_concav),
-        quiet=True,
-    )
-    r.mask(flags="r", quiet=True)
+        # convert to percentages
+        gs.message("4. Converting to percentages...")
+        g.region(**current_reg)
+        r.mask(raster=elevation, overwrite=True, quiet=True)
+        r.mapcalc(
+            expression="{x} = float({y} * 100)".format(x=convexity, y=resample_convex),
+            quiet=True,
+        )
+        r.mapcalc(
+            expression="{x} = float({y} * 100)".format(x=concavity, y=resample_concav),
+            quiet=True,
+        )
+        r.mask(flags="r", quiet=True)
 
     # set colors
+    r.colors(map=texture, color="haxby", quiet=True)
     r.colors_stddev(map=convexity, quiet=True)
     r.colors_stddev(map=concavity, quiet=True)
 
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import grass.script as gs
+from grass.gunittest.case import TestCase
+from grass.gunittest.main import test
+
+
+class TestTextureEngine(TestCase):
+    """The tiled NumPy engine (-t) must give the same results as the
+    r.neighbors, r.grow, r.mfilter and r.resamp.filter steps"""
+
+    outputs = ("texture", "convexity", "concavity")
+
+    @classmethod
+    def setUpClass(cls):
+        cls.use_temp_region()
+        cls.runModule("g.region", raster="elevation@PERMANENT", res=20, flags="a")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.del_temp_region()
+
+    def tearDown(self):
+        self.runModule(
+            "g.remove",
+            flags="f",
+            type="raster",
+            name=["ref_" + name for name in self.outputs]
+            + ["tiled_" + name for name in self.outputs],
+        )
+
+    def run_texture(self, prefix, **kwargs):
+        for name in self.outputs:
+            kwargs[name] = prefix + name
+        self.assertModule(
+            "r.terrain.texture",
+            elevation="elevation@PERMANENT",
+            counting_size=11,
+            **kwargs
+        )
+
+    def test_tiled_engine(self):
+        """Compare -t with the module chain, in several tiles and processes"""
+        self.run_texture("ref_")
+        self.run_texture("tiled_", flags="t", nprocs=2)
+        for name in self.outputs:
+            self.assertRastersNoDifference(
+                actual="tiled_" + name, reference="ref_" + name, precision=1e-3
+            )
+            univar = gs.parse_command("r.univar", map="ref_" + name, flags="g")
+            self.assertRasterFitsUnivar(
+                "tiled_" + name,
+                reference=dict(
+                    n=int(univar["n"]), null_cells=int(univar["null_cells"])
+                ),
+            )
+
+
+if __name__ == "__main__":
+    test()
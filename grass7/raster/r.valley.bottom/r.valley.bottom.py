@@ -100,6 +100,14 @@ COPYRIGHT: (C) 2018 by the GRASS Development Team
 #% answer: 2
 #% end
 
+#%option
+#% key: nprocs
+#% type: integer
+#% description: Number of processes used to compute the elevation percentile
+#% required: no
+#% answer: 1
+#% end
+
 #%flag
 #% key: s
 #% description: Use square moving window instead of circular moving window
@@ -112,11 +120,22 @@ import os
 import random
 import string
 import sys
+from multiprocessing import Pool
+
+import numpy as np
 
 import grass.script as gs
 from grass.pygrass.gis.region import Region
 from grass.pygrass.modules.shortcuts import general as g
 from grass.pygrass.modules.shortcuts import raster as r
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
+# null value of CELL maps
+CNULL = -2147483648
+
+# number of rows of the tiles used to compute the elevation percentile
+TILE_ROWS = 256
 
 if "GISBASE" not in os.environ:
     print("You must be in GRASS GIS to run this program.")
@@ -228,9 +247,109 @@ def focal_expr(radius, window_square=False):
     return offsets
 
 
-def elevation_percentile(input, radius=3, window_square=False):
+def set_region(region):
+    """Set the raster region of the current process
+
+    Parameters
+    ----------
+    region : dict
+        Region as returned by grass.script.region().
+    """
+    reg = Region()
+    reg.north = region["n"]
+    reg.south = region["s"]
+    reg.east = region["e"]
+    reg.west = region["w"]
+    reg.nsres = region["nsres"]
+    reg.ewres = region["ewres"]
+    reg.adjust()
+    reg.set_raster_region()
+
+
+def read_tile(input, start, end, radius, region):
+    """Reads rows of a raster map with a halo of radius cells
+
+    Parameters
+    ----------
+    input : str
+        Name of the GRASS raster map.
+
+    start, end : int
+        First row, and row following the last row of the tile.
+
+    radius : int
+        Number of cells of the halo around the tile.
+
+    region : dict
+        Region as returned by grass.script.region().
+
+    Returns
+    -------
+    tile : ndarray
+        Array of (end - start + 2 * radius, cols + 2 * radius) cells with NaN
+        for null cells and for cells outside of the region.
+    """
+    tile = np.full((end - start + 2 * radius, region["cols"] + 2 * radius), np.nan)
+    first = max(start - radius, 0)
+    last = min(end + radius, region["rows"])
+
+    with RasterRow(input) as src:
+        for row in range(first, last):
+            values = np.array(src[row], dtype=np.float64)
+            if src.mtype == "CELL":
+                values[values == CNULL] = np.nan
+            tile[row - start + radius, radius:-radius] = values
+
+    return tile
+
+
+def percentile_tile(args):
+    """Computes the elevation percentile of a tile of rows
+
+    Each neighbour is compared with the centre cell by a vectorised
+    comparison of the shifted tile. As in the r.mapcalc expression
+    if(isnull(x[d]), 1, x[d] <= x), null neighbours and neighbours outside
+    of the region count as lower and null centre cells remain null.
+
+    Parameters
+    ----------
+    args : tuple
+        Input raster, first and following last row of the tile, radius,
+        list of offsets and region.
+
+    Returns
+    -------
+    PCTL : ndarray
+        Elevation percentile of the rows of the tile.
+    """
+    input, start, end, radius, offsets, region = args
+    set_region(region)
+    tile = read_tile(input, start, end, radius, region)
+    nrows = end - start
+    ncols = region["cols"]
+    centre = tile[radius : radius + nrows, radius : radius + ncols]
+
+    count = np.zeros(centre.shape, dtype=np.int32)
+    for drow, dcol in offsets:
+        shifted = tile[
+            radius + drow : radius + drow + nrows, radius + dcol : radius + dcol + ncols
+        ]
+        with np.errstate(invalid="ignore"):
+            count += np.isnan(shifted) | (shifted <= centre)
+
+    pctl = count / float(len(offsets))
+    pctl[np.isnan(centre)] = np.nan
+
+    return pctl
+
+
+def elevation_percentile(input, radius=3, window_square=False, nprocs=1):
     """Calculates the percentile whichj is the ratio of the number of points of
     lower elevation to the total number of points in the surrounding region
+
+    The raster map is processed in tiles of rows with a halo of radius cells,
+    which are computed in parallel.
+
     Args
     ----
     L : int
@@ -241,6 +360,8 @@ def elevation_percentile(input, radius=3, window_square=False):
         Neighborhood radius (in pixels)
     window_square : bool. Optional (default is False)
         Boolean to use square or circular neighborhood
+    nprocs : int. Optional (default is 1)
+        Number of processes computing the tiles
     Returns
     -------
     PCTL : str
@@ -249,25 +370,30 @@ def elevation_percentile(input, radius=3, window_square=False):
     # get offsets for given neighborhood radius
     offsets = focal_expr(radius=radius, window_square=window_square)
 
-    # generate grass mapcalc terms and execute
-    n_pixels = float(len(offsets))
-
-    # create mapcalc expr focal function and fill null neighbors with centre cell
     PCTL = rand_id("PCTL{}".format(L + 1))
     TMP_RAST[L].append(PCTL)
 
-    terms = []
-    for d in offsets:
-        valid = ",".join(map(str, d))
-        terms.append(
-            "if( isnull({input}[{d}]), 1, {input}[{d}]<={input})".format(
-                input=input, d=valid
-            )
-        )
-
-    terms = "+".join(terms)
-    expr = "{x} = ({s}) / {n}".format(x=PCTL, s=terms, n=n_pixels)
-    gs.mapcalc(expr)
+    # the current region is passed explicitly, it is changed by g.region
+    # between the processing steps
+    region = gs.region()
+    set_region(region)
+    tiles = [
+        (input, start, min(start + TILE_ROWS, region["rows"]), radius, offsets, region)
+        for start in range(0, region["rows"], TILE_ROWS)
+    ]
+
+    pool = Pool(nprocs) if nprocs > 1 else None
+    try:
+        with RasterRow(PCTL, mode="w", mtype="DCELL") as out:
+            row = Buffer((region["cols"],), mtype="DCELL")
+            for pctl in (pool.imap if pool else map)(percentile_tile, tiles):
+                for values in pctl:
+                    row[:] = values
+                    out.put_row(row)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
     return PCTL
 
@@ -547,6 +673,7 @@ def main():
     p_pctl = float(options["p_pctl"])
     moving_window_square = flags["s"]
     min_cells = int(options["min_cells"])
+    nprocs = int(options["nprocs"])
 
     global current_region, TMP_RAST, L
     TMP_RAST = {}
@@ -622,7 +749,7 @@ def main():
     F.append(flatness(SLOPE[L], t_slope, p_slope))
 
     # calculation of elevation percentile PCTL for step 1
-    PCTL.append(elevation_percentile(DEM[L], radius, moving_window_square))
+    PCTL.append(elevation_percentile(DEM[L], radius, moving_window_square, nprocs))
 
     # transform elevation percentile to local lowness for step 1 (equation 3)
     PVF.append(prelim_flatness_valleys(F[L], PCTL[L], t_pctl_v, p_pctl))
@@ -654,7 +781,7 @@ def main():
     F.append(flatness(SLOPE[L], t_slope, p_slope))
 
     # calculation of elevation percentile PCTL for step 2 (radius of 6 cells)
-    PCTL.append(elevation_percentile(r_elevation, radius, moving_window_square))
+    PCTL.append(elevation_percentile(r_elevation, radius, moving_window_square, nprocs))
 
     # PVF for step 2 (equation 6)
     PVF.append(prelim_flatness_valleys(F[L], PCTL[L], t_pctl_v, p_pctl))
@@ -710,7 +837,7 @@ def main():
         g.region(ewres=Xres_step[L], nsres=Yres_step[L])
         remaining_cells = Region().cells
         DEM[L] = refine(DEM[L], Region(), method="average")
-        PCTL.append(elevation_percentile(DEM[L], radius, moving_window_square))
+        PCTL.append(elevation_percentile(DEM[L], radius, moving_window_square, nprocs))
 
         # refine PCTL to base resolution
         PCTL[L] = refine(PCTL[L], current_region, method="bilinear")
@@ -82,8 +82,14 @@
 #% description: low-memory option (will use full raster layers)
 #%end
 
+#%flag
+#% key: c
+#% description: streaming option (correlation matrix computed in one pass over the raster layers)
+#%end
+
 #%rules
 #%requires_all: -s,maxvif
+#%exclusive: -f,-c
 #%end
 
 # import libraries
@@ -100,10 +106,14 @@ import uuid
 import atexit
 import string
 import grass.script as gs
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
 
 
 # Functions
 CLEAN_RAST = []
+# Number of cell * raster values read at once in the streaming option
+BLOCK_CELLS = 8 * 1024 * 1024
 
 
 def cleanup():
@@ -179,6 +189,128 @@ def ComputeVif(mapx, mapy):
     return [vif, sqrtvif]
 
 
+def ReadCorrelation(raster, n):
+    """Compute the correlation matrix of the raster layers in one pass.
+
+    The rasters are read in blocks of rows and the cross-product matrix of
+    the cells without null values is accumulated block by block. If n is
+    not 100%, a random sample of cells is used: a Bernoulli sample for a
+    percentage, or a reservoir sample for a number of cells."""
+    gs.message("Computing the correlation matrix ...")
+    k = len(raster)
+    count = 0
+    mean = np.zeros(k)
+    comoment = np.zeros((k, k))
+    fraction = None
+    size = None
+    if n != "100%":
+        if n.endswith("%"):
+            fraction = float(n.rstrip("%")) / 100.0
+        else:
+            size = int(n)
+            reservoir = np.empty((0, k))
+            keys = np.empty(0)
+
+    def accumulate(block):
+        """Add the co-moments of a block (Chan et al. pairwise update)"""
+        nb = block.shape[0]
+        block_mean = block.mean(axis=0)
+        centred = block - block_mean
+        delta = block_mean - mean
+        total = count + nb
+        mean[:] += delta * nb / total
+        comoment[:] += np.dot(centred.T, centred) + np.outer(delta, delta) * (
+            count * nb / float(total)
+        )
+        return total
+
+    region = Region()
+    rows, cols = region.rows, region.cols
+    layers = [RasterRow(r) for r in raster]
+    for layer in layers:
+        layer.open("r")
+    block_rows = max(1, BLOCK_CELLS // (cols * k))
+    try:
+        for start in range(0, rows, block_rows):
+            end = min(start + block_rows, rows)
+            block = np.empty((end - start, cols, k))
+            for j, layer in enumerate(layers):
+                for row in range(start, end):
+                    block[row - start, :, j] = layer[row]
+                if layer.mtype == "CELL":
+                    block[:, :, j][block[:, :, j] == -2147483648] = np.nan
+            block = block.reshape(-1, k)
+            # as r.stats -n, skip cells with a null value in any layer
+            block = block[~np.isnan(block).any(axis=1)]
+            if fraction is not None:
+                block = block[np.random.random(block.shape[0]) < fraction]
+            if size is not None:
+                # keep the cells with the smallest random keys
+                reservoir = np.vstack((reservoir, block))
+                keys = np.concatenate((keys, np.random.random(block.shape[0])))
+                if keys.size > size:
+                    keep = np.argpartition(keys, size)[:size]
+                    reservoir = reservoir[keep]
+                    keys = keys[keep]
+            elif block.shape[0]:
+                count = accumulate(block)
+    finally:
+        for layer in layers:
+            layer.close()
+    if size is not None and reservoir.shape[0]:
+        count = accumulate(reservoir)
+
+    if count < 2:
+        gs.fatal("Not enough cells without null values to compute the VIF")
+    std = np.sqrt(np.diag(comoment))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = comoment / np.outer(std, std)
+    if np.isnan(corr).any():
+        gs.fatal("One or more layers have a constant value")
+    return corr
+
+
+def InverseCorrelation(corr):
+    """Invert the correlation matrix. The diagonal of the inverse of the
+    correlation matrix contains the VIF of the variables."""
+    try:
+        inv = np.linalg.inv(corr)
+    except np.linalg.LinAlgError:
+        inv = np.linalg.pinv(corr)
+        np.fill_diagonal(inv, float("inf"))
+    return inv
+
+
+def RemoveVariable(corr, inv, index):
+    """Remove a variable from the correlation matrix and its inverse.
+
+    The inverse is updated with a rank-one downdate (inverse of the Schur
+    complement). If the matrix is (nearly) singular, the inverse is
+    computed again instead."""
+    corr = np.delete(np.delete(corr, index, axis=0), index, axis=1)
+    pivot = inv[index, index]
+    if np.isfinite(pivot) and pivot < 1e10:
+        column = np.delete(inv[:, index], index)
+        inv = np.delete(np.delete(inv, index, axis=0), index, axis=1)
+        inv -= np.outer(column, column) / pivot
+    else:
+        inv = InverseCorrelation(corr)
+    return corr, inv
+
+
+def CorrelationVif(inv):
+    """Compute the vif and sqrt(vif) of all variables from the inverse of
+    the correlation matrix."""
+    vifstats = []
+    for vif in np.diag(inv):
+        if not np.isfinite(vif) or vif > 1e10:
+            vifstats.append([float("inf"), float("inf")])
+        else:
+            vif = max(float(vif), 1.0)
+            vifstats.append([vif, math.sqrt(vif)])
+    return vifstats
+
+
 def ComputeVif2(mapx, mapy):
     vifstat = gs.read_command(
         "r.regression.multi", flags="g", quiet=True, mapx=mapx, mapy=mapy
@@ -216,6 +348,7 @@ def main(options, flags):
     n = options["n"]
     flag_s = flags["s"]
     flag_f = flags["f"]
+    flag_c = flags["c"]
 
     # Determine maximum width of the columns to be printed to std output
     name_lengths = []
@@ -224,7 +357,11 @@ def main(options, flags):
     nlength = max(name_lengths)
 
     # Read in data
-    if not flag_f:
+    if flag_c:
+        corr = ReadCorrelation(IPF, n)
+        inv = InverseCorrelation(corr)
+        vifstats = CorrelationVif(inv)
+    elif not flag_f:
         p = ReadData(IPF, n)
 
     # Create arrays to hold results (which will be written to file at end)
@@ -249,6 +386,9 @@ def main(options, flags):
                 x = IPF[:]
                 del x[i]
                 vifstat = ComputeVif2(x, y)
+            # Use vif from the correlation matrix
+            elif flag_c:
+                vifstat = vifstats[i]
             # Compute vif using sample
             else:
                 y = p[:, i]
@@ -305,6 +445,9 @@ def main(options, flags):
                     x = IPF[:]
                     del x[k]
                     vifstat = ComputeVif2(x, y)
+                elif flag_c:
+                    # Use vif from the correlation matrix
+                    vifstat = vifstats[k]
                 else:
                     # Compute vif using sample
                     y = p[:, k]
@@ -341,7 +484,10 @@ def main(options, flags):
                 remove_variable = IPFn[rvifindex]
                 del IPF[rvifindex]
                 del IPFn[rvifindex]
-                if not flag_f:
+                if flag_c:
+                    corr, inv = RemoveVariable(corr, inv, rvifindex)
+                    vifstats = CorrelationVif(inv)
+                elif not flag_f:
                     p = np.delete(p, rvifindex, axis=1)
 
         # Write final selected variables to std output
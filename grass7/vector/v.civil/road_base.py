@@ -11,6 +11,8 @@ Created on Thu Jul 31 12:02:25 2014
 import math
 import re
 
+import numpy as np
+
 # from grass.pygrass.vector import VectorTopo
 from grass.pygrass.vector import VectorTopo
 from grass.pygrass.vector.geometry import Point
@@ -171,6 +173,33 @@ def bisecc(r_pnt, align):
     return RoadPoint(Point(eq_c[1], eq_c[2], 0), len_c, r_pnt.azi, "")
 
 
+def loop_range(start, end, interv, zero=None):
+    """Return the values of a loop adding interv to start while they do not
+    pass end, with the same rounding as the loop, and the value that ends
+    the loop. The values equal to 0 are replaced by zero, if given
+    ::
+    >>> loop_range(0, 2, 0.5)
+    (array([0. , 0.5, 1. , 1.5, 2. ]), 2.5)
+    """
+    num = max(int((end - start) / interv), 0) + 2
+    while True:
+        vals = np.cumsum(np.r_[float(start), np.full(num, float(interv))])
+        if interv > 0:
+            inside = vals <= end
+        else:
+            inside = vals >= end
+        if not inside[-1]:
+            break
+        num *= 2
+    num = int(np.argmin(inside))
+    vals, last = vals[:num], float(vals[num])
+    if zero is not None and (vals == 0).any():
+        k = int(np.argmax(vals == 0))
+        rest, last = loop_range(zero + interv, end, interv, zero)
+        vals = np.r_[vals[:k], zero, rest]
+    return vals, last
+
+
 def format_pk(funcion_f):
     """Return the pk format 10+000.001 of a funtion"""
 
@@ -394,6 +423,105 @@ class RoadPoint(Point, object):
         return Straight(self.point2d, None, self.azi + g90, 20)
 
 
+# =============================================
+# STATIONS
+# =============================================
+
+
+class Stations(object):
+    """Stations along an alignment as arrays of pk, coordinates, azimuth
+    and superelevation, with the point type and alignment of each one
+    ::
+    >>> stations = Stations([0, 10], [0, 0], [0, 10], azi=[0, 0], p_type="Line")
+    >>> len(stations)
+    2
+    """
+
+    def __init__(
+        self, npk=(), x=(), y=(), z=None, azi=None, incli=None, p_type="", align=""
+    ):
+        """Return"""
+        self.npk = np.asarray(npk, dtype=float)
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.z = self._array(z)
+        self.azi = self._array(azi)
+        self.incli = self._array(incli)
+        self.p_type = self._names(p_type)
+        self.align = self._names(align)
+
+    def __len__(self):
+        return len(self.npk)
+
+    def __repr__(self):
+        return "Stations(" + str(len(self)) + ")"
+
+    def _array(self, values):
+        """Return values as array, zeros if None"""
+        if values is None:
+            return np.zeros(len(self.npk))
+        return np.asarray(values, dtype=float)
+
+    def _names(self, names):
+        """Return list of names, repeating a single name"""
+        if isinstance(names, str):
+            return [names] * len(self.npk)
+        return list(names)
+
+    def set_align(self, align):
+        """Set the alignment name of all stations"""
+        self.align = self._names(align)
+
+    @staticmethod
+    def concat(list_stations):
+        """Return the stations of the list joined"""
+        stations = Stations()
+        if not list_stations:
+            return stations
+        for name in ["npk", "x", "y", "z", "azi", "incli"]:
+            setattr(
+                stations,
+                name,
+                np.concatenate([getattr(stat, name) for stat in list_stations]),
+            )
+        stations.p_type = [typ for stat in list_stations for typ in stat.p_type]
+        stations.align = [ali for stat in list_stations for ali in stat.align]
+        return stations
+
+    @staticmethod
+    def from_roadpnts(list_r_pnts):
+        """Return the stations of a list of roadpoints"""
+        return Stations(
+            [r_pnt.npk for r_pnt in list_r_pnts],
+            [r_pnt.x for r_pnt in list_r_pnts],
+            [r_pnt.y for r_pnt in list_r_pnts],
+            [r_pnt.z for r_pnt in list_r_pnts],
+            [r_pnt.azi for r_pnt in list_r_pnts],
+            [r_pnt.incli for r_pnt in list_r_pnts],
+            [r_pnt.p_type for r_pnt in list_r_pnts],
+            [r_pnt.align for r_pnt in list_r_pnts],
+        )
+
+    def get_roadpnts(self):
+        """Return the stations as list of roadpoints"""
+        list_pts = []
+        for npk, x, y, z, azi, incli, p_type, align in zip(
+            self.npk.tolist(),
+            self.x.tolist(),
+            self.y.tolist(),
+            self.z.tolist(),
+            self.azi.tolist(),
+            self.incli.tolist(),
+            self.p_type,
+            self.align,
+        ):
+            r_pnt = RoadPoint(Point(x, y, z), npk, azi, p_type)
+            r_pnt.incli = incli
+            r_pnt.align = align
+            list_pts.append(r_pnt)
+        return list_pts
+
+
 # =============================================
 # ROAD LINE
 # =============================================
@@ -624,6 +752,10 @@ class RoadObj(object):
         else:
             return "255:255:255"
 
+    def get_stations(self, start, end, interv):
+        """Return the stations of the object"""
+        return Stations.from_roadpnts(self.get_roadpnts(start, end, interv))
+
     def get_roadpoint(self, start):
         """Return a roadpoint found by pk"""
         if start == -1:
@@ -772,26 +904,28 @@ class Straight(RoadObj, object):
         [RoadPoint(2.12132034356, 2.12132034356, 0.0, 0, 0.785398163397,
         ...
         """
-        accum = self.pts_accum
+        return self.get_stations(start, end, interv).get_roadpnts()
+
+    def get_stations(self, start, end, interv):
+        """Return the stations of a straight, and set the rest to the end
+        and accumulated length"""
         if end == -1:
             end = self.length()
 
         azi = self.azimuth()
-        list_pts = []
-        while start <= end:
-            pnt = Point(
-                self.pstart.x + start * math.sin(azi),
-                self.pstart.y + start * math.cos(azi),
-                self.pstart.z,
-            )
-
-            list_pts.append(RoadPoint(pnt, accum, round(azi, 6), "Line"))
-            accum += interv
-            start += interv
-
-        self.pts_rest = end - (start - interv)
-        self.pts_accum = accum - interv
-        return list_pts
+        starts, last = loop_range(start, end, interv)
+        accums = np.cumsum(np.r_[float(self.pts_accum), np.full(len(starts), interv)])
+
+        self.pts_rest = end - (last - interv)
+        self.pts_accum = accums[-1] - interv
+        return Stations(
+            accums[:-1],
+            self.pstart.x + starts * math.sin(azi),
+            self.pstart.y + starts * math.cos(azi),
+            np.full(len(starts), self.pstart.z or 0.0),
+            np.full(len(starts), round(azi, 6)),
+            p_type="Line",
+        )
 
     def azimuth(self):
         """Return azimut of the straight
@@ -1042,48 +1176,42 @@ class Curve(RoadObj, object):
         [RoadPoint(57.0710678119, 57.0710678119, 0.0, 0,
         ...
         """
-        accum = self.pts_accum
+        return self.get_stations(start, end, interv).get_roadpnts()
+
+    def get_stations(self, start, end, interv):
+        """Return the stations of the curve, and set the rest to the end and
+        accumulated length"""
         az_ini = self.az_ini
         if end == -1:
             end = self.length()
-        list_pts = []
         interv = abs(float(interv) / float(self.radio))
 
         az_ini = az_ini + start / self.radio
         az_fin = az_ini + (end - start) / self.radio
 
-        inc = az_ini
         if self.radio > 0:
+            incs, last = loop_range(az_ini, az_fin, interv)
+            x_1 = self.p_center.x + self.radio * np.sin(incs)
+            y_1 = self.p_center.y + self.radio * np.cos(incs)
+            az1 = incs + math.pi / 2
+            az1 = np.where(az1 > 2 * math.pi, az1 - 2 * math.pi, az1)
+            rest = (az_fin - (last - interv)) * abs(self.radio)
+        else:
+            incs, last = loop_range(az_ini, az_fin, -interv)
+            x_1 = self.p_center.x + -self.radio * np.sin(incs)
+            y_1 = self.p_center.y + -self.radio * np.cos(incs)
+            az1 = incs - math.pi / 2
+            az1 = np.where(az1 < 0, az1 + 2 * math.pi, az1)
+            rest = ((last + interv) - az_fin) * abs(self.radio)
 
-            while inc <= az_fin:
-                pnt_1 = self.p_center.project(self.radio, inc)
-                az1 = inc + math.pi / 2
-                inc += interv
-
-                if az1 > 2 * math.pi:
-                    az1 = az1 - 2 * math.pi
-
-                list_pts.append(RoadPoint(pnt_1, accum, round(az1, 6), "Curve"))
-                accum += interv * abs(self.radio)
-            rest = (az_fin - (inc - interv)) * abs(self.radio)
-
-        elif self.radio < 0:
-
-            while inc >= az_fin:
-                pnt_1 = self.p_center.project(self.radio, inc, -1)
-                az1 = inc - math.pi / 2
-                inc -= interv
-
-                if az1 < 0:
-                    az1 = az1 + 2 * math.pi
-
-                list_pts.append(RoadPoint(pnt_1, accum, round(az1, 6), "Curve"))
-                accum += interv * abs(self.radio)
-            rest = ((inc + interv) - az_fin) * abs(self.radio)
+        step = interv * abs(self.radio)
+        accums = np.cumsum(np.r_[float(self.pts_accum), np.full(len(incs), step)])
 
         self.pts_rest = rest
-        self.pts_accum = accum - interv * abs(self.radio)
-        return list_pts
+        self.pts_accum = accums[-1] - step
+        # round each azimuth as Python does, np.round can differ in the last digit
+        azi = [round(float(a), 6) for a in az1]
+        return Stations(accums[:-1], x_1, y_1, azi=azi, p_type="Curve")
 
     def distance(self, pnt):
         """Return distance from a point to the curve
@@ -1306,6 +1434,10 @@ class Clothoid(RoadObj, object):
         [RoadPoint(10.0, 40.0000001, 0.0, 0,
         ...
         """
+        return self.get_stations(start, end, interv).get_roadpnts()
+
+    def get_stations(self, start, end, interv):
+        """Return the stations of the clothoid"""
         if end == -1:
             end = self.length()
 
@@ -1314,58 +1446,37 @@ class Clothoid(RoadObj, object):
         elif self.inout == "out":
             return self._get_pts_clot_out(start, end, interv)
 
+    def _stations(self, lengs, interv, p_type):
+        """Return the stations at the lengths from the origin of the
+        clothoid"""
+        rad_clo = self.a_clot ** 2 / lengs
+        tau_clo = lengs / (2 * rad_clo)
+        x_o, y_o = aprox_coord(lengs, tau_clo)
+        x_1, y_1 = self.cloth_global(x_o, y_o)
+        azi1 = self.pnt_azimuth(tau_clo)
+        accums = np.cumsum(np.r_[float(self.pts_accum), np.full(len(lengs), interv)])
+        self.pts_accum = accums[-1] - interv
+        azi = [round(float(a), 6) for a in azi1]
+        return Stations(accums[:-1], x_1, y_1, azi=azi, p_type=p_type)
+
     def _get_pts_clot_in(self, start, end, interv):
-        """Return list of axis points of clothoid in, and set the rest to
+        """Return the stations of clothoid in, and set the rest to
         the end of the clothoid and accum length
         """
-        accum = self.pts_accum
-        list_pts = []
-        while start <= end:
-            if start == 0:
-                start = 0.0000001
-            rad_clo = self.a_clot ** 2 / start
-            tau_clo = start / (2 * rad_clo)
-            x_o, y_o = aprox_coord(start, tau_clo)
-            x_1, y_1 = self.cloth_global(x_o, y_o)
-            azi1 = self.pnt_azimuth(tau_clo)
-            list_pts.append(
-                RoadPoint(Point(x_1, y_1, 0), accum, round(azi1, 6), "Clot_in")
-            )
-            accum += interv
-            start = start + interv
-
-        self.pts_rest = end - (start - interv)
-        self.pts_accum = accum - interv
-        return list_pts
+        starts, last = loop_range(start, end, interv, 0.0000001)
+        self.pts_rest = end - (last - interv)
+        return self._stations(starts, interv, "Clot_in")
 
     def _get_pts_clot_out(self, start, end, interv):
-        """Return list of axis points of clothoid out, and set the rest to
+        """Return the stations of clothoid out, and set the rest to
         the end of the clothoid and accum length
         """
-        accum = self.pts_accum
-        list_pts = []
         start2 = self.length() - end
         end2 = self.length() - start
 
-        while start2 <= end2:
-            if end2 == 0:
-                end2 = 0.0000001
-
-            rad_clo = self.a_clot ** 2 / end2
-            tau_clo = end2 / (2 * rad_clo)
-            x_o, y_o = aprox_coord((end2), tau_clo)
-            x_1, y_1 = self.cloth_global(x_o, y_o)
-            azi1 = self.pnt_azimuth(tau_clo)
-            list_pts.append(
-                RoadPoint(Point(x_1, y_1, 0), accum, round(azi1, 6), "Clot_out")
-            )
-            accum += interv
-            end2 = end2 - interv
-
-        self.pts_rest = start2 + (end2 + interv)
-        self.pts_accum = accum - interv
-
-        return list_pts
+        ends, last = loop_range(end2, start2, -interv, 0.0000001)
+        self.pts_rest = start2 + (last + interv)
+        return self._stations(ends, interv, "Clot_out")
 
     def _pnt_ar(self):
         """Return the first point of the clothoid in"""
@@ -12,11 +12,13 @@ import math
 
 # import grass.script as grass
 import re
+
+import numpy as np
 from grass.pygrass.vector import VectorTopo
 import road_base as Base
 from road_plant import Aligns
 
-# from grass.pygrass.vector.geometry import Point
+from grass.pygrass.vector.geometry import Point
 from grass.pygrass.vector.geometry import Line
 
 # from grass.pygrass.vector.geometry import Boundary
@@ -530,39 +532,107 @@ class DisplLine(Aligns, object):
 
         return elev
 
+    def _in_lim(self, i, npk):
+        """Return if the pk is in the limits of the align i"""
+        if isinstance(self.list_aligns[i], Base.Curve):
+            cuv_lim = npk <= self.list_lim[i + 1]
+        else:
+            cuv_lim = npk < self.list_lim[i + 1]
+        return (self.list_lim[i] <= npk) & cuv_lim
+
+    def _set_displ(self, i, r_pnt, r_pnt_d):
+        """Set distance, elevation and inclination of a displaced point"""
+        r_pnt_d.dist_displ = round(r_pnt_d.distance2(r_pnt.point2d), 4)
+        elev = self.get_elev(i, r_pnt, r_pnt_d.dist_displ)
+        r_pnt_d.z = elev + r_pnt.z
+        if r_pnt_d.dist_displ == 0:
+            r_pnt_d.incli = 0
+        else:
+            r_pnt_d.incli = math.atan(elev / r_pnt_d.dist_displ)
+
+        r_pnt_d.acum_pk = self.list_lim[i] + r_pnt_d.npk
+
     def find_cutoff(self, r_pnt):
         """Return"""
 
         for i in range(len(self.list_lim) - 1):
-            if isinstance(self.list_aligns[i], Base.Curve):
-                cuv_lim = r_pnt.npk <= self.list_lim[i + 1]
-            else:
-                cuv_lim = r_pnt.npk < self.list_lim[i + 1]
 
-            if self.list_lim[i] <= r_pnt.npk and cuv_lim:
+            if self._in_lim(i, r_pnt.npk):
 
                 if self.list_aligns[i] is not None:
                     r_pnt_d = self.list_aligns[i].find_cutoff(r_pnt)
 
                     if r_pnt_d is not None:
-                        r_pnt_d.dist_displ = round(r_pnt_d.distance2(r_pnt.point2d), 4)
-                        elev = self.get_elev(i, r_pnt, r_pnt_d.dist_displ)
-                        r_pnt_d.z = elev + r_pnt.z
-                        if r_pnt_d.dist_displ == 0:
-                            r_pnt_d.incli = 0
-                        else:
-                            r_pnt_d.incli = math.atan(elev / r_pnt_d.dist_displ)
-
-                        r_pnt_d.acum_pk = self.list_lim[i] + r_pnt_d.npk
+                        self._set_displ(i, r_pnt, r_pnt_d)
 
                     return r_pnt_d
 
-    def get_pnts_displ(self, list_r_pnts, line=False):
-        """Return a displaced line of a given axis"""
+    def _parallel_pnts(self, i, list_r_pnts):
+        """Return the displaced points of the parallel align i"""
+        paral = self.list_aligns[i]
+        for r_pnt in list_r_pnts:
+            if r_pnt.azi == 0:
+                r_pnt.azi = math.pi / 2
+        npks = np.array([r_pnt.npk for r_pnt in list_r_pnts], dtype=float)
+        azis = np.array([r_pnt.azi for r_pnt in list_r_pnts], dtype=float)
+        x_0 = np.array([r_pnt.x for r_pnt in list_r_pnts], dtype=float)
+        y_0 = np.array([r_pnt.y for r_pnt in list_r_pnts], dtype=float)
+
+        distx = paral.dist1 + ((npks - paral.pk1) * (paral.dist2 - paral.dist1)) / (
+            paral.pk2 - paral.pk1
+        )
+        x_1 = x_0 + distx * np.sin(azis + self.g90)
+        y_1 = y_0 + distx * np.cos(azis + self.g90)
+        dists = np.sqrt(
+            (np.array([r_pnt.point2d.x for r_pnt in list_r_pnts]) - x_1) ** 2
+            + (np.array([r_pnt.point2d.y for r_pnt in list_r_pnts]) - y_1) ** 2
+        )
+        elevs = self.elev_lim[i] + (
+            (npks - self.list_lim[i]) * (self.elev_lim[i + 1] - self.elev_lim[i])
+        ) / (self.list_lim[i + 1] - self.list_lim[i])
+
         list_pnts_d = []
+        for k, r_pnt in enumerate(list_r_pnts):
+            r_pnt_d = Base.RoadPoint(
+                Point(float(x_1[k]), float(y_1[k])), r_pnt.npk, r_pnt.azi, r_pnt.p_type
+            )
+            r_pnt_d.dist_displ = round(float(dists[k]), 4)
+            elev = float(elevs[k])
+            if self.plant.bombeo:
+                elev = self._find_superelev(r_pnt, elev, r_pnt_d.dist_displ)
+            r_pnt_d.z = elev + r_pnt.z
+            if r_pnt_d.dist_displ == 0:
+                r_pnt_d.incli = 0
+            else:
+                r_pnt_d.incli = math.atan(elev / r_pnt_d.dist_displ)
+            r_pnt_d.acum_pk = self.list_lim[i] + r_pnt_d.npk
+            list_pnts_d.append(r_pnt_d)
+        return list_pnts_d
 
-        for r_pnt in list_r_pnts:
-            list_pnts_d.append(self.find_cutoff(r_pnt))
+    def get_pnts_displ(self, list_r_pnts, line=False):
+        """Return a displaced line of a given axis, computing the points of
+        each parallel align at once"""
+        list_pnts_d = [None] * len(list_r_pnts)
+        npks = np.array([r_pnt.npk for r_pnt in list_r_pnts], dtype=float)
+        aligns = np.full(len(list_r_pnts), -1)
+        for i in range(len(self.list_lim) - 1):
+            if self.list_aligns[i] is not None:
+                aligns[(aligns == -1) & self._in_lim(i, npks)] = i
+
+        for i in np.unique(aligns[aligns != -1]).tolist():
+            index = np.flatnonzero(aligns == i).tolist()
+            r_pnts = [list_r_pnts[j] for j in index]
+            if isinstance(self.list_aligns[i], Parallel):
+                pnts_d = self._parallel_pnts(i, r_pnts)
+            else:
+                pnts_d = []
+                for r_pnt in r_pnts:
+                    r_pnt_d = self.list_aligns[i].find_cutoff(r_pnt)
+                    if r_pnt_d is not None:
+                        self._set_displ(i, r_pnt, r_pnt_d)
+                    pnts_d.append(r_pnt_d)
+            for j, r_pnt_d in zip(index, pnts_d):
+                list_pnts_d[j] = r_pnt_d
 
         if line:
             return Line(list_pnts_d)
@@ -700,10 +770,24 @@ class Displaced(object):
         return [list_pnts_d_left, list_pnts_d_right]
 
     def get_pnts_trans(self, list_r_pnts):
-        """Return"""
+        """Return all displaced points of the given axis points"""
+        lines_d = [d_line.get_pnts_displ(list_r_pnts) for d_line in self.displines]
         list_pnts_d = []
-        for r_pnt in list_r_pnts:
-            list_pnts_d.append(self.find_cutoff(r_pnt))
+        for i in range(len(list_r_pnts)):
+            list_pnts_d.append(
+                [
+                    [
+                        pnts_d[i]
+                        for d_line, pnts_d in zip(self.displines, lines_d)
+                        if d_line.left
+                    ],
+                    [
+                        pnts_d[i]
+                        for d_line, pnts_d in zip(self.displines, lines_d)
+                        if not d_line.left
+                    ],
+                ]
+            )
         return list_pnts_d
 
     def get_lines(self):
@@ -5,6 +5,7 @@ Created on Wed Jul 23 18:37:36 2014
 @author: meskal
 """
 
+import bisect
 import math
 import time
 import road_base as Base
@@ -107,6 +108,11 @@ class Aligns(object):
 
     def get_roadpnts(self, start, end, interv, interv_c=None):
         """Return"""
+        return self.get_stations(start, end, interv, interv_c).get_roadpnts()
+
+    def get_stations(self, start, end, interv, interv_c=None):
+        """Return the stations from start to end, each interv in straights
+        and interv_c in curves and clothoids"""
         if not interv_c:
             interv_c = interv
 
@@ -114,7 +120,7 @@ class Aligns(object):
             end = self.length()
         resto = interv
         accum = start
-        list_pts = []
+        list_stations = []
         ini = 0
         fin = len(self.leng_accum)
         for i in range(len(self.leng_accum) - 1):
@@ -130,17 +136,15 @@ class Aligns(object):
         rango_ant = []
         for i in range(ini, fin):
 
-            rango = []
             if isinstance(self.list_aligns[i], Base.Straight):
                 inter = interv
-                for j in range(len(rang_int) - 1):
-                    if self.leng_accum[i] <= rang_int[j] <= self.leng_accum[i + 1]:
-                        rango.append(rang_int[j])
+                rang = rang_int[:-1]
             else:
                 inter = interv_c
-                for j in range(len(rang_int_c) - 1):
-                    if self.leng_accum[i] <= rang_int_c[j] <= self.leng_accum[i + 1]:
-                        rango.append(rang_int_c[j])
+                rang = rang_int_c[:-1]
+            low = bisect.bisect_left(rang, self.leng_accum[i])
+            high = bisect.bisect_right(rang, self.leng_accum[i + 1])
+            rango = list(rang[low:high])
 
             if inter > self.list_aligns[i].length() + resto:
                 resto = resto + self.list_aligns[i].length()
@@ -160,10 +164,11 @@ class Aligns(object):
 
             self.list_aligns[i].pts_accum = accum
 
-            pnts = self.list_aligns[i].get_roadpnts(start2, end2, inter)
-            for pnt in pnts:
-                pnt.align = self.list_aligns[i].__class__.__name__ + "_" + str(i + 1)
-            list_pts.extend(pnts)
+            stations = self.list_aligns[i].get_stations(start2, end2, inter)
+            stations.set_align(
+                self.list_aligns[i].__class__.__name__ + "_" + str(i + 1)
+            )
+            list_stations.append(stations)
 
             resto = self.list_aligns[i].pts_rest
             accum = self.list_aligns[i].pts_accum
@@ -174,11 +179,14 @@ class Aligns(object):
         r_pnt.align = (
             self.list_aligns[-1].__class__.__name__ + "_" + str(len(self.list_aligns))
         )
-        if list_pts[-1].npk != r_pnt.npk:
+        stations = Base.Stations.concat(list_stations)
+        if stations.npk[-1] != r_pnt.npk:
             r_pnt.npk = round(r_pnt.npk, 6)
-            list_pts.append(r_pnt)
+            stations = Base.Stations.concat(
+                [stations, Base.Stations.from_roadpnts([r_pnt])]
+            )
 
-        return list_pts
+        return stations
 
     def get_segments_pnts(self, puntos, vert=None, line=False):
         """Return"""
@@ -10,6 +10,8 @@ Created on Thu Sep 11 00:29:15 2014
 #
 import math
 
+import numpy as np
+
 # import road_base as Base
 # from grass.pygrass.raster import RasterRow
 
@@ -115,11 +117,10 @@ class LongProfile(object):
         lim_sup = int(r_line[-1].npk)
         if lim_sup % self.mark_x_dist != 0:
             lim_sup += self.mark_x_dist
-        rang = range(0, lim_sup, self.mark_x_dist)
 
         label_npk, label_z, label_terr, label_cotaroja = [], [], [], []
         for r_pnt in r_line:
-            if r_pnt.npk in rang:
+            if 0 <= r_pnt.npk < lim_sup and r_pnt.npk % self.mark_x_dist == 0:
                 # pnts_marks.append(r_pnt)
                 label_npk.append(r_pnt.npk)
                 label_z.append(round(r_pnt.z, 4))
@@ -170,29 +171,25 @@ class LongProfile(object):
             lines.append(self._ras(r_line))
         return lines
 
+    def _line(self, npks, elevs):
+        """Return the profile line of the elevations at the pks"""
+        x_1 = np.asarray(npks, dtype=float) + self.zero_x
+        y_1 = (
+            np.asarray(elevs, dtype=float) - self.min_elev
+        ) * self.scale + self.zero_y
+        return Line(list(zip(x_1.tolist(), y_1.tolist())))
+
     def _ras(self, r_line):
         """Return(self.max_elev - self.min_elev)"""
-        line = []
-        for r_pnt in r_line:
-            line.append(
-                Point(
-                    r_pnt.npk + self.zero_x,
-                    (r_pnt.z - self.min_elev) * self.scale + self.zero_y,
-                )
-            )
-        return Line(line)
+        return self._line(
+            [r_pnt.npk for r_pnt in r_line], [r_pnt.z for r_pnt in r_line]
+        )
 
     def _terr(self, r_line):
         """Return"""
-        line = []
-        for r_pnt in r_line:
-            line.append(
-                Point(
-                    r_pnt.npk + self.zero_x,
-                    (r_pnt.terr - self.min_elev) * self.scale + self.zero_y,
-                )
-            )
-        return Line(line)
+        return self._line(
+            [r_pnt.npk for r_pnt in r_line], [r_pnt.terr for r_pnt in r_line]
+        )
 
     def get_ras_terr(self, puntos, vert):
         """Return"""
@@ -838,8 +838,23 @@ class RoadTables(object):
             map_out.close()
 
             map_out.open("rw", layer=layer, with_z=True)
+        # write the features directly and insert all their attributes in
+        # one transaction
         for i, obj in enumerate(objs):
-            map_out.write(obj, i + 1, values[i])
+            libvect.Vect_reset_cats(obj.c_cats)
+            libvect.Vect_cat_set(obj.c_cats, layer, i + 1)
+            result = libvect.Vect_write_line(
+                map_out.c_mapinfo, obj.gtype, obj.c_points, obj.c_cats
+            )
+            if result == -1:
+                raise GrassError("Not able to write the vector feature.")
+        cur = map_out.table.conn.cursor()
+        map_out.table.insert(
+            [[i + 1] + list(vals) for i, vals in enumerate(values)],
+            cursor=cur,
+            many=True,
+        )
+        cur.close()
         map_out.table.conn.commit()
         map_out.close()
 
@@ -6,9 +6,12 @@ Created on Thu Sep 11 00:29:15 2014
 """
 
 import math
+from collections import OrderedDict
 
 # import time
 
+import numpy as np
+
 import road_base as Base
 from grass.pygrass.raster import RasterRow
 
@@ -20,6 +23,14 @@ from grass.pygrass.vector.geometry import Boundary
 
 # from grass.pygrass.vector.geometry import Area
 
+CNULL = -2147483648
+# rows and columns of the blocks of the elevation model read at once
+BLOCK = 256
+# blocks kept in memory, 64 MB
+MAX_BLOCKS = 256
+# maximum length of the slopes
+MAX_LENGTH = 1000
+
 
 def get_rgb(type_terr):
     """Return"""
@@ -62,89 +73,104 @@ class Talud(object):
         self.roadlines = []
         self.roadline = None
 
-    def _get_cutfill_slope(self, r_pnt_d):
-        """Return"""
-        for i in range(len(self.pks) - 1):
-            if self.pks[i] <= r_pnt_d.npk < self.pks[i + 1]:
-
-                if r_pnt_d.z < r_pnt_d.terr:
-                    slope = self.cut
-                else:
-                    slope = self.fill
-
-                if slope[i] is not None or slope[i + 1] is not None:
-
-                    return slope[i] + (
-                        (r_pnt_d.npk - self.pks[i]) * (slope[i + 1] - slope[i])
-                    ) / (self.pks[i + 1] - self.pks[i])
-
-    def _funct(self, r_pnt_d, len_i, sig, azim, slope):
-        """Return"""
-        x_1 = r_pnt_d.x + len_i * math.sin(azim)
-        y_1 = r_pnt_d.y + len_i * math.cos(azim)
-        z_t = self.terr.get_value(Base.Point(x_1, y_1))
-        z_1 = r_pnt_d.z + sig * len_i * slope
-        return dict(zip(["z_1", "z_t", "x_1", "y_1"], [z_1, z_t, x_1, y_1]))
+    def _get_cutfill_slopes(self, npks, cut):
+        """Return the cut or fill slopes interpolated at the npks, NaN
+        outside the pks"""
+        slopes = np.full(len(npks), np.nan)
+        if len(self.pks) < 2:
+            return slopes
+        pks = np.array(self.pks, dtype=float)
+        idx = np.searchsorted(pks, npks, side="right") - 1
+        valid = (idx >= 0) & (idx < len(pks) - 1)
+        idx = idx[valid]
+        cut = cut[valid]
+        slope_a = np.where(cut, np.take(self.cut, idx), np.take(self.fill, idx))
+        slope_b = np.where(cut, np.take(self.cut, idx + 1), np.take(self.fill, idx + 1))
+        slopes[valid] = slope_a + (npks[valid] - pks[idx]) * (slope_b - slope_a) / (
+            pks[idx + 1] - pks[idx]
+        )
+        return slopes
 
     def get_pnt_slope(self, r_pnt, r_pnt_d):
         """Return"""
-        azim = r_pnt_d.azi + self.g90
-
-        if r_pnt_d.z > r_pnt_d.terr:  # Terraplen
-            sig = -1
-            type_t = "Fill"
-        else:
-            sig = 1
-            type_t = "Cut"
-
-        z_t = r_pnt_d.terr
-        z_1 = r_pnt_d.z
-
-        slop = self._get_cutfill_slope(r_pnt_d)
-        if slop is None:
-            return None
-
-        len_i = 0
-        while -sig * z_1 > -sig * z_t or len_i > 1000:
-            len_i += 1
-
-            x_1 = r_pnt_d.x + len_i * math.sin(azim)
-            y_1 = r_pnt_d.y + len_i * math.cos(azim)
-            z_t = self.terr.get_value(Base.Point(x_1, y_1))
-            z_1 = r_pnt_d.z + sig * len_i * slop
-
-        len_a = len_i - 1
-        len_b = len_i
-        len_c = (len_a + len_b) / 2.0
-
-        while (len_b - len_a) / 2.0 > 0.001:
-            eq_c = self._funct(r_pnt_d, len_c, sig, azim, slop)
-            eq_a = self._funct(r_pnt_d, len_a, sig, azim, slop)
-            if eq_c["z_1"] == eq_c["z_t"]:
-                break
-            elif (eq_a["z_1"] - eq_a["z_t"]) * (eq_c["z_1"] - eq_c["z_t"]) < 0:
-                len_b = len_c
-            else:
-                len_a = len_c
-            len_c = (len_a + len_b) / 2.0
-
-        eq_c = self._funct(r_pnt_d, len_c, sig, azim, slop)
-        pnt = Base.RoadPoint(
-            Point(eq_c["x_1"], eq_c["y_1"], eq_c["z_1"]), r_pnt.npk, r_pnt_d.azi, ""
-        )
-        pnt.terr_type = type_t
-        pnt.dist_displ = pnt.distance(r_pnt)
-        return pnt
+        return self.get_pnts_slope([r_pnt], [r_pnt_d])[0]
 
     def get_pnts_slope(self, list_r_pnts, list_pnts_d):
-        """Return"""
-        list_pnts_t = []
-        for i, r_pnt_d in enumerate(list_pnts_d):
-            if r_pnt_d is not None:
-                pnt_t = self.get_pnt_slope(list_r_pnts[i], r_pnt_d)
-                list_pnts_t.append(pnt_t)
-            else:
-                list_pnts_t.append(None)
+        """Return the slope points of all the displaced points at once,
+        marching along the rays in 1 m steps and bisecting the last one"""
+        list_pnts_t = [None] * len(list_pnts_d)
+        index = [i for i, r_pnt_d in enumerate(list_pnts_d) if r_pnt_d is not None]
+        if not index:
+            return list_pnts_t
+
+        pnts_d = [list_pnts_d[i] for i in index]
+        x_0 = np.array([r_pnt_d.x for r_pnt_d in pnts_d], dtype=float)
+        y_0 = np.array([r_pnt_d.y for r_pnt_d in pnts_d], dtype=float)
+        z_0 = np.array([r_pnt_d.z for r_pnt_d in pnts_d], dtype=float)
+        terr = np.array([r_pnt_d.terr for r_pnt_d in pnts_d], dtype=float)
+        npks = np.array([r_pnt_d.npk for r_pnt_d in pnts_d], dtype=float)
+        azim = np.array([r_pnt_d.azi for r_pnt_d in pnts_d], dtype=float) + self.g90
+        sin_a = np.sin(azim)
+        cos_a = np.cos(azim)
+
+        fill = z_0 > terr  # Terraplen
+        sig = np.where(fill, -1.0, 1.0)
+        slop = self._get_cutfill_slopes(npks, z_0 < terr)
+
+        def funct(len_i, sel):
+            """Return the elevations of the slope and the terrain"""
+            z_t = self.terr.get_values(
+                x_0[sel] + len_i * sin_a[sel], y_0[sel] + len_i * cos_a[sel]
+            )
+            z_1 = z_0[sel] + sig[sel] * len_i * slop[sel]
+            return z_1, z_t
+
+        valid = ~np.isnan(slop) & ~np.isnan(terr)
+        active = valid & (-sig * z_0 > -sig * terr)
+        len_i = np.zeros(len(pnts_d))
+        for _ in range(MAX_LENGTH):
+            if not active.any():
+                break
+            sel = np.flatnonzero(active)
+            len_i[sel] += 1
+            z_1, z_t = funct(len_i[sel], sel)
+            # rays leaving the terrain do not cut it
+            valid[sel[np.isnan(z_t)]] = False
+            active[sel] = -sig[sel] * z_1 > -sig[sel] * z_t
+        valid &= ~active
+
+        sel = np.flatnonzero(valid)
+        len_a = len_i[sel] - 1
+        len_b = len_i[sel]
+        len_c = (len_a + len_b) / 2.0
+        found = np.zeros(len(sel), dtype=bool)
+        step = 1.0
+        while step / 2.0 > 0.001:
+            z_1c, z_tc = funct(len_c, sel)
+            z_1a, z_ta = funct(len_a, sel)
+            found |= z_1c == z_tc
+            lower = ~found & ((z_1a - z_ta) * (z_1c - z_tc) < 0)
+            upper = ~found & ~lower
+            len_b[lower] = len_c[lower]
+            len_a[upper] = len_c[upper]
+            len_c = np.where(found, len_c, (len_a + len_b) / 2.0)
+            step /= 2.0
+
+        x_1 = x_0[sel] + len_c * sin_a[sel]
+        y_1 = y_0[sel] + len_c * cos_a[sel]
+        z_1 = z_0[sel] + sig[sel] * len_c * slop[sel]
+        for k, j in enumerate(sel):
+            i = index[j]
+            r_pnt = list_r_pnts[i]
+            pnt = Base.RoadPoint(
+                Point(float(x_1[k]), float(y_1[k]), float(z_1[k])),
+                r_pnt.npk,
+                pnts_d[j].azi,
+                "",
+            )
+            pnt.terr_type = "Fill" if fill[j] else "Cut"
+            pnt.dist_displ = pnt.distance(r_pnt)
+            list_pnts_t[i] = pnt
         return list_pnts_t
 
     def split_slope_line(self, rline):
@@ -331,43 +357,121 @@ class Taludes(object):
 
 
 class Terrain(object):
-    """Return"""
+    """Elevation model read on demand in blocks of the current region"""
 
     def __init__(self, mapname=None):
         """Return"""
         self.mapname = mapname
 
-        self.elev = []
-        self._init_elev()
-
-        region = Region()
-        self.xref = region.west
-        self.yref = region.north
-        self.xres = region.ewres
-        self.yres = region.nsres
-
-    def _init_elev(self):
-        """Return"""
-        with RasterRow(self.mapname) as rrow:
-            for row in rrow:
-                self.elev.append([])
-                for elem in row:
-                    self.elev[-1].append(elem)
+        self.region = Region()
+        self.xref = self.region.west
+        self.yref = self.region.north
+        self.xres = self.region.ewres
+        self.yres = self.region.nsres
+        self.rows = self.region.rows
+        self.cols = self.region.cols
+
+        self.blocks = OrderedDict()
+
+    def _block(self, brow, bcol):
+        """Return the block of elevations as float32 array, NaN for nulls"""
+        key = (brow, bcol)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+
+        row_0 = brow * BLOCK
+        col_0 = bcol * BLOCK
+        row_1 = min(row_0 + BLOCK, self.rows)
+        col_1 = min(col_0 + BLOCK, self.cols)
+        reg = Region()
+        reg.north = self.yref - row_0 * self.yres
+        reg.south = self.yref - row_1 * self.yres
+        reg.west = self.xref + col_0 * self.xres
+        reg.east = self.xref + col_1 * self.xres
+        reg.nsres = self.yres
+        reg.ewres = self.xres
+        reg.adjust()
+        reg.set_raster_region()
+        try:
+            with RasterRow(self.mapname) as rrow:
+                block = np.array(
+                    [rrow[row] for row in range(row_1 - row_0)], dtype=np.float64
+                )
+                if rrow.mtype == "CELL":
+                    block[block == CNULL] = np.nan
+        finally:
+            self.region.set_raster_region()
+        block = block.reshape(row_1 - row_0, col_1 - col_0).astype(np.float32)
+
+        self.blocks[key] = block
+        if len(self.blocks) > MAX_BLOCKS:
+            self.blocks.popitem(last=False)
+        return block
+
+    def _cells(self, rows, cols):
+        """Return the elevations of the cells, NaN outside the region"""
+        values = np.full(rows.shape, np.nan)
+        inside = np.flatnonzero(
+            (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols)
+        )
+        rows = rows[inside]
+        cols = cols[inside]
+        keys, inverse = np.unique(
+            (rows // BLOCK) * self.cols + cols // BLOCK, return_inverse=True
+        )
+        for k, key in enumerate(keys):
+            brow, bcol = divmod(key, self.cols)
+            sel = inverse == k
+            block = self._block(brow, bcol)
+            values[inside[sel]] = block[
+                rows[sel] - brow * BLOCK, cols[sel] - bcol * BLOCK
+            ]
+        return values
+
+    def get_values(self, x, y):
+        """Return the elevations at the coordinates, interpolated bilinearly
+        between the cell centers or the value of the cell next to nulls,
+        NaN outside the region"""
+        col = (np.asarray(x, dtype=float) - self.xref) / self.xres
+        row = (self.yref - np.asarray(y, dtype=float)) / self.yres
+        col_0 = np.floor(col - 0.5).astype(int)
+        row_0 = np.floor(row - 0.5).astype(int)
+        t_col = col - 0.5 - col_0
+        t_row = row - 0.5 - row_0
+
+        values = (
+            self._cells(row_0, col_0) * (1 - t_col)
+            + self._cells(row_0, col_0 + 1) * t_col
+        ) * (1 - t_row) + (
+            self._cells(row_0 + 1, col_0) * (1 - t_col)
+            + self._cells(row_0 + 1, col_0 + 1) * t_col
+        ) * t_row
+
+        nulls = np.isnan(values)
+        if nulls.any():
+            values[nulls] = self._cells(
+                np.floor(row[nulls]).astype(int), np.floor(col[nulls]).astype(int)
+            )
+        return values
 
     def get_value(self, point):
         """Return"""
-        pto_col = int((point.x - self.xref) / self.xres)
-        pto_row = int((self.yref - point.y) / self.yres)
-
-        return self.elev[pto_row][pto_col]
+        return float(self.get_values([point.x], [point.y])[0])
 
     def set_pnts_terr(self, list_r_pnts):
         """Return"""
+        r_pnts = []
         for r_pnt in list_r_pnts:
-            if r_pnt is not None:
-                self.set_pnt_terr(r_pnt)
-            else:
-                return None
+            if r_pnt is None:
+                break
+            r_pnts.append(r_pnt)
+        if r_pnts:
+            values = self.get_values(
+                [r_pnt.x for r_pnt in r_pnts], [r_pnt.y for r_pnt in r_pnts]
+            )
+            for r_pnt, value in zip(r_pnts, values):
+                r_pnt.terr = float(value)
 
     def set_pnt_terr(self, r_pnt):
         """Return"""
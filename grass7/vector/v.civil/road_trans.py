@@ -281,13 +281,18 @@ class Trans(object):
             )
         return list_lines, list_attrs
 
+    def set_displ(self, displaced):
+        """Set the displaced points of all the cross sections at once"""
+        list_pnts_d = displaced.get_pnts_trans([t_ali.r_pnt for t_ali in self.t_aligns])
+        for t_ali, pnts_d in zip(self.t_aligns, list_pnts_d):
+            t_ali.displ_left, t_ali.displ_right = pnts_d
+
     def get_pnts_trans(self, displ):
         """Return"""
         list_pnts = []
         list_attrs = []
+        self.set_displ(displ)
         for t_ali in self.t_aligns:
-            t_ali.set_displ(displ)
-
             #            list_pnts.extend(t_ali.displ_left + t_ali.displ_right)
             for i, r_pnt in enumerate(t_ali.displ_left + t_ali.displ_right):
                 if r_pnt is not None:
@@ -304,13 +309,40 @@ class Trans(object):
 
         return list_pnts, list_attrs
 
+    def set_taludes(self, taludes, terr):
+        """Set the slope points of all the cross sections at once"""
+        t_alis = [
+            t_ali
+            for t_ali in self.t_aligns
+            if t_ali.displ_left != [] and t_ali.displ_left[-1] is not None
+        ]
+        r_pnts_d = [t_ali.displ_left[-1] for t_ali in t_alis]
+        terr.set_pnts_terr(r_pnts_d)
+        pnts_t = taludes.talud_left.get_pnts_slope(
+            [t_ali.r_pnt for t_ali in t_alis], r_pnts_d
+        )
+        for t_ali, pnt_t in zip(t_alis, pnts_t):
+            t_ali.talud_left = pnt_t
+
+        t_alis = [
+            t_ali
+            for t_ali in self.t_aligns
+            if t_ali.displ_right != [] and t_ali.displ_right[-1] is not None
+        ]
+        r_pnts_d = [t_ali.displ_right[-1] for t_ali in t_alis]
+        terr.set_pnts_terr(r_pnts_d)
+        pnts_t = taludes.talud_right.get_pnts_slope(
+            [t_ali.r_pnt for t_ali in t_alis], r_pnts_d
+        )
+        for t_ali, pnt_t in zip(t_alis, pnts_t):
+            t_ali.talud_right = pnt_t
+
     def get_pnts_trans_terr(self, displ, taludes, terr):
         """Return"""
         list_pnts = []
         list_attrs = []
+        self.set_taludes(taludes, terr)
         for t_ali in self.t_aligns:
-            t_ali.set_talud(taludes, terr)
-
             for i, r_pnt in enumerate([t_ali.talud_left, t_ali.talud_right]):
                 if r_pnt is not None and r_pnt.npk != -1:
 
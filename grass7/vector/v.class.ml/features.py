@@ -29,8 +29,10 @@ def importances(
     csv="",
     img="",
     clf=ExtraTreesClassifier(n_estimators=N_ESTIMATORS, random_state=RANDOM_STATE),
+    n_jobs=1,
     **savefig
 ):
+    clf.set_params(n_jobs=n_jobs)
     clf.fit(X, y)
     imp = clf.feature_importances_
     std = np.std([est.feature_importances_ for est in clf.estimators_], axis=0)
@@ -5,11 +5,15 @@ Created on Wed Nov  6 15:08:38 2013
 @author: pietro
 """
 from __future__ import absolute_import, division, print_function
+import os
 import time
-import random as rnd
+import hashlib
+import shutil
+import tempfile
 from gettext import lgettext as _
 import sys
 import pickle as pk
+from multiprocessing import Pool
 
 import numpy as np
 import matplotlib  # required by windows
@@ -28,7 +32,6 @@ from sklearn.metrics import (
 from sklearn.cross_validation import StratifiedKFold
 from sklearn.grid_search import GridSearchCV
 from sklearn.svm import SVC
-from sklearn.cross_validation import cross_val_score
 
 # from grass.pygrass.messages import get_msgr
 
@@ -129,63 +132,149 @@ def reduce_cls(Yt, subs):
     return Yr
 
 
-def balance_cls(data, num):
-    indx = np.random.randint(0, len(data), size=num)
-    return data[indx]
-
-
-def balance(tdata, tclss, num=None):
+def balance_indexes(tclss, num=None, rng=np.random):
     clss = sorted(set(tclss))
     num = num if num else min([len(tclss[tclss == c]) for c in clss])
-    dt = []
-    for c in clss:
-        dt.extend([(c, d) for d in balance_cls(tdata[tclss == c], num)])
-    rnd.shuffle(dt)
-    bclss = np.array([r[0] for r in dt], dtype=int)
-    bdata = np.array([r[1] for r in dt])
-    return bdata, bclss
+    indx = np.concatenate(
+        [rng.choice((tclss == c).nonzero()[0], size=num) for c in clss]
+    )
+    rng.shuffle(indx)
+    return indx
+
+
+def balance(tdata, tclss, num=None, seed=None):
+    """Return a random subset of the training with num samples per class,
+    the same seed gives the same subset"""
+    indx = balance_indexes(tclss, num, np.random.RandomState(seed))
+    return tdata[indx], tclss[indx]
+
+
+# training data and parameters shared by the workers of TrainingPool
+SHARED = {}
+
+
+def init_worker(fdata, fclss, shared):
+    SHARED.clear()
+    SHARED["tdata"] = np.load(fdata, mmap_mode="r")
+    SHARED["tclss"] = np.load(fclss, mmap_mode="r")
+    SHARED.update(shared)
+
+
+class TrainingPool(object):
+    """Pool of processes sharing the training arrays, the arrays are saved
+    to npy files and memory mapped by each worker"""
+
+    def __init__(self, tdata, tclss, nprocs=1, **shared):
+        self.tmpdir = tempfile.mkdtemp(prefix="v.class.ml")
+        fdata = os.path.join(self.tmpdir, "tdata.npy")
+        fclss = os.path.join(self.tmpdir, "tclss.npy")
+        np.save(fdata, tdata)
+        np.save(fclss, tclss)
+        initargs = (fdata, fclss, shared)
+        if nprocs > 1:
+            self.pool = Pool(nprocs, initializer=init_worker, initargs=initargs)
+            self.map, self.imap = self.pool.map, self.pool.imap
+        else:
+            # run in the current process
+            self.pool = None
+            init_worker(*initargs)
+            self.map = lambda func, tasks: [func(task) for task in tasks]
+            self.imap = lambda func, tasks: (func(task) for task in tasks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        SHARED.clear()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def transform(Xt, Yt, tdata, scaler=None, decmp=None):
+    sXt, stdata = Xt, tdata
+    if scaler:
+        scaler.fit(sXt, Yt)
+        sXt = scaler.transform(sXt)
+        stdata = scaler.transform(stdata)
+    if decmp:
+        decmp.fit(sXt)
+        sXt = decmp.transform(sXt)
+        stdata = decmp.transform(stdata)
+    return sXt, stdata
+
+
+def optimize_round(seed):
+    tdata, tclss = SHARED["tdata"], SHARED["tclss"]
+    cls = SHARED["cls"].copy()
+    Xt, Yt = balance(tdata, tclss, SHARED["num"], seed)
+    sXt, stdata = transform(Xt, Yt, tdata, SHARED["scaler"], SHARED["decmp"])
+    test_classifier(cls, sXt, Yt, stdata, tclss, SHARED["labels"], verbose=False)
+    return seed, cls["c_acc_mean"]
+
+
+ROUNDS_DTYPE = [("seed", "i8"), ("score", "f8")]
 
 
 def optimize_training(
-    cls, tdata, tclss, labels, scaler=None, decmp=None, num=None, maxiterations=1000
+    cls,
+    tdata,
+    tclss,
+    labels,
+    scaler=None,
+    decmp=None,
+    num=None,
+    maxiterations=1000,
+    nprocs=1,
+    patience=0,
+    seed=None,
 ):
+    """Search the balanced training subset with the best mean accuracy,
+    each round draws a subset from its own seed. The search stops after
+    maxiterations rounds or after patience rounds without improvement.
+
+    Return the best classifier, its training subset and the array with
+    the seed and the score of each round, the subset of a seed is
+    reproduced by balance(tdata, tclss, num, seed).
+
+    The best classifier is fitted again on the subset of the best seed, its
+    score can differ from the best score of the rounds if the classifier
+    itself is not seeded."""
+    if maxiterations < 1:
+        raise ValueError("maxiterations must be greater than 0")
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, size=maxiterations)
+    shared = dict(cls=cls, labels=labels, scaler=scaler, decmp=decmp, num=num)
+    rounds = []
+    best_seed, best_score, stall = None, -np.inf, 0
+    with TrainingPool(tdata, tclss, nprocs, **shared) as pool:
+        # rounds are evaluated in order, the result does not depend on nprocs
+        for rseed, score in pool.imap(optimize_round, seeds):
+            rounds.append((rseed, score))
+            if score > best_score:
+                print("%f > %f" % (score, best_score))
+                best_seed, best_score, stall = rseed, score, 0
+            else:
+                stall += 1
+                if patience and stall >= patience:
+                    break
+    rounds = np.array(rounds, dtype=ROUNDS_DTYPE)
+    # fit again the best classifier
     best = cls.copy()
-    best["c_acc_mean"] = 0
-    means = []
-    # msgr = get_msgr()
-    for i in range(maxiterations):  # TODO: use multicore
-        # msgr.percent(i, maxiterations, 1)
-        Xt, Yt = balance(tdata, tclss, num)
-        stdata = None
-        sXt = None
-        if scaler:
-            scaler.fit(Xt, Yt)
-            sXt = scaler.transform(Xt)
-            stdata = scaler.transform(tdata)
-        if decmp:
-            sXt = sXt if sXt else Xt
-            stdata = stdata if stdata else tdata
-            decmp.fit(sXt)
-            sXt = decmp.transform(sXt)
-            stdata = decmp.transform(stdata)
-        if scaler is None and decmp is None:
-            sXt, stdata = Xt, tdata
-        test_classifier(cls, sXt, Yt, stdata, tclss, labels, verbose=False)
-        if cls["c_acc_mean"] > best["c_acc_mean"]:
-            print("%f > %f" % (cls["c_acc_mean"], best["c_acc_mean"]))
-            best = cls.copy()
-            bXt, bYt = Xt, Yt
-        means.append(cls["c_acc_mean"])
-    means = np.array(means)
+    bXt, bYt = balance(tdata, tclss, num, best_seed)
+    sXt, stdata = transform(bXt, bYt, tdata, scaler, decmp)
+    test_classifier(best, sXt, bYt, stdata, tclss, labels, verbose=False)
+    best["seed"] = best_seed
+    means = rounds["score"]
     print(
-        "best accuracy: %f, number of iterations: %d"
-        % (best["c_acc_mean"], maxiterations)
+        "best accuracy: %f, number of iterations: %d, seed: %d"
+        % (best["c_acc_mean"], len(rounds), best_seed)
     )
     print("mean of means: %f" % means.mean())
     print("min of means: %f" % means.min())
     print("max of means: %f" % means.max())
     print("std of means: %f" % means.std())
-    return best, bXt, bYt
+    return best, bXt, bYt, rounds
 
 
 def plot_bias_variance(
@@ -296,42 +385,65 @@ def plot_ROC(fpr, tpr, auc_score, name, label, fmt="png", **kwargs):
     fig.savefig("roc__%s.%s" % (name.replace(" ", "_"), fmt), **kwargs)
 
 
-def bias_variance_analysis(cls, tdata, tclss, n_folds=5, step=5):
+def fit_score(task):
+    classifier, kwargs, train, test = task
+    X, y = SHARED["tdata"], SHARED["tclss"]
+    clf = classifier(**kwargs)
+    clf.fit(X[train], y[train])
+    return clf.score(X[train], y[train]), clf.score(X[test], y[test])
+
+
+def extra_fold(task):
+    classifier, kwargs, train, test = task
+    X, y = SHARED["tdata"], SHARED["tclss"]
+    clf = classifier(**kwargs)
+    clf.fit(X[train], y[train])
+    X_test, y_test = X[test], y[test]
+    y_pred = clf.predict(X_test)
+    return (
+        clf.score(X[train], y[train]),
+        clf.score(X_test, y_test),
+        confusion_matrix(y_test, y_pred),
+        clf.predict_proba(X_test),
+    )
+
+
+def bias_variance_analysis(
+    cls, tdata, tclss, n_folds=5, step=5, pool=None, nprocs=1, seed=None
+):
+    if pool is None:
+        with TrainingPool(tdata, tclss, nprocs) as pool:
+            return bias_variance_analysis(
+                cls, tdata, tclss, n_folds, step, pool, seed=seed
+            )
+    clss = sorted(set(tclss))
     num = min([len(tclss[tclss == c]) for c in clss])
-    clf = cls["classifier"](**cls["kwargs"])
-    bv = {}
+    rng = np.random.RandomState(seed)
+    sizes, tasks = [], []
     for n in range(5, num, step):
-        X, y = balance(tdata, tclss, n)
-        cv = StratifiedKFold(y, n_folds=n_folds)
-        # instantiate empty lists
-        train_errors, test_errors, scores = [], [], []
+        indx = balance_indexes(tclss, n, rng)
+        cv = StratifiedKFold(tclss[indx], n_folds=n_folds)
         for train, test in cv:
-            X_train, y_train = X[train], y[train]
-            X_test, y_test = X[test], y[test]
-
-            # fit train data
-            clf.fit(X_train, y_train)
-
-            # get score
-            train_score = clf.score(X_train, y_train)
-            test_score = clf.score(X_test, y_test)
-            scores.append(test_score)
-
-            # get errors
-            train_errors.append(1 - train_score)
-            test_errors.append(1 - test_score)
-
-        bv[n] = {
-            "test": np.array(test_errors),
-            "train": np.array(train_errors),
-            "score": np.array(scores),
-        }
+            sizes.append(n)
+            tasks.append((cls["classifier"], cls["kwargs"], indx[train], indx[test]))
+    bv = {}
+    for n, (train_score, test_score) in zip(sizes, pool.map(fit_score, tasks)):
+        res = bv.setdefault(n, {"test": [], "train": [], "score": []})
+        res["score"].append(test_score)
+        # get errors
+        res["train"].append(1 - train_score)
+        res["test"].append(1 - test_score)
+    for res in bv.values():
+        for key in res:
+            res[key] = np.array(res[key])
     cls["bias variance"] = bv
 
 
-def extra_analysis(cls, tdata, tclss, labels, n_folds=10):
+def extra_analysis(cls, tdata, tclss, labels, n_folds=10, pool=None, nprocs=1):
+    if pool is None:
+        with TrainingPool(tdata, tclss, nprocs) as pool:
+            return extra_analysis(cls, tdata, tclss, labels, n_folds, pool)
     clss = sorted(labels.keys())
-    lbs = [labels[cl] for cl in clss]
     cv = StratifiedKFold(tclss, n_folds=n_folds)
     keys = (
         "fprs",
@@ -344,24 +456,17 @@ def extra_analysis(cls, tdata, tclss, labels, n_folds=10):
     )
     train_errors, test_errors, scores, cms = [], [], [], []
     lk = {l: {k: [] for k in keys} for l in clss}
-    clf = cls["classifier"](**cls["kwargs"])
-    for train, test in cv:
-        X_train, y_train = tdata[train], tclss[train]
-        X_test, y_test = tdata[test], tclss[test]
-        # fit train data
-        clf.fit(X_train, y_train)
-
-        train_score = clf.score(X_train, y_train)
-        test_score = clf.score(X_test, y_test)
+    splits = list(cv)
+    tasks = [(cls["classifier"], cls["kwargs"], train, test) for train, test in splits]
+    for (train, test), res in zip(splits, pool.map(extra_fold, tasks)):
+        train_score, test_score, cm, proba = res
+        y_test = tclss[test]
         scores.append(test_score)
 
         train_errors.append(1 - train_score)
         test_errors.append(1 - test_score)
 
-        y_pred = clf.predict(X_test)
-        cms.append(confusion_matrix(y_test, y_pred))
-        # get probability
-        proba = clf.predict_proba(X_test)
+        cms.append(cm)
         # compute score for each class VS rest
         for idx, label in enumerate(clss):
             fpr, tpr, roc_thr = roc_curve(y_test, proba[:, idx], label)
@@ -409,62 +514,183 @@ def plot_extra(cls, labels, fmt="png", **kwargs):
     )
 
 
+def cross_val_fold(task):
+    classifier, kwargs, train, test = task
+    X, y = SHARED["tdata"], SHARED["tclss"]
+    try:
+        clf = classifier(**kwargs)
+        clf.fit(X[train], y[train])
+        return clf.score(X[test], y[test])
+    except Exception:
+        return None
+
+
+def stable_repr(value):
+    """Return a representation of value without memory addresses, estimators
+    are rendered from their parameters and callables from their names."""
+    if hasattr(value, "get_params"):
+        params = value.get_params()
+        return "%s.%s(%s)" % (
+            type(value).__module__,
+            type(value).__name__,
+            stable_repr(params),
+        )
+    if isinstance(value, dict):
+        items = sorted(value.items(), key=lambda item: str(item[0]))
+        return "{%s}" % ", ".join(
+            "%s: %s" % (stable_repr(key), stable_repr(val)) for key, val in items
+        )
+    if isinstance(value, (list, tuple)):
+        return "[%s]" % ", ".join(stable_repr(val) for val in value)
+    if isinstance(value, np.ndarray):
+        return "array(%s)" % array_digest(value)
+    if callable(value):
+        return "%s.%s" % (
+            getattr(value, "__module__", ""),
+            getattr(value, "__name__", type(value).__name__),
+        )
+    return repr(value)
+
+
+def array_digest(*arrays):
+    """Return the sha1 digest of the arrays without copying them."""
+    sha = hashlib.sha1()
+    for array in arrays:
+        sha.update(memoryview(np.ascontiguousarray(array)))
+    return sha.hexdigest()
+
+
+def cache_key(cls, digest, n_folds):
+    clf = cls["classifier"]
+    estimator = clf(**cls["kwargs"])
+    if hasattr(estimator, "get_params"):
+        params = estimator.get_params()
+    else:
+        params = cls["kwargs"]
+    key = "%s %s.%s %s %s %d" % (
+        cls["name"],
+        clf.__module__,
+        clf.__name__,
+        stable_repr(params),
+        digest,
+        n_folds,
+    )
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def load_cache(path):
+    try:
+        with open(path, "rb") as pkl:
+            return pk.load(pkl)
+    except Exception:
+        return None
+
+
+def save_cache(path, cls):
+    tmp = "%s.%d" % (path, os.getpid())
+    with open(tmp, "wb") as pkl:
+        pk.dump(cls, pkl)
+    os.replace(tmp, path)
+
+
 def explorer_clsfiers(
-    clsses, Xd, Yd, labels, indexes=None, n_folds=5, bv=False, extra=False
+    clsses,
+    Xd,
+    Yd,
+    labels,
+    indexes=None,
+    n_folds=5,
+    bv=False,
+    extra=False,
+    nprocs=1,
+    cache="",
 ):
-    gen = zip(indexes, clsses) if indexes else enumerate(clsses)
-    cv = StratifiedKFold(Yd, n_folds=n_folds, shuffle=True)
+    """Cross validate the classifiers, the (classifier, fold) units run
+    together on nprocs processes. The results of each classifier are stored
+    in the cache directory and reused while the classifier, its parameters
+    and the training do not change."""
+    gen = list(zip(indexes, clsses) if indexes else enumerate(clsses))
+    # fixed folds to compare the cached and the new results
+    cv = list(StratifiedKFold(Yd, n_folds=n_folds, shuffle=True, random_state=0))
     fmt = "%5d %-30s %6.4f %6.4f %6.4f %6.4f"
     res = []
     kw = dict(bbox_inches="tight", dpi=300)
-    for index, cls in gen:
-        try:
-            cls["scores"] = cross_val_score(
-                cls["classifier"](**cls["kwargs"]), Xd, Yd, cv=cv, n_jobs=1, verbose=0
-            )
-            # TODO: if n_jobs == -1 raise:
-            # AttributeError: '_MainProcess' object has no attribute '_daemonic'
-            mean, mx, mn, st = (
-                cls["scores"].mean(),
-                cls["scores"].max(),
-                cls["scores"].min(),
-                cls["scores"].std(),
-            )
-            vals = (index, cls["name"], mean, mx, mn, st)
-            print(fmt % vals)
-            res.append(vals)
-            if bv:
-                bias_variance_analysis(cls, Xd, Yd, n_folds=5, step=5)
-                bv = cls["bias variance"]
-                data_sizes = np.array(sorted(bv.keys()))
-                test = np.array([bv[i]["test"] for i in data_sizes])
-                train = np.array([bv[i]["train"] for i in data_sizes])
-                plot_bias_variance(
-                    data_sizes,
-                    train.mean(axis=1),
-                    test.mean(axis=1),
-                    cls["name"],
-                    "Bias-Variance for '%s'",
-                    train_err_std=train.std(axis=1),
-                    test_err_std=test.std(axis=1),
-                    train_stl="-",
-                    test_stl="-",
-                    train_width=1,
-                    test_width=1,
-                    train_clr="b",
-                    test_clr="r",
-                    alpha=0.2,
-                    fmt="png",
-                    **kw
+    paths, cached = {}, {}
+    if cache:
+        if not os.path.isdir(cache):
+            os.makedirs(cache)
+        digest = array_digest(Xd, Yd)
+        for index, cls in gen:
+            paths[index] = os.path.join(cache, cache_key(cls, digest, n_folds) + ".pkl")
+            cached[index] = load_cache(paths[index])
+    with TrainingPool(Xd, Yd, nprocs) as pool:
+        todo = [(index, cls) for index, cls in gen if not cached.get(index)]
+        tasks = [
+            (cls["classifier"], cls["kwargs"], train, test)
+            for index, cls in todo
+            for train, test in cv
+        ]
+        scores = pool.map(cross_val_fold, tasks)
+        folds = {
+            index: scores[i * len(cv) : (i + 1) * len(cv)]
+            for i, (index, cls) in enumerate(todo)
+        }
+        for index, cls in gen:
+            if cached.get(index):
+                cls.update(cached[index])
+            elif None in folds[index]:
+                # print('problem with: %s' % cls['name'])
+                continue
+            else:
+                cls["scores"] = np.array(folds[index])
+            try:
+                mean, mx, mn, st = (
+                    cls["scores"].mean(),
+                    cls["scores"].max(),
+                    cls["scores"].min(),
+                    cls["scores"].std(),
                 )
-            if extra:
-                extra_analysis(cls, Xd, Yd, labels)
-                plot_extra(cls, labels, **kw)
-            with open("%s.pkl" % cls["name"].replace(" ", "_"), "wb") as pkl:
-                pk.dump(cls, pkl)
-        except:
-            # print('problem with: %s' % cls['name'])
-            pass
+                vals = (index, cls["name"], mean, mx, mn, st)
+                print(fmt % vals)
+                res.append(vals)
+                update = not cached.get(index)
+                if bv and "bias variance" not in cls:
+                    update = True
+                    bias_variance_analysis(cls, Xd, Yd, n_folds=5, step=5, pool=pool)
+                    bvar = cls["bias variance"]
+                    data_sizes = np.array(sorted(bvar.keys()))
+                    test = np.array([bvar[i]["test"] for i in data_sizes])
+                    train = np.array([bvar[i]["train"] for i in data_sizes])
+                    plot_bias_variance(
+                        data_sizes,
+                        train.mean(axis=1),
+                        test.mean(axis=1),
+                        cls["name"],
+                        "Bias-Variance for '%s'",
+                        train_err_std=train.std(axis=1),
+                        test_err_std=test.std(axis=1),
+                        train_stl="-",
+                        test_stl="-",
+                        train_width=1,
+                        test_width=1,
+                        train_clr="b",
+                        test_clr="r",
+                        alpha=0.2,
+                        fmt="png",
+                        **kw
+                    )
+                if extra and "label scores" not in cls:
+                    update = True
+                    extra_analysis(cls, Xd, Yd, labels, pool=pool)
+                    plot_extra(cls, labels, **kw)
+                if update:
+                    with open("%s.pkl" % cls["name"].replace(" ", "_"), "wb") as pkl:
+                        pk.dump(cls, pkl)
+                    if cache:
+                        save_cache(paths[index], cls)
+            except:
+                # print('problem with: %s' % cls['name'])
+                pass
     return np.array(res, dtype=SCORES_DTYPE)
 
 
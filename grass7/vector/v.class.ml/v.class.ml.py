@@ -185,6 +185,52 @@
 #% required: no
 #%end
 #%option
+#% key: npy_bseeds
+#% type: string
+#% multiple: no
+#% description: npy file with the seed and the score of each round of the training optimization
+#% answer: training_seeds.npy
+#% required: no
+#%end
+#%option
+#% key: maxiterations
+#% type: integer
+#% multiple: no
+#% description: Maximum number of rounds to optimize the training set
+#% required: no
+#% answer: 1000
+#%end
+#%option
+#% key: patience
+#% type: integer
+#% multiple: no
+#% description: Stop the optimization of the training set after this number of rounds without improvement, if 0 run all the rounds
+#% required: no
+#% answer: 0
+#%end
+#%option
+#% key: seed
+#% type: integer
+#% multiple: no
+#% description: Seed of the random generator used to optimize the training set
+#% required: no
+#%end
+#%option
+#% key: nprocs
+#% type: integer
+#% multiple: no
+#% description: Number of processes used to optimize the training set, to test the classifiers and to rank the feature importances
+#% required: no
+#% answer: 1
+#%end
+#%option
+#% key: cache_dir
+#% type: string
+#% multiple: no
+#% description: Directory to cache the test results of each classifier, if empty the results are not cached
+#% required: no
+#%end
+#%option
 #% key: nan
 #% type: string
 #% multiple: yes
@@ -600,6 +646,7 @@ def main(opt, flg):
         classifiers = [classifiers[i] for i in indexes]
 
     num = int(opt["n_training"]) if opt["n_training"] else None
+    nprocs = int(opt["nprocs"])
 
     # load fron npy files
     Xt = np.load(opt["npy_tdata"])
@@ -638,16 +685,19 @@ def main(opt, flg):
             cols[1:],
             csv=opt["imp_csv"],
             img=opt["imp_fig"],
+            n_jobs=nprocs,
             # default parameters to save the matplotlib figure
             **dict(dpi=300, transparent=False, bbox_inches="tight")
         )
 
     # optimize the training set
     if flg["o"]:
+        if int(opt["maxiterations"]) < 1:
+            msgr.fatal("The maxiterations option must be greater than 0.")
         ind_optimize = int(opt["pyindx_optimize"]) if opt["pyindx_optimize"] else 0
         cls = classifiers[ind_optimize]
         msgr.message("Find the optimum training set.")
-        best, Xbt, Ybt = optimize_training(
+        best, Xbt, Ybt, rounds = optimize_training(
             cls,
             Xt,
             Yt,
@@ -655,8 +705,14 @@ def main(opt, flg):
             scaler,
             decmp,
             num=num,
-            maxiterations=1000,
+            maxiterations=int(opt["maxiterations"]),
+            nprocs=nprocs,
+            patience=int(opt["patience"]),
+            seed=int(opt["seed"]) if opt["seed"] else None,
         )
+        msg = "    - save the seeds of the training data sets to: %s."
+        msgr.message(msg % opt["npy_bseeds"])
+        np.save(opt["npy_bseeds"], rounds)
         msg = "    - save the optimum training data set to: %s."
         msgr.message(msg % opt["npy_btdata"])
         np.save(opt["npy_btdata"], Xbt)
@@ -727,6 +783,8 @@ def main(opt, flg):
             n_folds=5,
             bv=flg["v"],
             extra=flg["x"],
+            nprocs=nprocs,
+            cache=opt["cache_dir"],
         )
         # TODO: sort(order=...) is working only in the terminal, why?
         # res.sort(order='mean')
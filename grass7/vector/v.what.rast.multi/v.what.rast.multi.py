@@ -36,6 +36,12 @@
 #% description: Interpolate values from the nearest four cells
 #%end
 
+#%flag
+#% key: b
+#% label: Sample all rasters in bulk and update the table in a single transaction
+#% description: Reads point coordinates once and only the raster rows holding points
+#%end
+
 #%option
 #% key: map
 #% type: string
@@ -100,15 +106,215 @@
 #% description: Example: income < 1000 and population >= 10000
 #%end
 
+#%option
+#% key: nprocs
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Number of rasters sampled in parallel (bulk mode only)
+#% answer: 1
+#%end
+
 import sys
 import os
+from multiprocessing import Pool
+
+import numpy as np
+
 import grass.script as grass
 from grass.pygrass.modules.shortcuts import vector as v
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.vector import VectorTopo
 
 if "GISBASE" not in os.environ:
     grass.message("You must be in GRASS GIS to run this program.")
     sys.exit(1)
 
+# Null value returned by RasterRow for CELL maps
+CELL_NULL = -2147483648
+
+
+def read_points(vmap, layer, vtype, where):
+    """Read coordinates and categories of the points once
+
+    Returns the x and y coordinates and the categories as NumPy arrays.
+    Features without a category in the given layer are skipped.
+    """
+    ascii = grass.read_command(
+        "v.out.ascii",
+        input=vmap,
+        layer=layer,
+        type=vtype,
+        where=where,
+        format="point",
+        separator="pipe",
+        quiet=True,
+    )
+    xs, ys, cats = [], [], []
+    for line in ascii.splitlines():
+        fields = line.split("|")
+        if len(fields) < 3 or not fields[-1]:
+            continue
+        xs.append(float(fields[0]))
+        ys.append(float(fields[1]))
+        cats.append(int(fields[-1]))
+    return np.array(xs), np.array(ys), np.array(cats, dtype=int)
+
+
+def cell_offsets(x, y, region, interpolate):
+    """Compute the cells and weights needed to sample each point
+
+    Returns a list of (rows, cols, weights) tuples, one per cell used in
+    the (optionally interpolated) sampling, and a mask of points inside the
+    current region. The interpolation uses the inverse squared distance to
+    the centers of the four nearest cells, cells outside of the region get
+    a zero weight and a cell at the point itself an infinite weight.
+    """
+    nrows, ncols = region["rows"], region["cols"]
+    fcol = (x - region["w"]) / region["ewres"]
+    frow = (region["n"] - y) / region["nsres"]
+    inside = (fcol >= 0) & (fcol < ncols) & (frow >= 0) & (frow < nrows)
+    if not interpolate:
+        rows = np.clip(np.floor(frow), 0, nrows - 1).astype(int)
+        cols = np.clip(np.floor(fcol), 0, ncols - 1).astype(int)
+        return [(rows, cols, np.ones(x.shape))], inside
+
+    # inverse distance weighting of the centers of the four nearest cells
+    fcol -= 0.5
+    frow -= 0.5
+    col0 = np.floor(fcol)
+    row0 = np.floor(frow)
+    offsets = []
+    for drow in (0, 1):
+        for dcol in (0, 1):
+            rows = row0 + drow
+            cols = col0 + dcol
+            dist2 = ((fcol - cols) * region["ewres"]) ** 2 + (
+                (frow - rows) * region["nsres"]
+            ) ** 2
+            with np.errstate(divide="ignore"):
+                weights = 1.0 / dist2
+            valid = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+            weights[~valid] = 0
+            rows = np.clip(rows, 0, nrows - 1).astype(int)
+            cols = np.clip(cols, 0, ncols - 1).astype(int)
+            offsets.append((rows, cols, weights))
+    return offsets, inside
+
+
+def sample_raster(args):
+    """Sample one raster at the given cells, reading only the needed rows
+
+    Returns the raster values at the points as floats, NaN for null cells.
+    Null cells are left out of the weighted average, a point is null only if
+    all its cells are null.
+    """
+    raster, offsets, inside = args
+    rows = np.concatenate([o[0] for o in offsets])
+    cols = np.concatenate([o[1] for o in offsets])
+    values = np.full(rows.shape, np.nan)
+    # group the requested cells by row so that each row is read only once
+    order = np.argsort(rows, kind="stable")
+    needed, starts = np.unique(rows[order], return_index=True)
+    bounds = np.append(starts, len(order))
+    with RasterRow(raster) as rast:
+        is_cell = rast.mtype == "CELL"
+        for i, row in enumerate(needed):
+            idx = order[bounds[i] : bounds[i + 1]]
+            cells = np.asarray(rast[int(row)])[cols[idx]]
+            row_values = cells.astype(float)
+            if is_cell:
+                row_values[cells == CELL_NULL] = np.nan
+            values[idx] = row_values
+
+    values = values.reshape(len(offsets), -1)
+    weights = np.array([o[2] for o in offsets])
+    weights[np.isnan(values)] = 0
+    # a cell at the point itself gives its value
+    exact = np.isinf(weights)
+    hit = exact.any(axis=0)
+    weights[:, hit] = exact[:, hit]
+    total = weights.sum(axis=0)
+    with np.errstate(invalid="ignore"):
+        result = np.where(weights > 0, weights * values, 0).sum(axis=0) / total
+    result[~inside] = np.nan
+    return result
+
+
+def bulk_sample(vmap, layer, vtype, rasters, columns, where, interpolate, nprocs):
+    """Sample all rasters and update the attribute table in one transaction"""
+    x, y, cats = read_points(vmap, layer, vtype, where)
+    if not len(cats):
+        grass.warning(_("No features with category found in layer <%s>") % layer)
+        return
+    offsets, inside = cell_offsets(x, y, grass.region(), interpolate)
+
+    # points sharing a category cannot be assigned a single value
+    unique_cats, counts = np.unique(cats, return_counts=True)
+    duplicated = np.isin(cats, unique_cats[counts > 1])
+    if duplicated.any():
+        grass.warning(
+            _("%d categories are shared by several points, values set to NULL")
+            % np.count_nonzero(counts > 1)
+        )
+
+    # create missing columns with the type of the raster
+    existing = grass.vector_columns(vmap, layer)
+    new_columns = []
+    for raster, column in zip(rasters, columns):
+        if column not in existing:
+            datatype = grass.raster_info(raster)["datatype"]
+            coltype = "integer" if datatype == "CELL" else "double precision"
+            new_columns.append("{} {}".format(column, coltype))
+    if new_columns:
+        v.db_addcolumn(map=vmap, layer=layer, columns=",".join(new_columns))
+        existing = grass.vector_columns(vmap, layer)
+
+    grass.message(_("Sampling %d raster maps...") % len(rasters))
+    jobs = [(raster, offsets, inside) for raster in rasters]
+    if nprocs > 1:
+        pool = Pool(min(nprocs, len(rasters)))
+        try:
+            samples = pool.map(sample_raster, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        samples = [sample_raster(job) for job in jobs]
+
+    records = []
+    for column, values in zip(columns, samples):
+        values[duplicated] = np.nan
+        is_int = existing[column]["type"].upper() == "INTEGER"
+        records.append(
+            [
+                None if np.isnan(value) else (int(value) if is_int else float(value))
+                for value in values
+            ]
+        )
+    records.append(cats.tolist())
+
+    grass.message(_("Updating attribute table..."))
+    vect = VectorTopo(vmap)
+    vect.open("r")
+    try:
+        link = vect.dblinks.by_layer(int(layer))
+        placeholder = "?" if link.driver == "sqlite" else "%s"
+        sql = "UPDATE {table} SET {values} WHERE {key}={placeholder}".format(
+            table=link.table_name,
+            values=", ".join("{}={}".format(c, placeholder) for c in columns),
+            key=link.key,
+            placeholder=placeholder,
+        )
+        conn = link.connection()
+        cur = conn.cursor()
+        cur.executemany(sql, list(zip(*records)))
+        conn.commit()
+        cur.close()
+        conn.close()
+    finally:
+        vect.close()
+
 
 def main():
 
@@ -133,6 +339,21 @@ def main():
     else:
         fl = ""
 
+    if flags["b"]:
+        if columns == [""]:
+            columns = [r.split("@")[0] for r in rasters]
+        bulk_sample(
+            vmap,
+            layer,
+            vtype,
+            rasters,
+            columns,
+            where,
+            flags["i"],
+            int(options["nprocs"]),
+        )
+        return 0
+
     # For each raster
     for i in range(len(rasters)):
 